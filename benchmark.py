@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота театральной мастерской "ИГРА"
+
+Генерирует обновления Telegram для полных сценариев пользователей
+(/start, кнопки меню, выбор филиала, ФИО, телефон, подтверждение),
+отправляет их в /webhook с заданной параллельностью и печатает
+пропускную способность, p50/p95/p99 по обработчикам и ожидание
+блокировки SQLite. Bot API заменён локальной заглушкой.
+
+Примеры:
+    python benchmark.py --users 200 --concurrency 16
+    python benchmark.py --server --save-baseline
+    python benchmark.py --compare  # сравнить с сохранённым baseline
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+BASELINE_FILE = "benchmark_baseline.json"
+
+# ================== ЗАГЛУШКА BOT API ==================
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    """Отвечает на любые методы Bot API успешным результатом"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # иначе keep-alive ответы ждут delayed ACK
+    latency = 0.0
+
+    def _handle(self):
+        length = int(self.headers.get("content-length") or 0)
+        if length:
+            self.rfile.read(length)
+        
+        url = urlparse(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if self.latency:
+            time.sleep(self.latency)
+        
+        if method in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", "")
+            }
+        else:
+            result = True
+        
+        body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _handle
+
+    def log_message(self, *args):
+        pass
+
+def start_fake_api(latency):
+    """Запустить заглушку Bot API на свободном порту"""
+    FakeBotApiHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ================== ГЕНЕРАЦИЯ ОБНОВЛЕНИЙ ==================
+class UpdateFactory:
+    """Конструктор JSON-обновлений Telegram"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def _take_id(self):
+        with self._lock:
+            value = self._next_id
+            self._next_id += 1
+            return value
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def message(self, user_id, text):
+        update_id = self._take_id()
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, user_id, data):
+        update_id = self._take_id()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(user_id),
+            "from": self._user(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "🏢 Выберите филиал:"
+            }
+        }}
+
+    def journey(self, user_id, filial_id):
+        """Полный сценарий: меню, запись и просмотр своих записей"""
+        return [
+            self.message(user_id, "/start"),
+            self.message(user_id, "🏢 Наши филиалы"),
+            self.message(user_id, "📞 Контакты"),
+            self.message(user_id, "ℹ️ О нас"),
+            self.message(user_id, "📝 Записаться на занятие"),
+            self.callback(user_id, f"filial_{filial_id}"),
+            self.message(user_id, f"Тестов Тест {user_id}"),
+            self.message(user_id, f"+7916{user_id % 10000000:07d}"),
+            self.callback(user_id, "confirm_yes"),
+            self.message(user_id, "👤 Мои записи"),
+        ]
+
+# ================== СБОР ИЗМЕРЕНИЙ ==================
+class Recorder:
+    """Сырые длительности по именам серий"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def add(self, name, value):
+        with self._lock:
+            self.samples[name].append(value)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+    }
+
+def instrument(bot_module, recorder):
+    """Подменить run_handler и db_transaction для записи сырых длительностей"""
+    original_run_handler = bot_module.run_handler
+    original_transaction = bot_module.db_transaction
+    
+    def run_handler(handler, update):
+        started = time.perf_counter()
+        try:
+            original_run_handler(handler, update)
+        finally:
+            recorder.add(f"handler:{handler.__name__}", time.perf_counter() - started)
+    
+    @contextmanager
+    def db_transaction():
+        started = time.perf_counter()
+        with original_transaction() as cursor:
+            # BEGIN IMMEDIATE уже выполнен: всё время до сюда — ожидание блокировки
+            recorder.add("db:lock_wait", time.perf_counter() - started)
+            yield cursor
+    
+    bot_module.run_handler = run_handler
+    bot_module.db_transaction = db_transaction
+
+# ================== ЗАПУСК ==================
+def configure_environment(args, api_url, workdir):
+    """Настройки бота до импорта bot_final"""
+    os.environ["TELEGRAM_API_URL"] = api_url
+    os.environ["DB_NAME"] = os.path.join(workdir, "benchmark.db")
+    os.environ["WEBHOOK_URL"] = ""
+    os.environ["RENDER_EXTERNAL_URL"] = ""
+    # Лимиты Telegram измеряют Telegram, а не бота: снимаем их
+    os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "100000")
+    os.environ.setdefault("TELEGRAM_CHAT_RATE", "100000")
+    os.environ.setdefault("TELEGRAM_CHAT_BURST", "100000")
+    os.environ.setdefault("UPDATE_QUEUE_SIZE", str(args.users * 20))
+    if args.workers:
+        os.environ["UPDATE_WORKERS"] = str(args.workers)
+    if args.inline_reply:
+        os.environ["WEBHOOK_INLINE_REPLY"] = "1"
+
+def make_poster(args, bot_module):
+    """Функция отправки обновления в /webhook (test client или HTTP)"""
+    if not args.server:
+        client = bot_module.app.test_client()
+        
+        def post(update):
+            response = client.post("/webhook", data=json.dumps(update), content_type="application/json")
+            return response.status_code
+        return post, None
+    
+    import requests
+    from werkzeug.serving import make_server
+    
+    server = make_server("127.0.0.1", 0, bot_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/webhook"
+    local = threading.local()
+    
+    def post(update):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        response = session.post(url, data=json.dumps(update), headers={"Content-Type": "application/json"})
+        return response.status_code
+    return post, server
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="igra-bench-")
+    api = start_fake_api(args.api_latency / 1000)
+    configure_environment(args, f"http://127.0.0.1:{api.server_port}", workdir)
+    
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot_final
+    
+    bot_final.init_db()
+    recorder = Recorder()
+    instrument(bot_final, recorder)
+    post, server = make_poster(args, bot_final)
+    
+    factory = UpdateFactory()
+    filial_ids = sorted(bot_final.filial_catalog.get().by_id) or [1]
+    journeys = [
+        factory.journey(100000 + index, filial_ids[index % len(filial_ids)])
+        for index in range(args.users)
+    ]
+    total_updates = sum(len(journey) for journey in journeys)
+    rejected = []
+    
+    def play(journey):
+        for update in journey:
+            started = time.perf_counter()
+            status = post(update)
+            recorder.add("webhook:response", time.perf_counter() - started)
+            if status != 200:
+                rejected.append(status)
+    
+    print(f"🚀 {args.users} сценариев, {total_updates} обновлений, параллельность {args.concurrency}")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(play, journeys))
+    bot_final.update_dispatcher.wait_idle()
+    elapsed = time.perf_counter() - started
+    
+    if server is not None:
+        server.shutdown()
+    api.shutdown()
+    
+    bookings = bot_final.db_fetchone("SELECT COUNT(*) FROM bookings")[0]
+    lock_errors = sum(
+        value for labels, value in bot_final.DB_ERRORS._values.items()
+    )
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "mode": "server" if args.server else "test_client",
+        "updates": total_updates,
+        "rejected": len(rejected),
+        "bookings": bookings,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(total_updates / elapsed, 1),
+        "db_errors": lock_errors,
+        "series": {name: summarize(values) for name, values in sorted(recorder.samples.items())},
+    }
+
+def print_report(result):
+    print("=" * 60)
+    print(f"⏱  Время: {result['elapsed_s']} с, пропускная способность: {result['throughput_ups']} обн/с")
+    print(f"📋 Записей создано: {result['bookings']}, отклонено webhook: {result['rejected']}, "
+          f"ошибок БД: {result['db_errors']}")
+    print("-" * 60)
+    print(f"{'серия':40} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, stats in result["series"].items():
+        print(f"{name:40} {stats['count']:>6} {stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8}")
+    print("=" * 60)
+
+def compare(result, baseline, tolerance):
+    """Список регрессий относительно baseline"""
+    regressions = []
+    if result["throughput_ups"] < baseline["throughput_ups"] * (1 - tolerance):
+        regressions.append(
+            f"пропускная способность {result['throughput_ups']} < {baseline['throughput_ups']}"
+        )
+    for name, stats in result["series"].items():
+        base = baseline["series"].get(name)
+        if base and base["p95_ms"] and stats["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {stats['p95_ms']} мс > {base['p95_ms']} мс")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /webhook")
+    parser.add_argument("--users", type=int, default=100, help="число сценариев (пользователей)")
+    parser.add_argument("--concurrency", type=int, default=8, help="параллельных отправителей")
+    parser.add_argument("--workers", type=int, default=0, help="UPDATE_WORKERS бота")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка заглушки Bot API, мс")
+    parser.add_argument("--server", action="store_true", help="слать запросы в локальный HTTP-сервер")
+    parser.add_argument("--inline-reply", action="store_true", help="включить WEBHOOK_INLINE_REPLY")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="файл baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="сохранить результат как baseline")
+    parser.add_argument("--compare", action="store_true", help="сравнить с baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+    
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+    
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Baseline сохранён в {args.baseline}")
+    
+    if args.compare:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print("❌ Регрессии относительно baseline:")
+            for line in regressions:
+                print(f"  • {line}")
+            sys.exit(1)
+        print("✅ Регрессий нет")
+
+if __name__ == "__main__":
+    main()
@@ -5,16 +5,42 @@ Telegram бот для театральной мастерской "ИГРА"
 """
 
 import os
+import io
+import re
+import csv
+import hmac
+import json
+import atexit
 import sqlite3
 import logging
+import logging.handlers
 import threading
 import time
+import queue
+import random
+import signal
+import shutil
+import socket
+import sys
+import uuid
+import tempfile
 import requests
-from datetime import datetime
-from flask import Flask, request
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import Flask, Response, request
 from apscheduler.schedulers.background import BackgroundScheduler
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from werkzeug.serving import make_server
 import telebot
-from telebot import types
+from telebot import apihelper, types
+
+PROCESS_STARTED = time.monotonic()  # отсчёт времени холодного старта
 
 # ================== НАСТРОЙКИ ==================
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8547352136:AAE1_t3mZcI8kmLXenqAu4WyTgSNRAvQcQs")
@@ -22,19 +48,1037 @@ ADMIN_ID = os.getenv("ADMIN_ID", "482094409")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # https://your-project.onrender.com
 SELF_PING_URL = os.getenv("RENDER_EXTERNAL_URL", "")
 
-bot = telebot.TeleBot(BOT_TOKEN)
-DB_NAME = "filials_bookings.db"
+# threaded=False: обновления обрабатывает наш пул воркеров (см. UpdateDispatcher),
+# который сохраняет порядок внутри чата; пул telebot этого не гарантирует
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+DB_NAME = os.getenv("DB_NAME", "filials_bookings.db")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_IDLE_CONNECTIONS = int(os.getenv("DB_IDLE_CONNECTIONS", "8"))  # запас соединений для HTTP-потоков
+FILIAL_CATALOG_CHECK_SECONDS = float(os.getenv("FILIAL_CATALOG_CHECK_SECONDS", "60"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+WEBHOOK_BACKPRESSURE_STATUS = int(os.getenv("WEBHOOK_BACKPRESSURE_STATUS", "503"))
+WEBHOOK_RETRY_AFTER = int(os.getenv("WEBHOOK_RETRY_AFTER", "1"))
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_SECONDS", str(24 * 3600)))
+STATE_MAX_SIZE = int(os.getenv("STATE_MAX_SIZE", "10000"))
+STATE_PERSIST = os.getenv("STATE_PERSIST", "1") == "1"
+STATE_FLUSH_SECONDS = float(os.getenv("STATE_FLUSH_SECONDS", "2"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # например, локальный фейковый Bot API
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "16"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # сообщений в секунду
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))
+WEBHOOK_INLINE_REPLY = os.getenv("WEBHOOK_INLINE_REPLY", "0") == "1"
+WEBHOOK_INLINE_REPLY_TIMEOUT = float(os.getenv("WEBHOOK_INLINE_REPLY_TIMEOUT", "1.0"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+STATUS_CACHE_SECONDS = float(os.getenv("STATUS_CACHE_SECONDS", "5"))
+BOOKINGS_PAGE_SIZE = int(os.getenv("BOOKINGS_PAGE_SIZE", "10"))
+BOOKINGS_CACHE_SECONDS = float(os.getenv("BOOKINGS_CACHE_SECONDS", "300"))
+BOOKINGS_CACHE_USERS = int(os.getenv("BOOKINGS_CACHE_USERS", "1000"))
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN", "")  # пусто — HTTP-выгрузка отключена
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "500"))
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024  # лимит Bot API на отправку файла
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "10000"))
+# Через неделю без обновлений Telegram выбирает следующий update_id случайно
+DEDUP_MARK_MAX_AGE_DAYS = float(os.getenv("DEDUP_MARK_MAX_AGE_DAYS", "6"))
+POLL_BATCH_SIZE = int(os.getenv("POLL_BATCH_SIZE", "100"))  # 1..100, лимит getUpdates
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))  # секунд ожидания long polling
+DEDUP_FLUSH_SECONDS = float(os.getenv("DEDUP_FLUSH_SECONDS", "1"))
+DB_WRITER_MAX_BATCH = int(os.getenv("DB_WRITER_MAX_BATCH", "64"))
+DB_WRITER_LINGER_MS = float(os.getenv("DB_WRITER_LINGER_MS", "0"))
+DB_WRITER_TIMEOUT = float(os.getenv("DB_WRITER_TIMEOUT", "10"))
+NOTIFY_POLL_SECONDS = float(os.getenv("NOTIFY_POLL_SECONDS", "5"))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "10"))
+NOTIFY_DIGEST_WINDOW = float(os.getenv("NOTIFY_DIGEST_WINDOW", "0"))  # 0 — без дайджестов
+NOTIFY_RETENTION_DAYS = int(os.getenv("NOTIFY_RETENTION_DAYS", "30"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))  # 0 — архив отключён
+ARCHIVE_TERMINAL_AFTER_DAYS = int(os.getenv("ARCHIVE_TERMINAL_AFTER_DAYS", "30"))
+ARCHIVE_TERMINAL_STATUSES = os.getenv("ARCHIVE_TERMINAL_STATUSES", "cancelled,done")
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_INTERVAL_MINUTES = float(os.getenv("ARCHIVE_INTERVAL_MINUTES", "60"))
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "256"))
+# Разовый полный VACUUM для файла без auto_vacuum — только на время обслуживания
+DB_VACUUM_CONVERT = os.getenv("DB_VACUUM_CONVERT", "0") == "1"
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # сообщений/с; остаток лимита — обычным ответам
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+BROADCAST_REPORT_SECONDS = float(os.getenv("BROADCAST_REPORT_SECONDS", "15"))
+PORT = int(os.getenv("PORT", "10000"))
+SERVER_BACKEND = os.getenv("SERVER_BACKEND", "auto")  # auto | gunicorn | waitress | werkzeug
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))  # процессы gunicorn
+WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+SHARED_STATE = os.getenv("SHARED_STATE", "sqlite")  # sqlite (один хост) | redis
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "redis://localhost:6379/0")
+CHAT_SHARDS = int(os.getenv("CHAT_SHARDS", str(WEB_CONCURRENCY)))  # процессов на все инстансы
+SHARD_LEASE_SECONDS = float(os.getenv("SHARD_LEASE_SECONDS", "15"))
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", "0.01"))  # доля обновлений с DEBUG-записями
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# ================== ЛОГИРОВАНИЕ ==================
+# Поток обработки только кладёт запись в очередь; форматирует и пишет в
+# stderr фоновый QueueListener. К каждой записи добавляется контекст
+# обновления из log_context(): update_id, user_id, обработчик и время
+# с начала обработки.
+_log_context = threading.local()
+
+@contextmanager
+def log_context(**fields):
+    """Добавить поля к записям лога текущего потока на время блока"""
+    previous = getattr(_log_context, 'fields', None) or {}
+    current = {**previous, **fields}
+    if 'update_id' in fields:
+        current['started'] = time.perf_counter()
+        # DEBUG-записи пишутся для всего обновления целиком или не пишутся вовсе
+        current['sampled'] = random.random() < LOG_DEBUG_SAMPLE
+    _log_context.fields = current
+    try:
+        yield
+    finally:
+        _log_context.fields = previous
+
+class LogContextFilter(logging.Filter):
+    """Поля контекста на запись и выборка DEBUG (работает в потоке вызова)"""
+
+    FIELDS = ('update_id', 'user_id', 'handler')
+
+    def __init__(self, level, debug_sample):
+        super().__init__()
+        self.level = level
+        self.debug_sample = debug_sample
+
+    def filter(self, record):
+        fields = getattr(_log_context, 'fields', None) or {}
+        if record.levelno < self.level:
+            sampled = fields.get('sampled')
+            if sampled is None:
+                sampled = random.random() < self.debug_sample
+            if not sampled:
+                return False
+        for name in self.FIELDS:
+            if name in fields and not hasattr(record, name):
+                setattr(record, name, fields[name])
+        if 'started' in fields and not hasattr(record, 'duration_ms'):
+            record.duration_ms = round((time.perf_counter() - fields['started']) * 1000, 3)
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования и ожидания в потоке вызова.
+
+    Запись уходит в очередь как есть (процесс один, сериализовать её не
+    нужно). Переполненная очередь не тормозит обработку: запись
+    отбрасывается и учитывается в dropped.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    FIELDS = ('update_id', 'user_id', 'handler', 'duration_ms')
 
-# Логирование
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for name in self.FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def _start_log_listener():
+    """Новая очередь и поток-писатель (при старте и в дочернем процессе после fork)"""
+    global log_listener
+    log_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    log_listener = logging.handlers.QueueListener(log_handler.queue, log_output)
+    log_listener.start()
+
+def _stop_log_listener():
+    """Дописать очередь до конца (при выходе из процесса)"""
+    if log_listener._thread is not None:
+        log_listener.stop()
+
+# Имя файла и строка в записях не выводятся — не ищем их по стеку
+logging._srcfile = None
+logging.logMultiprocessing = False
+
+log_output = logging.StreamHandler()
+log_output.setFormatter(
+    JsonLogFormatter() if LOG_FORMAT == "json"
+    else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 )
+log_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_handler.addFilter(LogContextFilter(logging.getLevelName(LOG_LEVEL), LOG_DEBUG_SAMPLE))
+logging.getLogger().handlers[:] = [log_handler]
+logging.getLogger().setLevel(LOG_LEVEL)
+log_listener = None
+_start_log_listener()
+# Поток-писатель не переживает fork (воркеры gunicorn) — запускаем заново
+os.register_at_fork(after_in_child=_start_log_listener)
+# Регистрируется раньше shutdown(), поэтому atexit вызовет его последним
+atexit.register(_stop_log_listener)
+
 logger = logging.getLogger(__name__)
+# DEBUG бота создаётся всегда, в вывод попадает выборка LOG_DEBUG_SAMPLE
+logger.setLevel(logging.DEBUG if LOG_DEBUG_SAMPLE > 0 else LOG_LEVEL)
+
+# ================== МЕТРИКИ ==================
+# Минимальная реализация формата Prometheus без внешних зависимостей:
+# наблюдение — это bisect по границам корзин и пара сложений под блокировкой.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Монотонный счётчик с метками"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Гистограмма длительностей с метками"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # labels -> [счётчики по корзинам..., +Inf], сумма
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', le)])} {cumulative}"
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+class Gauge:
+    """Значение, которое вычисляется в момент запроса /metrics"""
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.callback()}",
+        ]
+
+class MetricsRegistry:
+    """Набор метрик для эндпоинта /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback):
+        return self._add(Gauge(name, documentation, callback))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось снять метрику {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram(
+    "bot_handler_duration_seconds", "Время работы обработчиков бота", ("handler",)
+)
+HANDLER_ERRORS = metrics.counter(
+    "bot_handler_errors_total", "Исключения в обработчиках бота", ("handler",)
+)
+DB_QUERY_LATENCY = metrics.histogram(
+    "bot_db_query_duration_seconds", "Время запросов к SQLite по вызывающей функции", ("caller", "kind")
+)
+DB_ERRORS = metrics.counter(
+    "bot_db_errors_total", "Ошибки запросов к SQLite", ("caller", "kind")
+)
+API_LATENCY = metrics.histogram(
+    "bot_telegram_api_duration_seconds", "Время вызовов Bot API с ожиданием лимитов", ("method",)
+)
+API_ERRORS = metrics.counter(
+    "bot_telegram_api_errors_total", "Неуспешные вызовы Bot API", ("method", "code")
+)
+DB_WRITER_BATCH = metrics.histogram(
+    "bot_db_writer_batch_size", "Операций в одной групповой транзакции", (),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+WEBHOOK_UPDATES = metrics.counter(
+    "bot_webhook_updates_total", "Обновления, принятые webhook", ("result",)
+)
+BROADCAST_MESSAGES = metrics.counter(
+    "bot_broadcast_messages_total", "Сообщения рассылок по результату", ("result",)
+)
+ARCHIVED_BOOKINGS = metrics.counter(
+    "bot_bookings_archived_total", "Записи, перенесённые в bookings_archive"
+)
+metrics.gauge(
+    "bot_log_dropped_records", "Записи лога, отброшенные из-за переполненной очереди",
+    lambda: log_handler.dropped
+)
+POLLING_UPDATES = metrics.counter(
+    "bot_polling_updates_total", "Обновления, полученные через getUpdates", ("result",)
+)
+POLLING_BATCH = metrics.histogram(
+    "bot_polling_batch_size", "Обновлений в одном ответе getUpdates", (),
+    buckets=(1, 2, 5, 10, 25, 50, 100)
+)
+
+# ================== ИСХОДЯЩИЕ ЗАПРОСЫ К TELEGRAM ==================
+class TokenBucket:
+    """Корзина токенов; вызывать под внешней блокировкой"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        """Забрать токен и вернуть, сколько секунд ждать до его появления"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class TelegramSender:
+    """Отправка запросов к Bot API с учётом лимитов Telegram.
+
+    Подключается к telebot через apihelper.CUSTOM_REQUEST_SENDER. Все
+    запросы идут через одну requests.Session с пулом keep-alive соединений.
+    Методы с chat_id ограничиваются общей корзиной токенов (~30 сообщений/с)
+    и корзиной чата (1 сообщение/с в личке, 20 в минуту в группах).
+    На 429 ждём retry_after из ответа, на ошибки соединения, при которых
+    запрос не ушёл, — растущую паузу; к паузе добавляется случайный
+    разброс. 5xx, ReadTimeout и обрыв после отправки повторяем только для
+    get-методов: sendMessage мог уже дойти, и повтор задвоил бы его.
+    """
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, pool_size, global_rate, chat_rate, chat_burst, group_rate, max_retries):
+        self.pool_size = pool_size
+        self.session = self._create_session()
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chat_buckets = OrderedDict()
+        self._stats = {
+            'waiting': 0,
+            'in_flight': 0,
+            'sent': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'errors': 0,
+        }
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def reset_connections(self):
+        """Новый пул соединений: после fork сокеты родителя использовать нельзя"""
+        self.session = self._create_session()
+
+    def set_global_rate(self, rate):
+        """Изменить общий лимит (доля процесса, когда процессов несколько)"""
+        with self._lock:
+            self._global_bucket = TokenBucket(rate, max(1, int(rate)))
+
+    def stats(self):
+        """Счётчики: waiting — запросы, ждущие лимита (глубина очереди)"""
+        with self._lock:
+            return dict(self._stats)
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        method_name = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            response = self._send(method, url, params, files, timeout, proxies)
+        except Exception as e:
+            API_ERRORS.inc(method_name, type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - started, method_name)
+        if response.status_code >= 400:
+            API_ERRORS.inc(method_name, str(response.status_code))
+        return response
+
+    def _send(self, method, url, params, files, timeout, proxies):
+        chat_id = params.get('chat_id') if params else None
+        if chat_id is not None:
+            self._throttle(str(chat_id))
+        
+        inline_response = offer_inline_reply(url.rsplit('/', 1)[-1], params, files)
+        if inline_response is not None:
+            self._count('sent', 1)
+            return inline_response
+        
+        attempt = 0
+        while True:
+            self._count('in_flight', 1)
+            try:
+                response = self.session.request(
+                    method, url, params=params, files=files, timeout=timeout, proxies=proxies
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                delay = self._backoff(attempt)
+                if attempt >= self.max_retries or not self._safe_to_retry(url, e):
+                    self._count('errors', 1)
+                    raise
+                logger.warning(f"⚠️ Telegram недоступен ({e}), повтор через {delay:.1f} с")
+            else:
+                if response.status_code == 429:
+                    self._count('rate_limited', 1)
+                    delay = self._retry_after(response) + random.uniform(0, 0.5)
+                elif response.status_code >= 500 and self._read_only(url):
+                    delay = self._backoff(attempt)
+                else:
+                    self._count('sent', 1)
+                    return response
+                if attempt >= self.max_retries:
+                    self._count('errors', 1)
+                    return response
+                logger.warning(
+                    f"⚠️ Telegram ответил {response.status_code} на {url.rsplit('/', 1)[-1]}, "
+                    f"повтор через {delay:.1f} с"
+                )
+            finally:
+                self._count('in_flight', -1)
+            
+            attempt += 1
+            self._count('retries', 1)
+            time.sleep(delay)
+            self._rewind(files)
+
+    def _throttle(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if chat_id.startswith('-'):
+                    bucket = TokenBucket(self.group_rate, 1)
+                else:
+                    bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._chat_buckets[chat_id] = bucket
+                if len(self._chat_buckets) > self.MAX_CHAT_BUCKETS:
+                    self._chat_buckets.popitem(last=False)
+            else:
+                self._chat_buckets.move_to_end(chat_id)
+            delay = max(self._global_bucket.reserve(now), bucket.reserve(now))
+            if delay > 0:
+                self._stats['waiting'] += 1
+        
+        if delay > 0:
+            time.sleep(delay)
+            self._count('waiting', -1)
+
+    def _count(self, name, value):
+        with self._lock:
+            self._stats[name] += value
+
+    @staticmethod
+    def _safe_to_retry(url, error):
+        """Повтор не задвоит запрос: он не ушёл в Telegram или только читает данные"""
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        if isinstance(reason, NewConnectionError):
+            return True  # соединение не установлено (отказ, DNS)
+        return TelegramSender._read_only(url)
+
+    @staticmethod
+    def _read_only(url):
+        """get-методы только читают: их повтор ничего не задваивает"""
+        return url.rsplit('/', 1)[-1].startswith('get')
+
+    @staticmethod
+    def _rewind(files):
+        """Вернуть файлы в начало: при повторе requests читает их заново"""
+        for value in (files or {}).values():
+            fileobj = value[1] if isinstance(value, tuple) else value
+            if hasattr(fileobj, 'seek'):
+                fileobj.seek(0)
+
+    @staticmethod
+    def _backoff(attempt):
+        return min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return 1.0
+
+telegram_sender = TelegramSender(
+    TELEGRAM_POOL_SIZE,
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_GROUP_RATE,
+    TELEGRAM_MAX_RETRIES
+)
+apihelper.CUSTOM_REQUEST_SENDER = telegram_sender.request
+metrics.gauge(
+    "bot_telegram_waiting_requests", "Запросы к Bot API, ждущие лимита",
+    lambda: telegram_sender.stats()['waiting']
+)
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+
+# ================== ОТВЕТ В ТЕЛЕ WEBHOOK ==================
+# Telegram позволяет вернуть один вызов метода прямо в HTTP-ответе на webhook.
+# В этом режиме (WEBHOOK_INLINE_REPLY=1) первый sendMessage обработчика,
+# помеченного @inline_reply, не уходит отдельным запросом, а отдаётся
+# из webhook(); остальные вызовы идут обычным путём через TelegramSender.
+INLINE_REPLY_METHODS = {'sendMessage'}
+_inline_context = threading.local()
+
+class InlineReplySlot:
+    """Место для первого исходящего вызова, который вернёт webhook()"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._closed = False
+        self.payload = None
+
+    def offer(self, payload):
+        """Отдать вызов в ответ webhook; False, если webhook уже ответил"""
+        with self._lock:
+            if self._closed:
+                return False
+            self.payload = payload
+            self._closed = True
+        self._ready.set()
+        return True
+
+    def release(self):
+        """Обработчик завершился без подходящего вызова"""
+        with self._lock:
+            self._closed = True
+        self._ready.set()
+
+    def take(self, timeout):
+        """Дождаться вызова (или завершения обработчика) и закрыть слот"""
+        self._ready.wait(timeout)
+        with self._lock:
+            self._closed = True
+            return self.payload
+
+class InlineReplyRegistry:
+    """Слоты ответов, ожидающие обработки своих обновлений"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def expect(self, update_id):
+        slot = InlineReplySlot()
+        with self._lock:
+            self._slots[update_id] = slot
+        return slot
+
+    def claim(self, update_id):
+        with self._lock:
+            return self._slots.pop(update_id, None)
+
+    def discard(self, update_id):
+        with self._lock:
+            self._slots.pop(update_id, None)
+
+inline_replies = InlineReplyRegistry()
+
+def inline_reply(handler):
+    """Разрешить обработчику отвечать в теле webhook"""
+    handler.inline_reply = True
+    return handler
+
+@contextmanager
+def inline_reply_scope(handler):
+    """Включить перехват первого вызова на время работы обработчика"""
+    _inline_context.allowed = getattr(handler, 'inline_reply', False)
+    try:
+        yield
+    finally:
+        _inline_context.allowed = False
+
+def offer_inline_reply(method_name, params, files):
+    """Перехватить вызов для ответа в webhook; вернуть фиктивный ответ API или None"""
+    slot = getattr(_inline_context, 'slot', None)
+    if slot is None or files or not getattr(_inline_context, 'allowed', False):
+        return None
+    if method_name not in INLINE_REPLY_METHODS:
+        return None
+    
+    payload = {'method': method_name}
+    for key, value in (params or {}).items():
+        # Разметку telebot передаёт строкой JSON, в теле ответа нужен объект
+        if key in ('reply_markup', 'entities') and isinstance(value, str):
+            value = json.loads(value)
+        payload[key] = value
+    if not slot.offer(payload):
+        return None
+    
+    # Telegram не возвращает результат для такого вызова: отдаём telebot
+    # минимальное сообщение, чтобы обработчик продолжил работу
+    response = requests.Response()
+    response.status_code = 200
+    response.encoding = 'utf-8'
+    response._content = json.dumps({'ok': True, 'result': {
+        'message_id': 0,
+        'date': int(time.time()),
+        'chat': {'id': int(params['chat_id']), 'type': 'private'},
+        'text': params.get('text', '')
+    }}).encode('utf-8')
+    return response
+
+# ================== ОЧЕРЕДЬ ОБНОВЛЕНИЙ ==================
+class UpdateDispatcher:
+    """Пул воркеров для обработки обновлений.
+
+    У каждого чата своя очередь (lane). Ключ чата стоит в общей очереди
+    готовых не более одного раза, поэтому обновления одного чата
+    обрабатываются строго по порядку, а разные чаты — параллельно.
+    После каждого обновления чат возвращается в конец очереди готовых,
+    чтобы активный чат не занимал воркер надолго. update_id принятых, но
+    ещё не обработанных обновлений хранятся до конца обработки: по ним
+    polling знает, до какого offset всё уже обработано.
+    """
+
+    def __init__(self, handler, workers, max_pending):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)  # будится после каждого обновления
+        self._lanes = {}
+        self._in_flight = set()
+        self._ready = queue.SimpleQueue()
+        self._pending = 0
+        self._threads = []
+
+    @property
+    def pending(self):
+        """Сколько обновлений ждёт или обрабатывается"""
+        return self._pending
+
+    def start(self):
+        """Запустить воркеры (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"update-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info(f"✅ Запущено воркеров обработки обновлений: {self.workers}")
+
+    def submit(self, key, update):
+        """Поставить обновление в очередь чата; False, если очередь переполнена"""
+        if not self._threads:
+            self.start()
+        
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            self._in_flight.add(update.update_id)
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append(update)
+                return True
+            self._lanes[key] = deque([update])
+        
+        self._ready.put(key)
+        return True
+
+    def wait_idle(self, timeout=None):
+        """Дождаться, пока все принятые обновления будут обработаны"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def low_water(self, default):
+        """Наименьший update_id среди необработанных; default, если таких нет"""
+        with self._lock:
+            return min(self._in_flight, default=default)
+
+    def wait_progress(self, low_water, timeout):
+        """Дождаться, пока обработается обновление low_water"""
+        with self._idle:
+            return self._idle.wait_for(lambda: low_water not in self._in_flight, timeout)
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                update = self._lanes[key].popleft()
+            
+            try:
+                self.handler(update)
+            except Exception:
+                logger.exception(f"❌ Ошибка обработки обновления {getattr(update, 'update_id', '?')}")
+            
+            with self._lock:
+                self._pending -= 1
+                self._in_flight.discard(update.update_id)
+                if self._lanes[key]:
+                    self._ready.put(key)
+                else:
+                    del self._lanes[key]
+                self._idle.notify_all()
+
+def get_update_chat_id(update):
+    """Ключ очереди для обновления: id чата, иначе id пользователя"""
+    message = update.message or update.edited_message
+    if message is not None:
+        return message.chat.id
+    
+    call = update.callback_query
+    if call is not None:
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+    
+    return update.update_id
+
+def get_update_user_id(update):
+    """Telegram id автора обновления или None"""
+    for item in (update.message, update.edited_message, update.callback_query):
+        if item is not None and item.from_user is not None:
+            return item.from_user.id
+    return None
+
+def handle_update(update):
+    """Обработать одно обновление в воркере"""
+    slot = inline_replies.claim(update.update_id)
+    _inline_context.slot = slot
+    try:
+        with log_context(update_id=update.update_id, user_id=get_update_user_id(update)):
+            try:
+                bot.process_new_updates([update])
+            except Exception:
+                logger.exception(f"❌ Ошибка обработки обновления {update.update_id}")
+    finally:
+        _inline_context.slot = None
+        if slot is not None:
+            slot.release()
+
+update_dispatcher = UpdateDispatcher(handle_update, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+metrics.gauge("bot_update_queue_depth", "Обновления в очереди и в обработке", lambda: update_dispatcher.pending)
+
+# ================== ДЕДУПЛИКАЦИЯ ОБНОВЛЕНИЙ ==================
+class UpdateDeduplicator:
+    """Отбрасывает повторные доставки одного и того же обновления.
+
+    Telegram повторяет webhook, если не получил быстрый 2xx. Недавние
+    update_id и id callback-запросов хранятся в ограниченном LRU, а
+    максимальный принятый update_id (high-water mark) сбрасывается в
+    bot_meta фоновым потоком вместе со временем сохранения. После
+    перезапуска повтором считается update_id не выше отметки и не дальше
+    max_size от неё. Отметка старше max_mark_age не применяется: после
+    недели без обновлений Telegram начинает update_id со случайного числа.
+    """
+
+    def __init__(self, max_size, flush_interval, max_mark_age, meta_key='last_update_id'):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.max_mark_age = max_mark_age
+        self.meta_key = meta_key  # у каждого шарда своя отметка
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self._high_water = 0
+        self._persisted_high_water = 0  # отметка на момент старта
+        self._flushed_high_water = 0
+        self._flusher = None
+
+    def load(self):
+        """Прочитать сохранённую отметку из БД"""
+        row = db_fetchone("SELECT value FROM bot_meta WHERE key = ?", (self.meta_key,))
+        mark = json.loads(row[0]) if row else {}
+        if isinstance(mark, int):
+            mark = {'update_id': mark}  # формат без времени сохранения
+        high_water = mark.get('update_id', 0)
+        saved_at = mark.get('saved_at')
+        if high_water and saved_at is not None and time.time() - saved_at > self.max_mark_age:
+            logger.info(f"ℹ️ Отметка update_id {high_water} устарела, не применяю её")
+            high_water = 0
+        with self._lock:
+            self._persisted_high_water = high_water
+            self._flushed_high_water = self._persisted_high_water
+            self._high_water = max(self._high_water, self._persisted_high_water)
+        return self._persisted_high_water
+
+    def claim(self, update):
+        """Отметить обновление как принятое; False, если это повтор"""
+        keys = self._keys(update)
+        with self._lock:
+            # Дальше max_size ниже отметки повторов не бывает — это новая
+            # последовательность update_id, а не повторная доставка
+            persisted = self._persisted_high_water
+            if persisted and 0 <= persisted - update.update_id < self.max_size:
+                return False
+            if any(key in self._seen for key in keys):
+                return False
+            for key in keys:
+                self._seen[key] = None
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            # Скачок далеко вниз — Telegram начал новую последовательность
+            if update.update_id > self._high_water or self._high_water - update.update_id >= self.max_size:
+                self._high_water = update.update_id
+        self._ensure_flusher()
+        return True
+
+    def rewind(self, update_id):
+        """Не считать повтором update_id и выше: они не обработаны (offset polling)"""
+        with self._lock:
+            self._persisted_high_water = min(self._persisted_high_water, update_id - 1)
+
+    def release(self, update):
+        """Забыть обновление, которое не удалось принять (Telegram его повторит)"""
+        with self._lock:
+            for key in self._keys(update):
+                self._seen.pop(key, None)
+
+    def flush(self):
+        """Сохранить отметку, если она изменилась"""
+        with self._lock:
+            high_water = self._high_water
+        if high_water == self._flushed_high_water:
+            return
+        try:
+            set_meta(self.meta_key, json.dumps({'update_id': high_water, 'saved_at': int(time.time())}))
+            self._flushed_high_water = high_water
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка сохранения last_update_id: {e}")
+
+    @staticmethod
+    def _keys(update):
+        keys = [update.update_id]
+        if update.callback_query is not None:
+            keys.append(('callback', update.callback_query.id))
+        return keys
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="dedup-flusher", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+update_deduplicator = UpdateDeduplicator(
+    DEDUP_CACHE_SIZE,
+    DEDUP_FLUSH_SECONDS,
+    DEDUP_MARK_MAX_AGE_DAYS * 86400
+)
+
+# ================== LONG POLLING ==================
+class UpdatePoller:
+    """Long polling через getUpdates в ту же очередь, что и webhook.
+
+    Обновления приходят пачками до batch_size штук и раскладываются по
+    очередям чатов в update_dispatcher. getUpdates с offset подтверждает
+    Telegram все обновления ниже него, поэтому offset — не следующий
+    update_id, а наименьший ещё не обработанный: после сбоя Telegram
+    отдаст необработанные заново (at-least-once). Пока они в работе,
+    getUpdates возвращает их снова, такие обновления пропускаются. Offset
+    сохраняется в bot_meta, как только сдвинется.
+    """
+
+    META_KEY = 'polling_offset'
+
+    def __init__(self, batch_size, timeout):
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.offset = None
+        self._next_update_id = None  # всё ниже уже передано в update_dispatcher
+        self._stopping = threading.Event()
+
+    def load(self):
+        """Прочитать сохранённый offset из БД"""
+        row = db_fetchone("SELECT value FROM bot_meta WHERE key = ?", (self.META_KEY,))
+        self.offset = int(row[0]) if row else None
+        self._next_update_id = self.offset
+        if self.offset is not None:
+            # Обновления от offset могли быть приняты, но не обработаны до сбоя
+            update_deduplicator.rewind(self.offset)
+        return self.offset
+
+    def save_offset(self):
+        """Сдвинуть offset до первого необработанного обновления и сохранить его"""
+        if self._next_update_id is None:
+            return
+        offset = update_dispatcher.low_water(self._next_update_id)
+        if offset == self.offset:
+            return
+        self.offset = offset
+        try:
+            set_meta(self.META_KEY, offset)
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка сохранения offset polling: {e}")
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        """Опрашивать Telegram в текущем потоке до вызова stop()"""
+        self._stopping.clear()
+        self.load()
+        print(f"🔄 Polling: пачки до {self.batch_size}, ожидание {self.timeout} с, offset {self.offset}")
+        
+        failures = 0
+        while not self._stopping.is_set():
+            self.save_offset()
+            try:
+                # timeout=None: telebot сам выставит таймаут чтения больше long polling
+                updates = bot.get_updates(
+                    offset=self.offset,
+                    limit=self.batch_size,
+                    timeout=None,
+                    long_polling_timeout=self.timeout
+                )
+            except Exception as e:
+                delay = min(30.0, 2 ** failures) * random.uniform(0.5, 1.5)
+                failures += 1
+                logger.warning(f"⚠️ Ошибка getUpdates ({e}), повтор через {delay:.1f} с")
+                self._stopping.wait(delay)
+                continue
+            
+            failures = 0
+            if updates:
+                POLLING_BATCH.observe(len(updates))
+                self._dispatch(updates)
+
+    def _dispatch(self, updates):
+        dispatched = self._next_update_id
+        queue_full = False
+        for update in updates:
+            if self._next_update_id is not None and update.update_id < self._next_update_id:
+                continue  # ещё обрабатывается: offset на нём и стоит
+            if not update_deduplicator.claim(update):
+                POLLING_UPDATES.inc("duplicate")
+                self._next_update_id = update.update_id + 1
+                continue
+            if not update_dispatcher.submit(get_update_chat_id(update), update):
+                # Остаток пачки заберём следующим getUpdates
+                update_deduplicator.release(update)
+                POLLING_UPDATES.inc("rejected")
+                queue_full = True
+                break
+            POLLING_UPDATES.inc("accepted")
+            self._next_update_id = update.update_id + 1
+        
+        if queue_full:
+            logger.warning(f"⚠️ Очередь обновлений переполнена, жду разгрузки (offset {self.offset})")
+            update_dispatcher.wait_idle(self.timeout)
+        elif self._next_update_id == dispatched:
+            # В пачке только обновления в обработке: без паузы getUpdates
+            # сразу вернул бы их снова
+            update_dispatcher.wait_progress(self.offset, min(1.0, self.timeout))
+
+update_poller = UpdatePoller(POLL_BATCH_SIZE, POLL_TIMEOUT)
 
 # ================== FLASK СЕРВЕР С WEBHOOK ==================
 app = Flask(__name__)
 
+@app.teardown_appcontext
+def release_request_db(exception):
+    """Поток запроса не держит соединение: werkzeug заводит поток на каждый запрос"""
+    release_db()
+
 @app.route('/')
 def home():
     return "🎭 Бот театральной мастерской 'ИГРА' работает! ✅"
@@ -47,42 +1091,132 @@ def health():
 def ping():
     return "pong 🏓", 200
 
+@app.route('/ready')
+def ready():
+    """Готовность: БД открыта, фоновые задачи запущены, сервер слушает порт"""
+    if server_ready.is_set():
+        return "ready", 200
+    return "starting", 503
+
 @app.route('/status')
 def status():
     """Статус бота для мониторинга"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM bookings")
-    bookings_count = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM clients")
-    clients_count = cursor.fetchone()[0]
-    conn.close()
+    counters = stats_cache.get()
     
     return {
         "status": "online",
-        "bookings": bookings_count,
-        "clients": clients_count,
+        "bookings": counters["bookings"],
+        "clients": counters["clients"],
+        "bookings_today": counters["bookings_today"],
+        "bookings_by_status": counters["by_status"],
+        "bookings_by_filial": counters["by_filial"],
+        "telegram": telegram_sender.stats(),
         "timestamp": datetime.now().isoformat()
     }
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/export/<table>.<fmt>')
+def export(table, fmt):
+    """Потоковая выгрузка: /export/bookings.csv?filial=1&status=new&from=2024-01-01&to=2024-12-31
+
+    Доступ по заголовку Authorization: Bearer <EXPORT_TOKEN>.
+    """
+    if not EXPORT_TOKEN:
+        return 'Not found', 404
+    
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {EXPORT_TOKEN}".encode()):
+        return 'Unauthorized', 401, {'WWW-Authenticate': 'Bearer'}
+    
+    try:
+        filters = parse_export_filters(request.args.items())
+        chunks = export_stream(table, fmt, filters)
+    except ValueError as e:
+        return f'Bad request: {e}', 400
+    
+    logger.info(f"📤 Выгрузка {table}.{fmt} по HTTP, фильтры: {filters}")
+    return Response(chunks, mimetype=EXPORT_FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename="{export_filename(table, fmt)}"',
+        'X-Accel-Buffering': 'no',  # прокси не должен копить ответ целиком
+    })
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Эндпоинт для получения обновлений от Telegram"""
-    if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+    if request.headers.get('content-type') != 'application/json':
+        return 'Bad request', 400
+    
+    # Процесс останавливается: пусть Telegram повторит доставку позже
+    if not accepting_updates:
+        return 'Shutting down', 503, {'Retry-After': str(WEBHOOK_RETRY_AFTER)}
+    
+    raw = request.get_data().decode('utf-8')
+    try:
+        update = telebot.types.Update.de_json(raw)
+    except (ValueError, KeyError, TypeError) as e:
+        WEBHOOK_UPDATES.inc("invalid")
+        logger.warning(f"⚠️ Некорректное обновление: {e}")
+        return 'Bad request', 400
+    
+    # Чат закреплён за другим процессом: передаём обновление ему
+    chat_id = get_update_chat_id(update)
+    if not chat_shards.owns(chat_id):
+        try:
+            forwarded = chat_shards.forward(chat_id, raw)
+        except Exception as e:
+            WEBHOOK_UPDATES.inc("rejected")
+            logger.error(f"❌ Не удалось передать обновление {update.update_id}: {e}")
+            return 'Unavailable', 503, {'Retry-After': str(WEBHOOK_RETRY_AFTER)}
+        if forwarded:
+            WEBHOOK_UPDATES.inc("forwarded")
+            return '', 200
+        # У шарда нет владельца — обрабатываем здесь
+        WEBHOOK_UPDATES.inc("unowned")
+    
+    # Повторную доставку подтверждаем, но не обрабатываем второй раз
+    if not update_deduplicator.claim(update):
+        WEBHOOK_UPDATES.inc("duplicate")
+        logger.info(f"ℹ️ Повтор обновления {update.update_id} пропущен")
         return '', 200
-    return 'Bad request', 400
+    
+    slot = inline_replies.expect(update.update_id) if WEBHOOK_INLINE_REPLY else None
+    
+    # Отвечаем Telegram сразу, обработка идёт в пуле воркеров
+    if not update_dispatcher.submit(chat_id, update):
+        inline_replies.discard(update.update_id)
+        update_deduplicator.release(update)
+        WEBHOOK_UPDATES.inc("rejected")
+        logger.warning(f"⚠️ Очередь обновлений переполнена, отклоняю {update.update_id}")
+        return 'Queue is full', WEBHOOK_BACKPRESSURE_STATUS, {'Retry-After': str(WEBHOOK_RETRY_AFTER)}
+    
+    WEBHOOK_UPDATES.inc("accepted")
+    
+    if slot is not None:
+        payload = slot.take(WEBHOOK_INLINE_REPLY_TIMEOUT)
+        inline_replies.discard(update.update_id)
+        if payload is not None:
+            return payload, 200
+    return '', 200
 
 def set_webhook():
-    """Установка webhook для Telegram"""
+    """Установка webhook для Telegram (только если он отличается от нужного)"""
     if WEBHOOK_URL:
         try:
-            bot.remove_webhook()
-            time.sleep(1)
             full_url = f"{WEBHOOK_URL}/webhook"
-            bot.set_webhook(url=full_url)
+            info = bot.get_webhook_info()
+            if info.last_error_message:
+                logger.warning(f"⚠️ Последняя ошибка доставки webhook: {info.last_error_message}")
+            if info.url == full_url and info.max_connections == WEBHOOK_MAX_CONNECTIONS:
+                logger.info(f"✅ Webhook уже установлен: {full_url}")
+                print(f"✅ Webhook уже установлен: {full_url}")
+                return True
+            
+            # setWebhook заменяет старый адрес сам, удалять его заранее не нужно
+            bot.set_webhook(url=full_url, max_connections=WEBHOOK_MAX_CONNECTIONS)
             logger.info(f"✅ Webhook установлен: {full_url}")
             print(f"✅ Webhook установлен: {full_url}")
             return True
@@ -100,19 +1234,425 @@ def keep_alive():
         try:
             response = requests.get(f"{SELF_PING_URL}/ping", timeout=10)
             logger.info(f"✅ Self-ping: {response.status_code}")
-            print(f"✅ Ping sent at {datetime.now().strftime('%H:%M:%S')}")
         except Exception as e:
             logger.warning(f"⚠️ Ping failed: {e}")
-            print(f"⚠️ Ping failed: {e}")
     else:
-        print("ℹ️ SELF_PING_URL не установлен, пропускаю пинг")
+        logger.info("ℹ️ SELF_PING_URL не установлен, пропускаю пинг")
 
 # ================== БАЗА ДАННЫХ ==================
-def init_db():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect(DB_NAME)
+# Одно соединение на поток: файл открывается, схема читается и PRAGMA
+# выставляются один раз, а кэш подготовленных выражений sqlite3
+# переиспользуется между обновлениями. Потоки HTTP-запросов (werkzeug
+# создаёт поток на каждый запрос) и разовые потоки возвращают соединение
+# в ограниченный запас release_db(), иначе файлы копились бы до выхода.
+_db_local = threading.local()
+_db_connections = []
+_db_idle = []
+_db_connections_lock = threading.Lock()
+
+def _connect_db():
+    """Открыть соединение с БД и настроить PRAGMA"""
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # транзакции открываем явно в db_transaction()
+        check_same_thread=False,
+        cached_statements=256
+    )
+    # Только для нового файла: на существующем PRAGMA ждёт блокировку на запись
+    # и ничего не меняет без VACUUM — такой файл переводит BookingArchiver
+    # при DB_VACUUM_CONVERT=1
+    if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")  # читатели не ждут писателя
+    conn.execute("PRAGMA synchronous=NORMAL")  # в режиме WAL это безопасно
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def get_db():
+    """Соединение с БД для текущего потока"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        with _db_connections_lock:
+            conn = _db_idle.pop() if _db_idle else None
+        if conn is None:
+            conn = _connect_db()
+            with _db_connections_lock:
+                _db_connections.append(conn)
+        _db_local.conn = conn
+    return conn
+
+def release_db():
+    """Отдать соединение текущего потока в запас (конец запроса или потока)"""
+    conn = _db_local.__dict__.pop('conn', None)
+    if conn is None:
+        return
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        with _db_connections_lock:
+            if len(_db_idle) < DB_IDLE_CONNECTIONS:
+                _db_idle.append(conn)
+                return
+            _db_connections.remove(conn)
+        conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Ошибка освобождения соединения с БД: {e}")
+
+def close_db():
+    """Закрыть все открытые соединения (при остановке процесса)"""
+    with _db_connections_lock:
+        _db_idle.clear()
+        while _db_connections:
+            try:
+                _db_connections.pop().close()
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Ошибка закрытия соединения с БД: {e}")
+    _db_local.__dict__.pop('conn', None)
+
+def db_fetchone(query, params=()):
+    """Выполнить SELECT и вернуть одну строку"""
+    caller = sys._getframe(1).f_code.co_name
+    started = time.perf_counter()
+    try:
+        return get_db().execute(query, params).fetchone()
+    except sqlite3.Error:
+        DB_ERRORS.inc(caller, "read")
+        raise
+    finally:
+        DB_QUERY_LATENCY.observe(time.perf_counter() - started, caller, "read")
+
+def db_fetchall(query, params=()):
+    """Выполнить SELECT и вернуть все строки"""
+    caller = sys._getframe(1).f_code.co_name
+    started = time.perf_counter()
+    try:
+        return get_db().execute(query, params).fetchall()
+    except sqlite3.Error:
+        DB_ERRORS.inc(caller, "read")
+        raise
+    finally:
+        DB_QUERY_LATENCY.observe(time.perf_counter() - started, caller, "read")
+
+@contextmanager
+def db_transaction():
+    """Транзакция на запись.
+
+    BEGIN IMMEDIATE сразу берёт блокировку на запись, поэтому два писателя
+    не упираются в "database is locked" при повышении блокировки, а ждут
+    друг друга в пределах busy_timeout.
+    """
+    # Кадр 1 — __enter__ из contextlib, кадр 2 — код с "with db_transaction()"
+    caller = sys._getframe(2).f_code.co_name
+    started = time.perf_counter()
+    conn = get_db()
     cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            try:
+                conn.commit()
+            except BaseException:
+                # Неудачный COMMIT оставляет транзакцию открытой
+                conn.rollback()
+                raise
+    except sqlite3.Error:
+        DB_ERRORS.inc(caller, "write")
+        raise
+    finally:
+        cursor.close()
+        DB_QUERY_LATENCY.observe(time.perf_counter() - started, caller, "write")
+
+def init_db():
+    """Инициализация базы данных: применение недостающих миграций.
+
+    Версия схемы хранится в PRAGMA user_version, поэтому вызов дешёвый и
+    выполняется один раз при старте процесса, а не в обработчиках.
+    """
+    current_version = db_fetchone("PRAGMA user_version")[0]
+    
+    for version, description, migrate in MIGRATIONS:
+        if version <= current_version:
+            continue
+        
+        with db_transaction() as cursor:
+            # Миграцию мог уже применить другой процесс, пока мы ждали блокировку
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= version:
+                continue
+            migrate(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+        
+        logger.info(f"✅ Миграция {version} применена: {description}")
+        print(f"✅ Миграция {version} применена: {description}")
+    
+    logger.info(f"✅ База данных инициализирована (схема v{MIGRATIONS[-1][0]})")
+    print("✅ База данных инициализирована")
+
+def upsert_client(cursor, user_id, full_name, phone):
+    """Создать или обновить клиента по user_id, вернуть его id"""
+    cursor.execute('''
+    INSERT INTO clients (user_id, full_name, phone, phone_e164, created_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        full_name = excluded.full_name,
+        phone = excluded.phone,
+        phone_e164 = excluded.phone_e164
+    ''', (user_id, full_name, phone, normalize_phone(phone), datetime.now()))
+    # lastrowid не обновляется при UPDATE-ветке upsert, поэтому читаем id явно
+    cursor.execute("SELECT id FROM clients WHERE user_id = ?", (user_id,))
+    return cursor.fetchone()[0]
+
+def set_meta(key, value):
+    """Записать служебное значение в bot_meta"""
+    with db_transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO bot_meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, str(value))
+        )
+
+def create_booking(cursor, user_id, full_name, phone, filial_id):
+    """Сохранить клиента и новую запись, вернуть id записи"""
+    client_id = upsert_client(cursor, user_id, full_name, phone)
+    
+    cursor.execute('''
+    INSERT INTO bookings (client_id, filial_id, service_type, notes, status)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (
+        client_id,
+        filial_id,
+        "🎭 Запись на занятие",
+        "Нет комментариев",
+        'new'
+    ))
     
+    return cursor.lastrowid
+
+def save_booking(cursor, user_id, user_data):
+    """Создать запись и поставить уведомление администратору в outbox.
+
+    Обе вставки идут в одной транзакции, поэтому уведомление не теряется,
+    даже если процесс упадёт сразу после подтверждения записи. Повтор с тем
+    же user_data['confirmation'] (ответ писателя не дождались, клиент нажал
+    ещё раз) возвращает уже созданную запись.
+    """
+    token = user_data.get('confirmation')
+    if token:
+        cursor.execute("SELECT booking_id FROM booking_confirmations WHERE token = ?", (token,))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+    booking_id = create_booking(
+        cursor, user_id, user_data['full_name'], user_data['phone'], user_data['filial_id']
+    )
+    # Повторный клиент: прежние записи этого аккаунта или того же телефона, включая архив
+    phone_e164 = normalize_phone(user_data['phone'])
+    cursor.execute('''
+    WITH matched AS (SELECT id FROM clients WHERE phone_e164 = ? OR user_id = ?)
+    SELECT
+        (SELECT COUNT(*) FROM bookings WHERE client_id IN matched AND id != ?)
+      + (SELECT COUNT(*) FROM bookings_archive WHERE client_id IN matched)
+    ''', (phone_e164, user_id, booking_id))
+    previous_bookings = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM clients WHERE phone_e164 = ?", (phone_e164,))
+    accounts = cursor.fetchone()[0]
+    payload = {
+        'booking_id': booking_id,
+        'user_id': user_id,
+        'full_name': user_data['full_name'],
+        'phone': user_data['phone'],
+        'filial_id': user_data['filial_id'],
+        'filial_name': user_data['filial_name'],
+        'filial_address': user_data['filial_address'],
+        'created_at': datetime.now().strftime('%H:%M %d.%m.%Y'),
+        'previous_bookings': previous_bookings,
+        'accounts': accounts,
+    }
+    now = time.time()
+    cursor.execute('''
+    INSERT INTO notification_outbox (chat_id, booking_id, filial_id, payload, next_attempt_at, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ''', (
+        str(ADMIN_ID),
+        booking_id,
+        user_data['filial_id'],
+        json.dumps(payload, ensure_ascii=False),
+        now + NOTIFY_DIGEST_WINDOW,
+        now
+    ))
+    if token:
+        cursor.execute(
+            "INSERT INTO booking_confirmations (token, booking_id, created_at) VALUES (?, ?, ?)",
+            (token, booking_id, now)
+        )
+    return booking_id
+
+# ================== ОЧЕРЕДЬ ЗАПИСИ В БД ==================
+class DatabaseWriter:
+    """Единственный поток-писатель с групповой фиксацией.
+
+    submit() ставит операцию в очередь и сразу возвращает Future.
+    Поток-писатель забирает всё, что накопилось (до max_batch), и выполняет
+    операции в одной транзакции: при всплеске записей SQLite делает один
+    COMMIT на пачку, а писатели не толкаются за блокировку. Каждая операция
+    идёт в своём SAVEPOINT, поэтому ошибка одной не откатывает остальные.
+    Future получает результат только после COMMIT. exclusive() выполняет
+    операцию вне транзакции, и пока она идёт, пачки не берутся.
+    """
+
+    def __init__(self, max_batch, linger):
+        self.max_batch = max_batch
+        self.linger = linger
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def submit(self, operation, *args):
+        """Поставить operation(cursor, *args) в очередь на запись"""
+        future = Future()
+        self._queue.put((operation, args, future, False))
+        self._ensure_started()
+        return future
+
+    def exclusive(self, operation, *args):
+        """Выполнить operation(conn, *args) на потоке-писателе вне транзакции (VACUUM)"""
+        future = Future()
+        self._queue.put((operation, args, future, True))
+        self._ensure_started()
+        return future
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """Записать всё, что уже в очереди, и остановить поток"""
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+        with self._lock:
+            self._thread = None
+
+    def _run(self):
+        carried = None
+        while True:
+            item = carried or self._queue.get()
+            carried = None
+            if item is None:
+                return
+            if item[3]:
+                self._run_exclusive(*item[:3])
+                continue
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.max_batch:
+                try:
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        item = self._queue.get(timeout=remaining)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                if item[3]:
+                    # Сначала фиксируем накопленное, потом монопольная операция
+                    carried = item
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch):
+        DB_WRITER_BATCH.observe(len(batch))
+        completed = []
+        try:
+            with db_transaction() as cursor:
+                for operation, args, future, _ in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    cursor.execute("SAVEPOINT write_intent")
+                    try:
+                        result = operation(cursor, *args)
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO write_intent")
+                        cursor.execute("RELEASE write_intent")
+                        future.set_exception(e)
+                    else:
+                        cursor.execute("RELEASE write_intent")
+                        completed.append((future, result))
+        except Exception as e:
+            logger.error(f"❌ Ошибка групповой записи ({len(batch)} операций): {e}")
+            # Транзакция могла не начаться (BEGIN упёрся в busy_timeout):
+            # ошибку получают все операции пачки, а не только выполненные
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            self._reset_connection()
+            return
+        
+        for future, result in completed:
+            future.set_result(result)
+
+    def _run_exclusive(self, operation, args, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = operation(get_db(), *args)
+        except Exception as e:
+            self._reset_connection()
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    @staticmethod
+    def _reset_connection():
+        """Не оставлять соединение потока-писателя внутри транзакции"""
+        conn = getattr(_db_local, 'conn', None)
+        if conn is None or not conn.in_transaction:
+            return
+        try:
+            conn.rollback()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Не удалось откатить транзакцию писателя, переподключаюсь: {e}")
+            with _db_connections_lock:
+                if conn in _db_connections:
+                    _db_connections.remove(conn)
+            _db_local.__dict__.pop('conn', None)
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+db_writer = DatabaseWriter(DB_WRITER_MAX_BATCH, DB_WRITER_LINGER_MS / 1000)
+metrics.gauge("bot_db_writer_queue_depth", "Операции, ждущие потока-писателя", lambda: db_writer.pending)
+
+# ================== МИГРАЦИИ ==================
+def _migration_initial_schema(cursor):
+    """Создание таблиц и начальных данных"""
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS filials (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -163,16 +1703,1497 @@ def init_db():
                 "INSERT INTO filials (name, address, phone) VALUES (?, ?, ?)",
                 (name, address, phone)
             )
-    
-    conn.commit()
-    conn.close()
-    logger.info("✅ База данных инициализирована")
-    print("✅ База данных инициализирована")
 
-# Словарь для хранения состояний пользователей
-user_states = {}
+def _migration_filials_version(cursor):
+    """Версия данных филиалов для кэша каталога"""
+    # Триггеры увеличивают версию при любом изменении таблицы,
+    # по ней кэш каталога понимает, что пора перечитать филиалы
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('filials', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS filials_version_{event.lower()}
+        AFTER {event} ON filials
+        BEGIN
+            UPDATE data_versions SET version = version + 1 WHERE name = 'filials';
+        END
+        ''')
 
-# ================== КЛАВИАТУРЫ ==================
+def _migration_conversation_states(cursor):
+    """Таблица для сохранения незавершённых записей между перезапусками"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS conversation_states (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    ''')
+
+def _migration_client_identity_indexes(cursor):
+    """Один клиент на user_id и индексы для "Мои записи" и админских выборок"""
+    # INSERT OR REPLACE без уникального ключа плодил клиентов: оставляем
+    # последнюю запись каждого пользователя и переносим на неё брони
+    cursor.execute('''
+    CREATE TEMP TABLE client_merge AS
+    SELECT c.id AS old_id, k.keep_id AS new_id
+    FROM clients c
+    JOIN (SELECT user_id, MAX(id) AS keep_id FROM clients
+          WHERE user_id IS NOT NULL GROUP BY user_id) k ON c.user_id = k.user_id
+    WHERE c.id <> k.keep_id
+    ''')
+    cursor.execute('''
+    UPDATE bookings
+    SET client_id = (SELECT new_id FROM client_merge WHERE old_id = bookings.client_id)
+    WHERE client_id IN (SELECT old_id FROM client_merge)
+    ''')
+    cursor.execute("DELETE FROM clients WHERE id IN (SELECT old_id FROM client_merge)")
+    cursor.execute("DROP TABLE client_merge")
+    
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_user_id ON clients (user_id)")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_bookings_client_created ON bookings (client_id, created_at)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_bookings_filial_status_created "
+        "ON bookings (filial_id, status, created_at)"
+    )
+
+def _stats_bump(key_expr, delta):
+    """SQL триггера: прибавить delta к счётчику key_expr"""
+    return (
+        f"INSERT INTO stats (key, value) VALUES ({key_expr}, {delta}) "
+        f"ON CONFLICT (key) DO UPDATE SET value = value + {delta};"
+    )
+
+def _stats_booking_keys(row, delta):
+    """SQL триггера: все счётчики одной записи (row — NEW или OLD)"""
+    return " ".join([
+        _stats_bump("'bookings'", delta),
+        _stats_bump(f"'status:' || {row}.status", delta),
+        _stats_bump(f"'filial:' || {row}.filial_id", delta),
+        # created_at в UTC, день — по местному времени процесса, как в /status
+        _stats_bump(f"'day:' || date({row}.created_at, 'localtime')", delta),
+    ])
+
+def _migration_stats_counters(cursor):
+    """Счётчики записей и клиентов, которые поддерживают триггеры"""
+    # Ключи: bookings, clients, status:<статус>, filial:<id>, day:<YYYY-MM-DD> (местная дата)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stats (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    ''')
+    
+    bump, booking_keys = _stats_bump, _stats_booking_keys
+    
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_bookings_insert AFTER INSERT ON bookings
+    BEGIN {booking_keys("NEW", 1)} END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_bookings_delete AFTER DELETE ON bookings
+    BEGIN {booking_keys("OLD", -1)} END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_bookings_update
+    AFTER UPDATE OF status, filial_id, created_at ON bookings
+    BEGIN {booking_keys("OLD", -1)} {booking_keys("NEW", 1)} END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_clients_insert AFTER INSERT ON clients
+    BEGIN {bump("'clients'", 1)} END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_clients_delete AFTER DELETE ON clients
+    BEGIN {bump("'clients'", -1)} END
+    ''')
+    
+    # Разовый подсчёт по уже накопленным данным
+    cursor.execute("DELETE FROM stats")
+    cursor.execute("INSERT INTO stats (key, value) SELECT 'bookings', COUNT(*) FROM bookings")
+    cursor.execute("INSERT INTO stats (key, value) SELECT 'clients', COUNT(*) FROM clients")
+    cursor.execute(
+        "INSERT INTO stats (key, value) "
+        "SELECT 'status:' || status, COUNT(*) FROM bookings GROUP BY status"
+    )
+    cursor.execute(
+        "INSERT INTO stats (key, value) "
+        "SELECT 'filial:' || filial_id, COUNT(*) FROM bookings GROUP BY filial_id"
+    )
+    cursor.execute(
+        "INSERT INTO stats (key, value) "
+        "SELECT 'day:' || date(created_at, 'localtime'), COUNT(*) FROM bookings "
+        "GROUP BY date(created_at, 'localtime')"
+    )
+
+def _migration_bot_meta(cursor):
+    """Служебные значения (последний принятый update_id и т.п.)"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS bot_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    ''')
+
+def _migration_notification_outbox(cursor):
+    """Outbox для уведомлений администратору о новых записях"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS notification_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT NOT NULL,
+        booking_id INTEGER,
+        filial_id INTEGER,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        created_at REAL NOT NULL,
+        sent_at REAL,
+        last_error TEXT
+    )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON notification_outbox (status, next_attempt_at)"
+    )
+
+def _migration_shared_state(cursor):
+    """Общее состояние процессов: аренды шардов и очереди пересылки"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS shared_state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        expires_at REAL
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS shared_inbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        queue TEXT NOT NULL,
+        payload TEXT NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_shared_inbox_queue ON shared_inbox (queue, id)")
+
+def _migration_broadcasts(cursor):
+    """Рассылки клиентам и статус доставки каждому получателю"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'draft',
+        created_by TEXT,
+        created_at REAL NOT NULL,
+        last_client_id INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        report_chat_id TEXT,
+        report_message_id INTEGER,
+        started_at REAL,
+        finished_at REAL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        sent_at REAL,
+        PRIMARY KEY (broadcast_id, chat_id)
+    ) WITHOUT ROWID
+    ''')
+    # Частичный индекс: в нём только ещё не обработанные получатели
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending
+    ON broadcast_recipients (broadcast_id, chat_id) WHERE status = 'pending'
+    ''')
+
+def _migration_client_search(cursor):
+    """Телефон в E.164 и полнотекстовый индекс по ФИО"""
+    cursor.execute("ALTER TABLE clients ADD COLUMN phone_e164 TEXT")
+    rows = cursor.execute("SELECT id, phone FROM clients").fetchall()
+    cursor.executemany(
+        "UPDATE clients SET phone_e164 = ? WHERE id = ?",
+        [(normalize_phone(phone), client_id) for client_id, phone in rows]
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_clients_phone_e164 ON clients (phone_e164)")
+    
+    # Таблица хранит свою копию ФИО: «ё» приводится к «е» при записи,
+    # токенизатор unicode61 сам этого не делает. rowid = clients.id
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS clients_fts USING fts5(
+        full_name,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    ''')
+    fold = "replace(replace({}, 'ё', 'е'), 'Ё', 'Е')"
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS clients_fts_insert AFTER INSERT ON clients
+    BEGIN
+        INSERT INTO clients_fts (rowid, full_name) VALUES (new.id, {fold.format('new.full_name')});
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS clients_fts_update AFTER UPDATE OF full_name ON clients
+    BEGIN
+        UPDATE clients_fts SET full_name = {fold.format('new.full_name')} WHERE rowid = new.id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS clients_fts_delete AFTER DELETE ON clients
+    BEGIN
+        DELETE FROM clients_fts WHERE rowid = old.id;
+    END
+    ''')
+    cursor.execute(
+        f"INSERT INTO clients_fts (rowid, full_name) SELECT id, {fold.format('full_name')} FROM clients"
+    )
+
+def _migration_bookings_archive(cursor):
+    """Архив старых записей и представление bookings_all"""
+    # id переносятся как есть: AUTOINCREMENT в bookings не выдаёт их повторно
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS bookings_archive (
+        id INTEGER PRIMARY KEY,
+        client_id INTEGER,
+        filial_id INTEGER,
+        service_type TEXT,
+        notes TEXT,
+        status TEXT,
+        created_at TIMESTAMP,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_bookings_archive_client_created "
+        "ON bookings_archive (client_id, created_at)"
+    )
+    # Отбор кандидатов на перенос идёт по дате
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_created ON bookings (created_at)")
+    
+    # Счётчики /status считают обе таблицы: перенос (-1 в bookings, +1 здесь) их не меняет
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_bookings_archive_insert AFTER INSERT ON bookings_archive
+    BEGIN {_stats_booking_keys("NEW", 1)} END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_bookings_archive_delete AFTER DELETE ON bookings_archive
+    BEGIN {_stats_booking_keys("OLD", -1)} END
+    ''')
+    
+    cursor.execute('''
+    CREATE VIEW IF NOT EXISTS bookings_all AS
+    SELECT id, client_id, filial_id, service_type, notes, status, created_at, 0 AS archived
+    FROM bookings
+    UNION ALL
+    SELECT id, client_id, filial_id, service_type, notes, status, created_at, 1 AS archived
+    FROM bookings_archive
+    ''')
+
+def _migration_booking_confirmations(cursor):
+    """Какая запись создана по какому подтверждению (повторное нажатие «Да»)"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS booking_confirmations (
+        token TEXT PRIMARY KEY,
+        booking_id INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''')
+
+def _migration_stats_local_day(cursor):
+    """Счётчики day:* по местной дате вместо даты UTC"""
+    for name, table, event, row, delta in (
+        ("stats_bookings_insert", "bookings", "INSERT", "NEW", 1),
+        ("stats_bookings_delete", "bookings", "DELETE", "OLD", -1),
+        ("stats_bookings_archive_insert", "bookings_archive", "INSERT", "NEW", 1),
+        ("stats_bookings_archive_delete", "bookings_archive", "DELETE", "OLD", -1),
+    ):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f'''
+        CREATE TRIGGER {name} AFTER {event} ON {table}
+        BEGIN {_stats_booking_keys(row, delta)} END
+        ''')
+    cursor.execute("DROP TRIGGER IF EXISTS stats_bookings_update")
+    cursor.execute(f'''
+    CREATE TRIGGER stats_bookings_update
+    AFTER UPDATE OF status, filial_id, created_at ON bookings
+    BEGIN {_stats_booking_keys("OLD", -1)} {_stats_booking_keys("NEW", 1)} END
+    ''')
+    
+    cursor.execute("DELETE FROM stats WHERE key >= 'day:' AND key < 'day;'")
+    cursor.execute(
+        "INSERT INTO stats (key, value) "
+        "SELECT 'day:' || date(created_at, 'localtime'), COUNT(*) FROM bookings_all "
+        "GROUP BY date(created_at, 'localtime')"
+    )
+
+# Миграции применяются по порядку; номер записывается в PRAGMA user_version.
+# Новые миграции добавляются только в конец списка.
+MIGRATIONS = [
+    (1, "базовая схема", _migration_initial_schema),
+    (2, "версия данных филиалов", _migration_filials_version),
+    (3, "сохранённые состояния диалогов", _migration_conversation_states),
+    (4, "уникальный клиент и индексы записей", _migration_client_identity_indexes),
+    (5, "счётчики для /status", _migration_stats_counters),
+    (6, "служебные значения бота", _migration_bot_meta),
+    (7, "очередь уведомлений администратора", _migration_notification_outbox),
+    (8, "общее состояние процессов", _migration_shared_state),
+    (9, "рассылки клиентам", _migration_broadcasts),
+    (10, "поиск клиентов по телефону и ФИО", _migration_client_search),
+    (11, "архив записей", _migration_bookings_archive),
+    (12, "подтверждения записей", _migration_booking_confirmations),
+    (13, "счётчики дней по местной дате", _migration_stats_local_day),
+]
+
+# ================== КЭШ ФИЛИАЛОВ ==================
+FilialSnapshot = namedtuple('FilialSnapshot', ['keyboard', 'text', 'by_id'])
+
+class FilialCatalog:
+    """Кэш активных филиалов.
+
+    Держит готовую клавиатуру выбора (уже сериализованную в JSON), текст
+    "НАШИ ФИЛИАЛЫ" и словарь id → (name, address). Таблица перечитывается
+    только после invalidate() или когда сменилась версия в data_versions;
+    версия проверяется не чаще раза в check_interval секунд.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self):
+        """Текущий снимок каталога"""
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return snapshot
+        
+        with self._lock:
+            now = time.monotonic()
+            if self._snapshot is not None:
+                if now - self._checked_at < self.check_interval:
+                    return self._snapshot
+                if self._current_version() == self._version:
+                    self._checked_at = now
+                    return self._snapshot
+            
+            self._version = self._current_version()
+            self._snapshot = self._build()
+            self._checked_at = now
+            logger.info(f"✅ Каталог филиалов загружен: {len(self._snapshot.by_id)} шт.")
+            return self._snapshot
+
+    def get_filial(self, filial_id):
+        """(name, address) филиала; неактивные филиалы читаются из БД"""
+        filial = self.get().by_id.get(filial_id)
+        if filial is None:
+            filial = db_fetchone("SELECT name, address FROM filials WHERE id = ?", (filial_id,))
+        return filial
+
+    def invalidate(self):
+        """Сбросить кэш: следующий get() перечитает таблицу"""
+        with self._lock:
+            self._snapshot = None
+            self._version = None
+
+    def _current_version(self):
+        row = db_fetchone("SELECT version FROM data_versions WHERE name = 'filials'")
+        return row[0] if row else None
+
+    def _build(self):
+        filials = db_fetchall("SELECT id, name, address, phone FROM filials WHERE is_active = 1")
+        
+        markup = types.InlineKeyboardMarkup()
+        for filial_id, name, _, _ in filials:
+            markup.add(types.InlineKeyboardButton(name, callback_data=f"filial_{filial_id}"))
+        markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
+        
+        lines = ["🏢 НАШИ ФИЛИАЛЫ:\n\n"]
+        for _, name, address, phone in filials:
+            lines.append(f"{name}\n")
+            lines.append(f"📍 Адрес: {address}\n")
+            lines.append(f"📞 Телефон: {phone}\n")
+            lines.append("──────────────\n")
+        
+        return FilialSnapshot(
+            keyboard=markup.to_json(),
+            text="".join(lines),
+            by_id={filial_id: (name, address) for filial_id, name, address, _ in filials}
+        )
+
+filial_catalog = FilialCatalog(FILIAL_CATALOG_CHECK_SECONDS)
+
+# ================== СЧЁТЧИКИ ДЛЯ /status ==================
+class StatsCache:
+    """Снимок таблицы stats, который живёт ttl секунд.
+
+    Таблицу поддерживают триггеры (см. _migration_stats_counters), поэтому
+    её размер не зависит от числа записей, а /status не делает COUNT(*).
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._loaded_at = 0.0
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return snapshot
+        
+        with self._lock:
+            if self._snapshot is None or time.monotonic() - self._loaded_at >= self.ttl:
+                self._snapshot = self._load()
+                self._loaded_at = time.monotonic()
+            return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    @staticmethod
+    def _load():
+        # Ключи дней — местные даты (триггеры переводят created_at из UTC)
+        today = "day:" + datetime.now().strftime("%Y-%m-%d")
+        counters = {
+            "bookings": 0,
+            "clients": 0,
+            "bookings_today": 0,
+            "by_status": {},
+            "by_filial": {},
+        }
+        rows = db_fetchall(
+            "SELECT key, value FROM stats WHERE key < 'day:' OR key > 'day;' OR key = ?", (today,)
+        )
+        for key, value in rows:
+            kind, _, name = key.partition(":")
+            if kind == "status":
+                counters["by_status"][name] = value
+            elif kind == "filial":
+                filial = filial_catalog.get().by_id.get(int(name)) if name.isdigit() else None
+                counters["by_filial"][filial[0] if filial else name] = value
+            elif kind == "day":
+                counters["bookings_today"] = value
+            else:
+                counters[kind] = value
+        return counters
+
+stats_cache = StatsCache(STATUS_CACHE_SECONDS)
+
+# ================== СТРАНИЦЫ «МОИ ЗАПИСИ» ==================
+class BookingPagesCache:
+    """Отрисованные страницы «Мои записи» по пользователям.
+
+    Ключ страницы — курсор из callback. Записи клиента меняются при новой
+    записи, после неё кэш пользователя сбрасывается (invalidate); ttl
+    страхует от правок в обход бота. Хранятся не больше max_users
+    пользователей, давно не заходившие вытесняются.
+    """
+
+    def __init__(self, ttl, max_users):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()  # user_id -> (время заполнения, {курсор: страница})
+
+    def get(self, user_id, cursor):
+        with self._lock:
+            entry = self._pages.get(user_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.ttl:
+                del self._pages[user_id]
+                return None
+            self._pages.move_to_end(user_id)
+            return entry[1].get(cursor)
+
+    def put(self, user_id, cursor, page):
+        with self._lock:
+            entry = self._pages.get(user_id)
+            if entry is None:
+                entry = self._pages[user_id] = (time.monotonic(), {})
+                while len(self._pages) > self.max_users:
+                    self._pages.popitem(last=False)
+            entry[1][cursor] = page
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._pages.pop(user_id, None)
+
+booking_pages = BookingPagesCache(BOOKINGS_CACHE_SECONDS, BOOKINGS_CACHE_USERS)
+
+# Место под created_at в callback_data (лимит 64 байта вместе с префиксом и id)
+BOOKING_CURSOR_MAX_STAMP = 32
+
+def encode_booking_cursor(created_at, booking_id):
+    """Курсор (created_at, id) для callback_data: '2024-05-01 10:00:00' → '20240501100000_42'.
+
+    created_at в другом виде (доли секунды, часовой пояс) кладётся как есть,
+    чтобы позиция не сдвинулась; слишком длинный — пустой курсор (первая страница).
+    """
+    if re.fullmatch(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d", created_at):
+        stamp = re.sub(r"\D", "", created_at)
+    elif (len(created_at.encode()) <= BOOKING_CURSOR_MAX_STAMP
+          and "_" not in created_at and not created_at.isdigit()):
+        stamp = created_at
+    else:
+        return ""
+    return f"{stamp}_{booking_id}"
+
+def decode_booking_cursor(token):
+    """(created_at, id) из курсора или None, если курсор не разобрать"""
+    stamp, _, booking_id = token.rpartition("_")
+    if not stamp or not booking_id.isdigit():
+        return None
+    if len(stamp) == 14 and stamp.isdigit():
+        stamp = f"{stamp[:4]}-{stamp[4:6]}-{stamp[6:8]} {stamp[8:10]}:{stamp[10:12]}:{stamp[12:]}"
+    elif len(stamp.encode()) > BOOKING_CURSOR_MAX_STAMP or not stamp[:4].isdigit():
+        return None
+    return stamp, int(booking_id)
+
+def fetch_bookings_page(client_id, direction=None, cursor=None):
+    """Страница записей клиента от новых к старым и флаг «есть ещё».
+
+    direction='older' — записи старше курсора, 'newer' — новее; без курсора
+    первая страница. История включает bookings_archive: из каждой таблицы
+    берётся не больше страницы по её индексу (client_id, created_at), затем
+    части сливаются. Сравнение (created_at, id) идёт без OFFSET.
+    """
+    limit = BOOKINGS_PAGE_SIZE + 1
+    if cursor is None:
+        condition, bounds, order = "", (), "DESC"
+    elif direction == 'older':
+        condition, bounds, order = "AND (b.created_at, b.id) < (?, ?)", cursor, "DESC"
+    else:
+        condition, bounds, order = "AND (b.created_at, b.id) > (?, ?)", cursor, "ASC"
+    
+    def part(table):
+        return f'''
+        SELECT b.id, f.name, b.service_type, b.created_at, b.status
+        FROM {table} b
+        JOIN filials f ON b.filial_id = f.id
+        WHERE b.client_id = ? {condition}
+        ORDER BY b.created_at {order}, b.id {order}
+        LIMIT ?
+        '''
+    
+    rows = db_fetchall(f'''
+    SELECT * FROM ({part("bookings")})
+    UNION ALL
+    SELECT * FROM ({part("bookings_archive")})
+    ORDER BY created_at {order}, id {order}
+    LIMIT ?
+    ''', (client_id, *bounds, limit) * 2 + (limit,))
+    
+    if direction == 'newer' and cursor is not None:
+        rows.reverse()
+        # Лишняя строка при движении к новым оказывается первой
+        return rows[-BOOKINGS_PAGE_SIZE:], len(rows) > BOOKINGS_PAGE_SIZE
+    return rows[:BOOKINGS_PAGE_SIZE], len(rows) > BOOKINGS_PAGE_SIZE
+
+def render_bookings_page(bookings, has_newer, has_older):
+    """Текст страницы и клавиатура навигации (JSON)"""
+    lines = ["📋 ВАШИ ЗАПИСИ:\n\n"]
+    for booking_id, filial_name, service, created_at, status in bookings:
+        status_icon = "✅" if status == "confirmed" else "🔄" if status == "new" else "❌"
+        lines.append(
+            f"{status_icon} Запись #{booking_id}\n"
+            f"🏢 Филиал: {filial_name}\n"
+            f"🎭 Услуга: {service}\n"
+            f"📅 Дата: {created_at[:10]}\n"
+            f"📊 Статус: {status}\n"
+            "──────────────\n"
+        )
+    
+    buttons = []
+    if has_newer:
+        first = bookings[0]
+        buttons.append(types.InlineKeyboardButton(
+            "⬅️ Новее", callback_data=f"bookings_newer_{encode_booking_cursor(first[3], first[0])}"
+        ))
+    if has_older:
+        last = bookings[-1]
+        buttons.append(types.InlineKeyboardButton(
+            "Старее ➡️", callback_data=f"bookings_older_{encode_booking_cursor(last[3], last[0])}"
+        ))
+    markup = None
+    if buttons:
+        markup = types.InlineKeyboardMarkup()
+        markup.row(*buttons)
+        markup = markup.to_json()
+    return "".join(lines), markup
+
+# ================== ВЫГРУЗКА ДАННЫХ ==================
+# Таблица -> (колонки, SELECT, условия фильтров, порядок или None)
+EXPORT_TABLES = {
+    'bookings': (
+        ('id', 'created_at', 'status', 'filial_id', 'filial', 'client_id',
+         'full_name', 'phone', 'user_id', 'service_type', 'notes', 'archived'),
+        '''
+        SELECT b.id, b.created_at, b.status, b.filial_id, f.name, b.client_id,
+               c.full_name, c.phone, c.user_id, b.service_type, b.notes, b.archived
+        FROM bookings_all b
+        LEFT JOIN filials f ON b.filial_id = f.id
+        LEFT JOIN clients c ON b.client_id = c.id
+        ''',
+        {
+            'filial': "b.filial_id = ?",
+            'status': "b.status = ?",
+            'date_from': "b.created_at >= ?",
+            'date_to': "b.created_at < ?",
+        },
+        # Без ORDER BY обе части bookings_all читаются по своим индексам
+        # без сортировки всей выгрузки во временном B-дереве
+        None
+    ),
+    'clients': (
+        ('id', 'user_id', 'full_name', 'phone', 'phone_e164', 'email', 'created_at'),
+        "SELECT c.id, c.user_id, c.full_name, c.phone, c.phone_e164, c.email, c.created_at FROM clients c",
+        {
+            'filial': "EXISTS (SELECT 1 FROM bookings_all b WHERE b.client_id = c.id AND b.filial_id = ?)",
+            'status': "EXISTS (SELECT 1 FROM bookings_all b WHERE b.client_id = c.id AND b.status = ?)",
+            'date_from': "c.created_at >= ?",
+            'date_to': "c.created_at < ?",
+        },
+        "c.id"
+    ),
+    'filials': (
+        ('id', 'name', 'address', 'phone', 'is_active'),
+        "SELECT f.id, f.name, f.address, f.phone, f.is_active FROM filials f",
+        {'filial': "f.id = ?"},
+        "f.id"
+    ),
+}
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+def parse_export_filters(pairs):
+    """Фильтры из пар (ключ, значение): filial, status, from, to (даты ГГГГ-ММ-ДД, включительно)"""
+    filters = {}
+    for key, value in pairs:
+        if not value:
+            continue
+        if key == 'filial':
+            if not value.isdigit():
+                raise ValueError(f"filial должен быть числом: {value!r}")
+            filters['filial'] = int(value)
+        elif key == 'status':
+            filters['status'] = value
+        elif key in ('from', 'to'):
+            try:
+                day = datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f"дата {key} должна быть в формате ГГГГ-ММ-ДД: {value!r}")
+            if key == 'from':
+                filters['date_from'] = day.strftime('%Y-%m-%d')
+            else:
+                # Верхняя граница включительно: всё, что раньше следующего дня
+                filters['date_to'] = (day + timedelta(days=1)).strftime('%Y-%m-%d')
+        else:
+            raise ValueError(f"неизвестный фильтр: {key!r}")
+    return filters
+
+def export_filename(table, fmt):
+    return f"{table}_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}"
+
+def export_stream(table, fmt, filters):
+    """Генератор байтов выгрузки.
+
+    Таблица, формат и фильтры проверяются сразу (ValueError), до первого
+    байта ответа; чтение из БД начинается, когда генератор начнут читать.
+    """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"неизвестная таблица: {table!r}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"неизвестный формат: {fmt!r}")
+    
+    columns, query, conditions, order = EXPORT_TABLES[table]
+    unsupported = set(filters) - set(conditions)
+    if unsupported:
+        raise ValueError(f"фильтры {sorted(unsupported)} не поддерживаются для {table}")
+    
+    where = [conditions[key] for key in filters]
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    if order:
+        query += f" ORDER BY {order}"
+    
+    chunks = iter_export_chunks(query, tuple(filters.values()))
+    if fmt == 'csv':
+        return render_export_csv(columns, chunks)
+    return render_export_jsonl(columns, chunks)
+
+def iter_export_chunks(query, params):
+    """Строки запроса порциями по EXPORT_CHUNK_SIZE.
+
+    Курсор открыт на отдельном соединении до конца выгрузки и читается
+    через fetchmany, так что в памяти только текущая порция. В режиме WAL
+    выгрузка видит снимок на момент первого чтения и не мешает записи.
+    """
+    conn = _connect_db()
+    try:
+        conn.execute("PRAGMA query_only=ON")
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        # Срабатывает и при обрыве соединения клиентом (generator.close())
+        conn.close()
+
+def render_export_csv(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    # BOM — чтобы Excel открыл кириллицу в UTF-8
+    yield ("\ufeff" + buffer.getvalue()).encode('utf-8')
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+def render_export_jsonl(columns, chunks):
+    for rows in chunks:
+        yield "".join(
+            json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows
+        ).encode('utf-8')
+
+# ================== ПОИСК КЛИЕНТОВ ==================
+def normalize_phone(raw):
+    """Телефон в формате E.164 ('+79161234567') или None, если номер не распознан.
+
+    Российские номера принимаются в видах 8XXXXXXXXXX, 7XXXXXXXXXX и
+    9XXXXXXXXX (без кода страны); с '+' — любой код страны.
+    """
+    if not raw:
+        return None
+    digits = re.sub(r"\D", "", raw)
+    if raw.strip().startswith("+"):
+        return f"+{digits}" if 8 <= len(digits) <= 15 and digits[0] != "0" else None
+    if len(digits) == 11 and digits[0] in "78":
+        return f"+7{digits[1:]}"
+    if len(digits) == 10 and digits[0] == "9":
+        return f"+7{digits}"
+    return None
+
+def phone_search_prefix(query):
+    """Начало номера в E.164 для поиска по части телефона: '8916' → '+7916'"""
+    digits = re.sub(r"\D", "", query)
+    if not query.strip().startswith("+"):
+        if digits.startswith("8"):
+            digits = "7" + digits[1:]
+        elif digits.startswith("9"):
+            digits = "7" + digits
+    return f"+{digits}"
+
+def find_clients(query, limit=20):
+    """Клиенты по части телефона или по началу слов ФИО.
+
+    Телефон ищется диапазоном по индексу idx_clients_phone_e164, ФИО —
+    префиксным запросом FTS5 (каждое слово запроса — начало слова в ФИО).
+    Строки: id, ФИО, телефон, user_id, число записей, дата последней.
+    """
+    # Обе таблицы по отдельности: через bookings_all коррелированный
+    # подзапрос не попадает в индексы по client_id
+    stats = '''
+    (SELECT COUNT(*) FROM bookings b WHERE b.client_id = c.id)
+      + (SELECT COUNT(*) FROM bookings_archive a WHERE a.client_id = c.id),
+    NULLIF(MAX(
+        COALESCE((SELECT MAX(b.created_at) FROM bookings b WHERE b.client_id = c.id), ''),
+        COALESCE((SELECT MAX(a.created_at) FROM bookings_archive a WHERE a.client_id = c.id), '')
+    ), '')
+    '''
+    if not re.search(r"[^\W\d_]", query):
+        prefix = phone_search_prefix(query)
+        if len(prefix) < 4:
+            raise ValueError("укажите хотя бы 3 цифры телефона")
+        # ':' идёт в ASCII сразу после '9' — верхняя граница диапазона префикса
+        return db_fetchall(f'''
+        SELECT c.id, c.full_name, COALESCE(c.phone_e164, c.phone), c.user_id, {stats}
+        FROM clients c
+        WHERE c.phone_e164 >= ? AND c.phone_e164 < ?
+        ORDER BY c.phone_e164
+        LIMIT ?
+        ''', (prefix, prefix + ":", limit))
+    
+    words = re.findall(r"\w+", query.lower().replace("ё", "е"))
+    match = " AND ".join(f'"{word}"*' for word in words)
+    return db_fetchall(f'''
+    SELECT c.id, c.full_name, COALESCE(c.phone_e164, c.phone), c.user_id, {stats}
+    FROM clients_fts
+    JOIN clients c ON c.id = clients_fts.rowid
+    WHERE clients_fts MATCH ?
+    ORDER BY clients_fts.rank
+    LIMIT ?
+    ''', (match, limit))
+
+# ================== СОСТОЯНИЯ ПОЛЬЗОВАТЕЛЕЙ ==================
+class SqliteStateBackend:
+    """Хранение состояний диалогов в таблице conversation_states"""
+
+    def load(self, now):
+        rows = db_fetchall(
+            "SELECT user_id, data, expires_at FROM conversation_states WHERE expires_at > ?",
+            (now,)
+        )
+        return [(user_id, json.loads(data), expires_at) for user_id, data, expires_at in rows]
+
+    def save(self, items):
+        with db_transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO conversation_states (user_id, data, expires_at) VALUES (?, ?, ?)",
+                [(user_id, json.dumps(state, ensure_ascii=False), expires_at)
+                 for user_id, state, expires_at in items]
+            )
+
+    def delete(self, user_ids, now):
+        with db_transaction() as cursor:
+            cursor.executemany(
+                "DELETE FROM conversation_states WHERE user_id = ?",
+                [(user_id,) for user_id in user_ids]
+            )
+            cursor.execute("DELETE FROM conversation_states WHERE expires_at <= ?", (now,))
+
+class StateStore:
+    """Состояния пользователей в памяти с TTL и ограничением размера.
+
+    Чтение всегда идёт из памяти. Запись продлевает TTL записи; при
+    превышении max_size вытесняются давно не использованные пользователи.
+    Если задан backend, изменения сбрасываются в него фоновым потоком
+    (write-behind), а при старте load() восстанавливает незавершённые записи.
+
+    get() возвращает копию: изменять состояние нужно через set()/update(),
+    иначе изменение не попадёт в backend.
+    """
+
+    def __init__(self, ttl, max_size, backend=None, flush_interval=2.0):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # user_id -> (state, expires_at)
+        self._dirty = set()
+        self._deleted = set()
+        self._flusher = None
+        self._wakeup = threading.Event()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, user_id):
+        return self._get_entry(user_id) is not None
+
+    def get(self, user_id, default=None):
+        entry = self._get_entry(user_id)
+        return dict(entry[0]) if entry is not None else default
+
+    def set(self, user_id, state):
+        with self._lock:
+            self._data[user_id] = (dict(state), time.time() + self.ttl)
+            self._data.move_to_end(user_id)
+            self._mark_dirty(user_id)
+            while len(self._data) > self.max_size:
+                evicted, _ = self._data.popitem(last=False)
+                self._mark_deleted(evicted)
+
+    def update(self, user_id, **fields):
+        """Дополнить состояние пользователя (создаёт его при отсутствии)"""
+        state = self.get(user_id, {})
+        state.update(fields)
+        self.set(user_id, state)
+
+    def pop(self, user_id, default=None):
+        with self._lock:
+            entry = self._data.pop(user_id, None)
+            if entry is None:
+                return default
+            self._mark_deleted(user_id)
+            return entry[0]
+
+    def load(self, owns=None):
+        """Восстановить сохранённые состояния из backend (только своих чатов, если задан owns)"""
+        if self.backend is None:
+            return 0
+        items = self.backend.load(time.time())
+        if owns is not None:
+            items = [item for item in items if owns(item[0])]
+        with self._lock:
+            for user_id, state, expires_at in sorted(items, key=lambda item: item[2]):
+                self._data[user_id] = (state, expires_at)
+        return len(items)
+
+    def flush(self):
+        """Записать накопленные изменения в backend"""
+        if self.backend is None:
+            return
+        
+        with self._lock:
+            dirty = [(user_id, *self._data[user_id]) for user_id in self._dirty if user_id in self._data]
+            deleted = list(self._deleted)
+            self._dirty.clear()
+            self._deleted.clear()
+        
+        try:
+            if dirty:
+                self.backend.save(dirty)
+            if deleted:
+                self.backend.delete(deleted, time.time())
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения состояний: {e}")
+            with self._lock:
+                # Вернём изменения, чтобы повторить при следующем сбросе
+                self._dirty.update(user_id for user_id, _, _ in dirty if user_id in self._data)
+                self._deleted.update(user_id for user_id in deleted if user_id not in self._data)
+
+    def sweep(self):
+        """Удалить записи с истёкшим TTL"""
+        now = time.time()
+        with self._lock:
+            expired = [user_id for user_id, (_, expires_at) in self._data.items() if expires_at <= now]
+            for user_id in expired:
+                del self._data[user_id]
+                self._mark_deleted(user_id)
+        return len(expired)
+
+    def _get_entry(self, user_id):
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._data[user_id]
+                self._mark_deleted(user_id)
+                return None
+            self._data.move_to_end(user_id)
+            return entry
+
+    def _mark_dirty(self, user_id):
+        self._deleted.discard(user_id)
+        self._dirty.add(user_id)
+        self._ensure_flusher()
+
+    def _mark_deleted(self, user_id):
+        self._dirty.discard(user_id)
+        if self.backend is not None:
+            self._deleted.add(user_id)
+            self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self.backend is None or self._flusher is not None:
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, name="state-flusher", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        last_sweep = time.monotonic()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if time.monotonic() - last_sweep >= 60:
+                self.sweep()
+                last_sweep = time.monotonic()
+            self.flush()
+
+# ================== ОБЩЕЕ СОСТОЯНИЕ ПРОЦЕССОВ ==================
+# Несколько воркеров (или инстансов) обслуживают один бот так: каждый чат
+# закреплён за шардом chat_id % CHAT_SHARDS, шард арендует ровно один
+# процесс. Обновление, пришедшее не своему процессу, пересылается в очередь
+# владельца. Поэтому шаги записи одного чата идут по порядку в одном
+# процессе, и его кэш состояний, дедупликация и лимит чата остаются верными.
+class SharedState(ABC):
+    """Интерфейс хранилища, общего для всех процессов бота.
+
+    Ключи с TTL (аренды), очереди пересылки и backend состояний диалогов.
+    SqliteSharedState — для процессов на одном хосте, RedisSharedState —
+    для нескольких инстансов. Backend без какого-либо метода не создастся.
+    """
+
+    @abstractmethod
+    def add(self, key, value, ttl):
+        """Записать значение, если ключа нет или его TTL истёк; True при успехе"""
+
+    @abstractmethod
+    def renew(self, key, value, ttl):
+        """Продлить ключ, если он всё ещё содержит value"""
+
+    @abstractmethod
+    def get(self, key):
+        """Значение ключа или None, если ключа нет или его TTL истёк"""
+
+    @abstractmethod
+    def delete(self, key, value=None):
+        """Удалить ключ (только если он содержит value, когда value задан)"""
+
+    @abstractmethod
+    def push(self, queue_name, payload):
+        """Добавить сообщение в конец очереди"""
+
+    @abstractmethod
+    def pop(self, queue_name, limit, timeout):
+        """Забрать до limit сообщений, ожидая первое не дольше timeout секунд"""
+
+    @abstractmethod
+    def state_backend(self):
+        """Backend для StateStore"""
+
+class SqliteSharedState(SharedState):
+    """Общее состояние в файле SQLite (WAL позволяет нескольким процессам)"""
+
+    POLL_INTERVAL = 0.02
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        with db_transaction() as cursor:
+            cursor.execute('''
+            INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            WHERE shared_state.expires_at IS NOT NULL AND shared_state.expires_at <= ?
+            ''', (key, value, now + ttl, now))
+            return cursor.rowcount == 1
+
+    def renew(self, key, value, ttl):
+        with db_transaction() as cursor:
+            cursor.execute(
+                "UPDATE shared_state SET expires_at = ? WHERE key = ? AND value = ?",
+                (time.time() + ttl, key, value)
+            )
+            return cursor.rowcount == 1
+
+    def get(self, key):
+        row = db_fetchone(
+            "SELECT value FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())
+        )
+        return row[0] if row else None
+
+    def delete(self, key, value=None):
+        with db_transaction() as cursor:
+            if value is None:
+                cursor.execute("DELETE FROM shared_state WHERE key = ?", (key,))
+            else:
+                cursor.execute("DELETE FROM shared_state WHERE key = ? AND value = ?", (key, value))
+
+    def push(self, queue_name, payload):
+        # Через поток-писатель: под нагрузкой пересылки коммитятся пачками
+        db_writer.submit(
+            lambda cursor: cursor.execute(
+                "INSERT INTO shared_inbox (queue, payload) VALUES (?, ?)", (queue_name, payload)
+            )
+        ).result(DB_WRITER_TIMEOUT)
+
+    def pop(self, queue_name, limit, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            # Пустую очередь проверяем чтением, без блокировки записи
+            if db_fetchone("SELECT 1 FROM shared_inbox WHERE queue = ? LIMIT 1", (queue_name,)):
+                with db_transaction() as cursor:
+                    cursor.execute(
+                        "SELECT id, payload FROM shared_inbox WHERE queue = ? ORDER BY id LIMIT ?",
+                        (queue_name, limit)
+                    )
+                    rows = cursor.fetchall()
+                    if rows:
+                        cursor.execute(
+                            "DELETE FROM shared_inbox WHERE queue = ? AND id <= ?", (queue_name, rows[-1][0])
+                        )
+                        return [payload for _, payload in rows]
+            if time.monotonic() >= deadline:
+                return []
+            time.sleep(self.POLL_INTERVAL)
+
+    def state_backend(self):
+        return SqliteStateBackend()
+
+class RedisSharedState(SharedState):
+    """Общее состояние в Redis — для инстансов на разных хостах.
+
+    Принимает готовый клиент redis-py, поэтому локально вместо сервера
+    можно подставить совместимый клиент (например, fakeredis.FakeRedis).
+    """
+
+    def __init__(self, client, prefix='igra:'):
+        self.client = client
+        self.prefix = prefix
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(self.prefix + key, value, nx=True, px=int(ttl * 1000)))
+
+    def renew(self, key, value, ttl):
+        from redis.exceptions import WatchError
+        
+        name = self.prefix + key
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(name)
+                current = pipe.get(name)
+                if current is None or current.decode('utf-8') != value:
+                    return False
+                pipe.multi()
+                pipe.pexpire(name, int(ttl * 1000))
+                pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def delete(self, key, value=None):
+        from redis.exceptions import WatchError
+        
+        name = self.prefix + key
+        if value is None:
+            self.client.delete(name)
+            return
+        # Проверка и удаление — одна транзакция: аренду, которую между ними
+        # перехватил другой процесс, удалять нельзя
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(name)
+                current = pipe.get(name)
+                if current is None or current.decode('utf-8') != value:
+                    return
+                pipe.multi()
+                pipe.delete(name)
+                pipe.execute()
+            except WatchError:
+                pass  # ключ изменился — он уже не наш
+
+    def push(self, queue_name, payload):
+        self.client.rpush(self.prefix + queue_name, payload)
+
+    def pop(self, queue_name, limit, timeout):
+        name = self.prefix + queue_name
+        first = self.client.blpop([name], timeout=max(1, int(timeout)))
+        if first is None:
+            return []
+        payloads = [first[1]]
+        if limit > 1:
+            with self.client.pipeline() as pipe:
+                pipe.lrange(name, 0, limit - 2)
+                pipe.ltrim(name, limit - 1, -1)
+                rest, _ = pipe.execute()
+            payloads.extend(rest)
+        return [payload.decode('utf-8') for payload in payloads]
+
+    def state_backend(self):
+        return RedisStateBackend(self.client, self.prefix + 'state:')
+
+class RedisStateBackend:
+    """Хранение состояний диалогов в Redis; TTL записи = TTL ключа"""
+
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+
+    def load(self, now):
+        keys = list(self.client.scan_iter(match=self.prefix + '*', count=500))
+        if not keys:
+            return []
+        items = []
+        for key, value in zip(keys, self.client.mget(keys)):
+            if value is None:
+                continue
+            data = json.loads(value)
+            if data['expires_at'] > now:
+                user_id = int(key.decode('utf-8')[len(self.prefix):])
+                items.append((user_id, data['state'], data['expires_at']))
+        return items
+
+    def save(self, items):
+        now = time.time()
+        with self.client.pipeline(transaction=False) as pipe:
+            for user_id, state, expires_at in items:
+                pipe.set(
+                    f"{self.prefix}{user_id}",
+                    json.dumps({'state': state, 'expires_at': expires_at}, ensure_ascii=False),
+                    px=max(1, int((expires_at - now) * 1000))
+                )
+            pipe.execute()
+
+    def delete(self, user_ids, now):
+        if user_ids:
+            self.client.delete(*(f"{self.prefix}{user_id}" for user_id in user_ids))
+
+def create_shared_state():
+    """Хранилище по SHARED_STATE; redis подключается только при выборе redis"""
+    if SHARED_STATE == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SHARED_STATE=redis требует пакет redis (pip install redis)")
+        return RedisSharedState(redis.Redis.from_url(SHARED_STATE_URL))
+    return SqliteSharedState()
+
+shared_state = create_shared_state()
+
+class ChatShards:
+    """Закрепление чатов за процессами (chat affinity).
+
+    При старте процесс арендует свободный шард в shared_state и продлевает
+    аренду фоновым потоком; обновления чужих чатов пересылает в очередь
+    шарда-владельца, а свою очередь разбирает в update_dispatcher.
+    При одном шарде ничего этого не происходит.
+    """
+
+    def __init__(self, shared, count, lease_seconds):
+        self.shared = shared
+        self.count = count
+        self.lease_seconds = lease_seconds
+        self.owner = None
+        self.slot = None
+        self._stopping = threading.Event()
+        self._threads = []
+
+    @property
+    def enabled(self):
+        return self.count > 1
+
+    def shard_of(self, chat_id):
+        return chat_id % self.count
+
+    def owns(self, chat_id):
+        return not self.enabled or chat_id is None or self.shard_of(chat_id) == self.slot
+
+    def claim(self):
+        """Арендовать свободный шард; ждёт, пока прежний владелец его отпустит"""
+        # pid меняется после fork, поэтому имя владельца берём здесь
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stopping.clear()
+        waiting_since = time.monotonic()
+        while True:
+            for slot in range(self.count):
+                if self.shared.add(f"shard:{slot}", self.owner, self.lease_seconds):
+                    self.slot = slot
+                    logger.info(f"✅ Шард {slot}/{self.count} закреплён за {self.owner}")
+                    print(f"🧩 Шард {slot} из {self.count}")
+                    return slot
+            if time.monotonic() - waiting_since > self.lease_seconds * 2:
+                logger.warning(f"⚠️ Все {self.count} шардов заняты, жду освобождения (CHAT_SHARDS меньше числа процессов?)")
+                waiting_since = time.monotonic()
+            time.sleep(self.lease_seconds / 10)
+
+    def start(self):
+        """Запустить продление аренды и разбор очереди своего шарда"""
+        for target, name in ((self._heartbeat, "shard-lease"), (self._consume, "shard-inbox")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Перестать забирать пересланные обновления"""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(self.lease_seconds)
+        self._threads = []
+
+    def release(self):
+        """Отпустить шард, чтобы замена могла занять его сразу"""
+        if self.slot is not None:
+            try:
+                self.shared.delete(f"shard:{self.slot}", self.owner)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось отпустить шард {self.slot}: {e}")
+            self.slot = None
+
+    def forward(self, chat_id, raw_update):
+        """Переслать обновление владельцу шарда; False, если владельца нет.
+
+        Шард без владельца (CHAT_SHARDS больше живых процессов или процесс
+        упал) никто не разбирает: такие обновления обрабатывает тот, кто
+        их получил, иначе пользователь остался бы без ответа.
+        """
+        shard = self.shard_of(chat_id)
+        if self.shared.get(f"shard:{shard}") is None:
+            return False
+        self.shared.push(f"inbox:{shard}", raw_update)
+        return True
+
+    def _heartbeat(self):
+        """Продлевать аренду; процесс гасится, только когда шард точно у другого.
+
+        Ошибка продления (БД занята VACUUM или большой пачкой, Redis
+        недоступен) — повод повторить чаще, а не считать шард потерянным:
+        пока хранилище недоступно, занять шард не может и никто другой.
+        """
+        key = f"shard:{self.slot}"
+        interval = self.lease_seconds / 3
+        while not self._stopping.wait(interval):
+            interval = self.lease_seconds / 3
+            try:
+                if self.shared.renew(key, self.owner, self.lease_seconds):
+                    continue
+                holder = self.shared.get(key)
+                if holder is None and self.shared.add(key, self.owner, self.lease_seconds):
+                    logger.warning(f"⚠️ Аренда шарда {self.slot} истекла, но шард свободен — занял снова")
+                    continue
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка продления аренды шарда {self.slot}, повторю: {e}")
+                interval = min(1.0, interval)
+                continue
+            if holder is None or holder == self.owner:
+                interval = min(1.0, interval)  # гонка с другим процессом — проверим ещё раз
+                continue
+            # Шард у другого процесса: кэш состояний больше не наш.
+            # Перезапуск воркера (gunicorn поднимет новый) безопаснее всего
+            logger.critical(f"❌ Шард {self.slot} занят процессом {holder}, перезапускаю процесс")
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+
+    def _consume(self):
+        inbox = f"inbox:{self.slot}"
+        while not self._stopping.is_set():
+            capacity = update_dispatcher.max_pending - update_dispatcher.pending
+            if capacity <= 0:
+                update_dispatcher.wait_idle(1.0)
+                continue
+            try:
+                payloads = self.shared.pop(inbox, min(capacity, 100), 1.0)
+            except Exception:
+                logger.exception(f"❌ Ошибка чтения очереди шарда {self.slot}")
+                self._stopping.wait(1.0)
+                continue
+            for payload in payloads:
+                self._dispatch(payload)
+
+    def _dispatch(self, payload):
+        try:
+            update = telebot.types.Update.de_json(payload)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"⚠️ Некорректное пересланное обновление: {e}")
+            return
+        if not update_deduplicator.claim(update):
+            WEBHOOK_UPDATES.inc("duplicate")
+            return
+        while not update_dispatcher.submit(get_update_chat_id(update), update):
+            update_dispatcher.wait_idle(1.0)
+        WEBHOOK_UPDATES.inc("accepted")
+
+# Продление ждёт блокировку БД до busy_timeout: аренда должна пережить
+# несколько таких ожиданий подряд
+chat_shards = ChatShards(shared_state, CHAT_SHARDS, max(SHARD_LEASE_SECONDS, 4 * DB_BUSY_TIMEOUT_MS / 1000))
+
+# Состояния пользователей в процессе записи
+user_states = StateStore(
+    STATE_TTL_SECONDS,
+    STATE_MAX_SIZE,
+    backend=shared_state.state_backend() if STATE_PERSIST else None,
+    flush_interval=STATE_FLUSH_SECONDS
+)
+metrics.gauge("bot_user_states", "Незавершённые записи в памяти", lambda: len(user_states))
+
+# ================== МАРШРУТИЗАЦИЯ ==================
+class UpdateRouter:
+    """Таблицы диспетчеризации вместо цепочки lambda-предикатов.
+
+    Сообщение находит обработчик одним поиском в словаре: по команде,
+    по точному тексту кнопки или по шагу сценария пользователя.
+    Callback-запросы ищутся по префиксу данных до первого "_"
+    ("filial_3" → "filial", "confirm_yes" → "confirm").
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.buttons = {}
+        self.steps = {}
+        self.callbacks = {}
+
+    def command(self, *names):
+        return self._register(self.commands, names)
+
+    def button(self, *texts):
+        return self._register(self.buttons, texts)
+
+    def step(self, *steps):
+        return self._register(self.steps, steps)
+
+    def callback(self, *prefixes):
+        return self._register(self.callbacks, prefixes)
+
+    def resolve_message(self, message):
+        """Обработчик для текстового сообщения или None"""
+        text = message.text or ""
+        command = telebot.util.extract_command(text)
+        if command is not None and command.lower() in self.commands:
+            return self.commands[command.lower()]
+        
+        handler = self.buttons.get(text)
+        if handler is None:
+            step = user_states.get(message.from_user.id, {}).get('step')
+            handler = self.steps.get(step)
+        return handler
+
+    def resolve_callback(self, call):
+        """Обработчик для callback-запроса или None"""
+        prefix = (call.data or "").split("_", 1)[0]
+        return self.callbacks.get(prefix)
+
+    def route_message(self, message):
+        handler = self.resolve_message(message)
+        if handler is None:
+            logger.info(f"ℹ️ Сообщение без обработчика от {message.from_user.id}: {(message.text or '')[:50]!r}")
+            return
+        with inline_reply_scope(handler):
+            run_handler(handler, message)
+
+    def route_callback(self, call):
+        handler = self.resolve_callback(call)
+        if handler is None:
+            logger.info(f"ℹ️ Callback без обработчика от {call.from_user.id}: {call.data!r}")
+            return
+        with inline_reply_scope(handler):
+            run_handler(handler, call)
+
+    @staticmethod
+    def _register(table, keys):
+        def decorator(handler):
+            for key in keys:
+                table[key] = handler
+            return handler
+        return decorator
+
+def run_handler(handler, update):
+    """Вызвать обработчик, записав время работы и ошибки в метрики"""
+    started = time.perf_counter()
+    with log_context(handler=handler.__name__):
+        try:
+            handler(update)
+        except Exception:
+            HANDLER_ERRORS.inc(handler.__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe(elapsed, handler.__name__)
+            logger.debug(
+                f"✅ Обработчик {handler.__name__} отработал",
+                extra={'duration_ms': round(elapsed * 1000, 3)}
+            )
+
+router = UpdateRouter()
+bot.register_message_handler(router.route_message, content_types=['text'])
+bot.register_callback_query_handler(router.route_callback, func=None)
+
+# ================== КЛАВИАТУРЫ ==================
 def get_main_keyboard():
     """Главное меню с emoji"""
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -185,47 +3206,241 @@ def get_main_keyboard():
     return markup
 
 def get_filials_keyboard():
-    """Клавиатура выбора филиала"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, name FROM filials WHERE is_active = 1")
-    filials = cursor.fetchall()
-    conn.close()
-    
-    markup = types.InlineKeyboardMarkup()
-    for filial_id, name in filials:
-        markup.add(types.InlineKeyboardButton(name, callback_data=f"filial_{filial_id}"))
-    markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
-    return markup
+    """Клавиатура выбора филиала (из кэша каталога)"""
+    return filial_catalog.get().keyboard
 
 # ================== КОМАНДЫ И КНОПКИ ==================
-@bot.message_handler(commands=['start'])
+@router.command('start')
+@inline_reply
 def cmd_start(message):
     """Команда /start"""
     user_id = message.from_user.id
     first_name = message.from_user.first_name
     
-    init_db()
+    welcome_text = f"""🎭 Привет, {first_name}!
+
+Добро пожаловать в Театральную Мастерскую "ИГРА"!
+
+✨ Что я умею:
+• Записать вас на занятие в удобный филиал
+• Показать контакты всех филиалов  
+• Сохранить ваши данные для связи
+• Уведомить администратора о записи
+
+Выберите действие ниже 👇"""
+    
+    bot.send_message(
+        message.chat.id,
+        welcome_text,
+        reply_markup=get_main_keyboard()
+    )
+
+# ================== КОМАНДЫ АДМИНИСТРАТОРА ==================
+def is_admin(user_id):
+    """Проверка, что пользователь — администратор"""
+    return str(user_id) == str(ADMIN_ID)
+
+@router.command('reload_filials')
+def cmd_reload_filials(message):
+    """Команда /reload_filials — перечитать каталог филиалов"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    filial_catalog.invalidate()
+    count = len(filial_catalog.get().by_id)
+    bot.send_message(message.chat.id, f"✅ Каталог филиалов обновлён: {count} активных филиалов")
+
+@router.command('broadcast')
+def cmd_broadcast(message):
+    """Команда /broadcast <текст> — черновик рассылки всем клиентам"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    text = telebot.util.extract_arguments(message.text or "")
+    if not text:
+        bot.send_message(message.chat.id, "ℹ️ Использование: /broadcast текст сообщения")
+        return
+    
+    broadcast_id = broadcast_engine.create(text, message.from_user.id)
+    markup = types.InlineKeyboardMarkup()
+    markup.row(
+        types.InlineKeyboardButton("✅ Отправить всем", callback_data=f"broadcast_send_{broadcast_id}"),
+        types.InlineKeyboardButton("❌ Отмена", callback_data=f"broadcast_cancel_{broadcast_id}")
+    )
+    bot.send_message(
+        message.chat.id,
+        f"📣 Рассылка #{broadcast_id} — проверьте текст:\n\n{text}",
+        reply_markup=markup
+    )
+
+@router.callback('broadcast')
+def process_broadcast(call):
+    """Запуск или отмена черновика рассылки"""
+    if not is_admin(call.from_user.id):
+        return
+    
+    _, action, broadcast_id = call.data.split("_")
+    broadcast_id = int(broadcast_id)
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    
+    if action == "send":
+        if broadcast_engine.launch(broadcast_id, chat_id, message_id):
+            bot.edit_message_text(f"📣 Рассылка #{broadcast_id} запущена...", chat_id, message_id)
+        else:
+            bot.edit_message_text(f"ℹ️ Рассылка #{broadcast_id} уже запущена или отменена", chat_id, message_id)
+    elif action == "cancel":
+        broadcast_engine.cancel(broadcast_id)
+        bot.edit_message_text(f"❌ Рассылка #{broadcast_id} отменена", chat_id, message_id)
+
+@router.command('broadcast_status')
+def cmd_broadcast_status(message):
+    """Команда /broadcast_status — последние рассылки"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    rows = db_fetchall(
+        "SELECT id, status, total, sent, failed FROM broadcasts WHERE status != 'draft' ORDER BY id DESC LIMIT 5"
+    )
+    if not rows:
+        bot.send_message(message.chat.id, "📭 Рассылок ещё не было")
+        return
+    reports = [render_broadcast_progress(*row, rate=0) for row in rows]
+    bot.send_message(message.chat.id, "\n\n".join(reports))
+
+@router.command('broadcast_stop')
+def cmd_broadcast_stop(message):
+    """Команда /broadcast_stop — остановить идущие рассылки"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    rows = db_fetchall("SELECT id FROM broadcasts WHERE status = 'running'")
+    for (broadcast_id,) in rows:
+        broadcast_engine.cancel(broadcast_id)
+    bot.send_message(message.chat.id, f"🛑 Остановлено рассылок: {len(rows)}")
+
+@router.command('export')
+def cmd_export(message):
+    """Команда /export [bookings|clients|filials] [csv|jsonl] [filial=ID] [status=new] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    table, fmt, pairs = 'bookings', 'csv', []
+    for arg in telebot.util.extract_arguments(message.text or "").split():
+        if "=" in arg:
+            pairs.append(tuple(arg.split("=", 1)))
+        elif arg in EXPORT_FORMATS:
+            fmt = arg
+        else:
+            table = arg
+    
+    try:
+        chunks = export_stream(table, fmt, parse_export_filters(pairs))
+    except ValueError as e:
+        bot.send_message(
+            message.chat.id,
+            f"❌ {e}\n\nℹ️ Использование: /export bookings csv filial=1 status=new from=2024-01-01 to=2024-12-31"
+        )
+        return
+    
+    # Небольшая выгрузка остаётся в памяти, большая уходит во временный файл
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as document:
+        for chunk in chunks:
+            document.write(chunk)
+        size = document.tell()
+        if size > TELEGRAM_DOCUMENT_LIMIT:
+            bot.send_message(
+                message.chat.id,
+                f"⚠️ Выгрузка весит {size // (1024 * 1024)} МБ — больше лимита Telegram. "
+                f"Сузьте фильтры или скачайте её по HTTP: /export/{table}.{fmt}"
+            )
+            return
+        document.seek(0)
+        bot.send_document(
+            message.chat.id,
+            document,
+            visible_file_name=export_filename(table, fmt),
+            caption=f"📤 {table}.{fmt}"
+        )
+    logger.info(f"📤 Выгрузка {table}.{fmt} отправлена администратору, {size} байт")
+
+@router.command('find')
+def cmd_find(message):
+    """Команда /find <ФИО или телефон> — поиск клиентов по началу слов или номера"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    query = telebot.util.extract_arguments(message.text or "").strip()
+    if not query:
+        bot.send_message(message.chat.id, "ℹ️ Использование: /find Иванов Ив или /find 8916123")
+        return
+    
+    try:
+        clients = find_clients(query)
+    except ValueError as e:
+        bot.send_message(message.chat.id, f"❌ {e}")
+        return
     
-    welcome_text = f"""🎭 Привет, {first_name}!
-
-Добро пожаловать в Театральную Мастерскую "ИГРА"!
-
-✨ Что я умею:
-• Записать вас на занятие в удобный филиал
-• Показать контакты всех филиалов  
-• Сохранить ваши данные для связи
-• Уведомить администратора о записи
+    if not clients:
+        bot.send_message(message.chat.id, f"📭 По запросу «{query}» никого не нашлось")
+        return
+    
+    lines = [f"🔎 Найдено: {len(clients)}" + (" (показаны первые)" if len(clients) == 20 else "")]
+    for client_id, full_name, phone, user_id, total, last_at in clients:
+        lines.append(
+            f"\n👤 #{client_id} {full_name}\n"
+            f"📞 {phone} • 🆔 {user_id}\n"
+            f"🗂 Записей: {total}" + (f", последняя — {last_at[:10]}" if last_at else "")
+        )
+    bot.send_message(message.chat.id, "\n".join(lines))
 
-Выберите действие ниже 👇"""
+@router.callback('admin')
+def process_admin_details(call):
+    """Кнопка «Подробнее» в уведомлении о записи"""
+    if not is_admin(call.from_user.id):
+        return
+    
+    booking_id = int(call.data.rsplit("_", 1)[1])
+    booking = db_fetchone('''
+    SELECT b.id, b.status, b.created_at, b.service_type, b.notes, f.name, f.address,
+           b.client_id, c.full_name, c.phone, c.user_id
+    FROM bookings_all b
+    LEFT JOIN filials f ON b.filial_id = f.id
+    LEFT JOIN clients c ON b.client_id = c.id
+    WHERE b.id = ?
+    ''', (booking_id,))
+    
+    if not booking:
+        bot.answer_callback_query(call.id, f"❌ Запись #{booking_id} не найдена", show_alert=True)
+        return
+    
+    (_, status, created_at, service, notes, filial_name, address,
+     client_id, full_name, phone, user_id) = booking
+    total, first_at = db_fetchone('''
+    SELECT
+        (SELECT COUNT(*) FROM bookings WHERE client_id = ?)
+          + (SELECT COUNT(*) FROM bookings_archive WHERE client_id = ?),
+        COALESCE(
+            (SELECT MIN(created_at) FROM bookings_archive WHERE client_id = ?),
+            (SELECT MIN(created_at) FROM bookings WHERE client_id = ?)
+        )
+    ''', (client_id,) * 4)
     
     bot.send_message(
-        message.chat.id,
-        welcome_text,
-        reply_markup=get_main_keyboard()
+        call.message.chat.id,
+        f"📋 ЗАПИСЬ #{booking_id}\n\n"
+        f"📊 Статус: {status}\n"
+        f"📅 Создана: {created_at}\n"
+        f"🎭 Услуга: {service}\n"
+        f"📝 Комментарий: {notes}\n\n"
+        f"🏢 Филиал: {filial_name}\n"
+        f"📍 Адрес: {address}\n\n"
+        f"👤 Клиент #{client_id}: {full_name}\n"
+        f"📞 Телефон: {phone}\n"
+        f"🆔 Telegram ID: {user_id}\n"
+        f"🗂 Всего записей: {total}, первая — {(first_at or '')[:10]}"
     )
 
-@bot.message_handler(func=lambda message: message.text == "📝 Записаться на занятие")
+@router.button("📝 Записаться на занятие")
 def start_booking(message):
     """Начало записи"""
     bot.send_message(
@@ -234,26 +3449,14 @@ def start_booking(message):
         reply_markup=get_filials_keyboard()
     )
 
-@bot.message_handler(func=lambda message: message.text == "🏢 Наши филиалы")
+@router.button("🏢 Наши филиалы")
+@inline_reply
 def show_filials(message):
     """Показать филиалы"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, address, phone FROM filials WHERE is_active = 1")
-    filials = cursor.fetchall()
-    conn.close()
-    
-    response = "🏢 НАШИ ФИЛИАЛЫ:\n\n"
-    
-    for name, address, phone in filials:
-        response += f"{name}\n"
-        response += f"📍 Адрес: {address}\n"
-        response += f"📞 Телефон: {phone}\n"
-        response += "──────────────\n"
-    
-    bot.send_message(message.chat.id, response)
+    bot.send_message(message.chat.id, filial_catalog.get().text)
 
-@bot.message_handler(func=lambda message: message.text == "📞 Контакты")
+@router.button("📞 Контакты")
+@inline_reply
 def show_contacts(message):
     """Показать контакты"""
     contacts_text = """📞 КОНТАКТЫ ТЕАТРАЛЬНОЙ МАСТЕРСКОЙ "ИГРА"
@@ -274,7 +3477,8 @@ def show_contacts(message):
     
     bot.send_message(message.chat.id, contacts_text)
 
-@bot.message_handler(func=lambda message: message.text == "ℹ️ О нас")
+@router.button("ℹ️ О нас")
+@inline_reply
 def show_about(message):
     """Информация о нас"""
     about_text = """🎭 ТЕАТРАЛЬНАЯ МАСТЕРСКАЯ "ИГРА"
@@ -299,73 +3503,80 @@ def show_about(message):
     
     bot.send_message(message.chat.id, about_text)
 
-@bot.message_handler(func=lambda message: message.text == "👤 Мои записи")
+@router.button("👤 Мои записи")
 def show_my_bookings(message):
     """Показать записи пользователя"""
     user_id = message.from_user.id
     
-    print(f"🔍 Кнопка 'Мои записи' нажата пользователем {user_id}")
-    
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    logger.debug(f"🔍 Кнопка 'Мои записи' нажата пользователем {user_id}")
     
-    cursor.execute("SELECT id, full_name, phone FROM clients WHERE user_id = ?", (user_id,))
-    client = cursor.fetchone()
+    client = db_fetchone("SELECT id, full_name, phone FROM clients WHERE user_id = ?", (user_id,))
     
     if not client:
-        print(f"📭 Пользователь {user_id} не найден в базе клиентов")
+        logger.debug(f"📭 Пользователь {user_id} не найден в базе клиентов")
         bot.send_message(message.chat.id, "📭 У вас еще нет записей. Запишитесь на первое занятие!")
-        conn.close()
         return
     
     client_id, client_name, client_phone = client
-    print(f"👤 Найден клиент: {client_name}, ID в базе: {client_id}")
-    
-    cursor.execute('''
-    SELECT b.id, f.name, b.service_type, b.created_at, b.status
-    FROM bookings b
-    JOIN filials f ON b.filial_id = f.id
-    WHERE b.client_id = ?
-    ORDER BY b.created_at DESC
-    LIMIT 10
-    ''', (client_id,))
-    
-    bookings = cursor.fetchall()
-    conn.close()
-    
-    if not bookings:
-        print(f"📭 У клиента {client_id} нет записей")
-        bot.send_message(message.chat.id, "📭 У вас нет активных записей.")
-        return
+    logger.debug(f"👤 Найден клиент: {client_name}, ID в базе: {client_id}")
     
-    print(f"📋 Найдено {len(bookings)} записей для клиента {client_id}")
+    page = booking_pages.get(user_id, 'first')
+    if page is None:
+        bookings, has_older = fetch_bookings_page(client_id)
+        
+        if not bookings:
+            logger.debug(f"📭 У клиента {client_id} нет записей")
+            bot.send_message(message.chat.id, "📭 У вас нет активных записей.")
+            return
+        
+        logger.debug(f"📋 Найдено {len(bookings)} записей для клиента {client_id}")
+        page = render_bookings_page(bookings, has_newer=False, has_older=has_older)
+        booking_pages.put(user_id, 'first', page)
     
-    response = "📋 ВАШИ ЗАПИСИ:\n\n"
+    text, markup = page
+    bot.send_message(message.chat.id, text, reply_markup=markup)
+
+@router.callback('bookings')
+def browse_my_bookings(call):
+    """Листание «Мои записи» кнопками: сообщение редактируется на месте"""
+    user_id = call.from_user.id
+    _, direction, token = call.data.split("_", 2)
     
-    for booking_id, filial_name, service, created_at, status in bookings:
-        status_icon = "✅" if status == "confirmed" else "🔄" if status == "new" else "❌"
-        response += f"{status_icon} Запись #{booking_id}\n"
-        response += f"🏢 Филиал: {filial_name}\n"
-        response += f"🎭 Услуга: {service}\n"
-        response += f"📅 Дата: {created_at[:10]}\n"
-        response += f"📊 Статус: {status}\n"
-        response += "──────────────\n"
+    page = booking_pages.get(user_id, call.data)
+    if page is None:
+        client = db_fetchone("SELECT id FROM clients WHERE user_id = ?", (user_id,))
+        if not client:
+            return
+        
+        cursor = decode_booking_cursor(token)
+        if cursor is None:
+            direction = None  # курсор не разобрать — показываем первую страницу
+        bookings, has_more = fetch_bookings_page(client[0], direction, cursor)
+        if not bookings:
+            bot.edit_message_text("📭 Других записей нет.", call.message.chat.id, call.message.message_id)
+            return
+        
+        # Откуда пришли, там записи точно есть
+        if direction is None:
+            page = render_bookings_page(bookings, has_newer=False, has_older=has_more)
+        elif direction == 'older':
+            page = render_bookings_page(bookings, has_newer=True, has_older=has_more)
+        else:
+            page = render_bookings_page(bookings, has_newer=has_more, has_older=True)
+        booking_pages.put(user_id, call.data, page)
     
-    bot.send_message(message.chat.id, response)
+    text, markup = page
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
 # ================== ПРОЦЕСС ЗАПИСИ ==================
-@bot.callback_query_handler(func=lambda call: call.data.startswith('filial_'))
+@router.callback('filial')
 def process_filial(call):
     """Обработка выбора филиала"""
     filial_id = int(call.data.split("_")[1])
     
-    user_states[call.from_user.id] = {'filial_id': filial_id, 'step': 'waiting_name'}
+    user_states.set(call.from_user.id, {'filial_id': filial_id, 'step': 'waiting_name'})
     
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, address FROM filials WHERE id = ?", (filial_id,))
-    filial = cursor.fetchone()
-    conn.close()
+    filial = filial_catalog.get_filial(filial_id)
     
     if filial:
         filial_name, address = filial
@@ -378,7 +3589,7 @@ def process_filial(call):
             call.message.message_id
         )
 
-@bot.message_handler(func=lambda message: user_states.get(message.from_user.id, {}).get('step') == 'waiting_name')
+@router.step('waiting_name')
 def process_name(message):
     """Обработка ввода имени"""
     full_name = message.text.strip()
@@ -387,8 +3598,7 @@ def process_name(message):
         bot.send_message(message.chat.id, "❌ Введите полное ФИО (минимум 5 символов):")
         return
     
-    user_states[message.from_user.id]['full_name'] = full_name
-    user_states[message.from_user.id]['step'] = 'waiting_phone'
+    user_states.update(message.from_user.id, full_name=full_name, step='waiting_phone')
     
     bot.send_message(
         message.chat.id,
@@ -397,24 +3607,24 @@ def process_name(message):
         f"(Например: +79161234567 или 89161234567)"
     )
 
-@bot.message_handler(func=lambda message: user_states.get(message.from_user.id, {}).get('step') == 'waiting_phone')
+@router.step('waiting_phone')
 def process_phone(message):
     """Обработка ввода телефона"""
-    phone = message.text.strip()
+    # Храним номер в одном виде, чтобы один клиент не выглядел как несколько
+    phone = normalize_phone(message.text)
     
-    if not any(char.isdigit() for char in phone) or len(phone) < 10:
-        bot.send_message(message.chat.id, "❌ Неверный формат телефона. Введите еще раз:")
+    if phone is None:
+        bot.send_message(
+            message.chat.id,
+            "❌ Неверный формат телефона. Введите еще раз:\n(Например: +79161234567 или 89161234567)"
+        )
         return
     
-    user_data = user_states[message.from_user.id]
+    user_data = user_states.get(message.from_user.id, {})
     full_name = user_data['full_name']
     filial_id = user_data['filial_id']
     
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, address FROM filials WHERE id = ?", (filial_id,))
-    filial = cursor.fetchone()
-    conn.close()
+    filial = filial_catalog.get_filial(filial_id)
     
     filial_name = filial[0] if filial else "Неизвестный филиал"
     filial_address = filial[1] if filial else ""
@@ -436,10 +3646,14 @@ def process_phone(message):
     )
     markup.row(types.InlineKeyboardButton("❌ Отменить", callback_data="confirm_no"))
     
-    user_data['phone'] = phone
-    user_data['filial_name'] = filial_name
-    user_data['filial_address'] = filial_address
-    user_data['step'] = 'waiting_confirmation'
+    user_states.update(
+        message.from_user.id,
+        phone=phone,
+        filial_name=filial_name,
+        filial_address=filial_address,
+        confirmation=uuid.uuid4().hex,
+        step='waiting_confirmation'
+    )
     
     bot.send_message(
         message.chat.id,
@@ -447,7 +3661,7 @@ def process_phone(message):
         reply_markup=markup
     )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('confirm_'))
+@router.callback('confirm')
 def process_confirmation(call):
     """Обработка подтверждения"""
     action = call.data.split("_")[1]
@@ -459,8 +3673,7 @@ def process_confirmation(call):
             call.message.chat.id,
             call.message.message_id
         )
-        if user_id in user_states:
-            del user_states[user_id]
+        user_states.pop(user_id)
         return
     
     if action == "edit":
@@ -471,7 +3684,7 @@ def process_confirmation(call):
             reply_markup=get_filials_keyboard()
         )
         if user_id in user_states:
-            user_states[user_id]['step'] = 'waiting_name'
+            user_states.update(user_id, step='waiting_name')
         return
     
     user_data = user_states.get(user_id, {})
@@ -480,33 +3693,24 @@ def process_confirmation(call):
         bot.answer_callback_query(call.id, "❌ Данные устарели", show_alert=True)
         return
     
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    INSERT OR REPLACE INTO clients (user_id, full_name, phone, created_at)
-    VALUES (?, ?, ?, ?)
-    ''', (user_id, user_data['full_name'], user_data['phone'], datetime.now()))
-    
-    client_id = cursor.lastrowid
-    
-    cursor.execute('''
-    INSERT INTO bookings (client_id, filial_id, service_type, notes, status)
-    VALUES (?, ?, ?, ?, ?)
-    ''', (
-        client_id,
-        user_data['filial_id'],
-        "🎭 Запись на занятие",
-        "Нет комментариев",
-        'new'
-    ))
+    if 'confirmation' not in user_data:
+        # Состояние сохранено до появления токена
+        user_data['confirmation'] = uuid.uuid4().hex
+        user_states.update(user_id, confirmation=user_data['confirmation'])
     
-    booking_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    try:
+        booking_id = db_writer.submit(save_booking, user_id, user_data).result(DB_WRITER_TIMEOUT)
+    except FutureTimeoutError:
+        # Запись ещё может сохраниться: состояние остаётся, повтор вернёт её же
+        logger.warning(f"⚠️ Запись пользователя {user_id} не сохранена за {DB_WRITER_TIMEOUT} с")
+        bot.answer_callback_query(
+            call.id, "⏳ Сохраняем запись, нажмите «Да» ещё раз через несколько секунд", show_alert=True
+        )
+        return
+    admin_notifier.wake()
+    booking_pages.invalidate(user_id)
     
-    if user_id in user_states:
-        del user_states[user_id]
+    user_states.pop(user_id)
     
     success_text = f"""🎉 ЗАПИСЬ УСПЕШНО СОЗДАНА!
 
@@ -528,80 +3732,904 @@ def process_confirmation(call):
         call.message.chat.id,
         call.message.message_id
     )
+
+@router.callback('cancel')
+def cancel_booking(call):
+    """Отмена записи"""
+    user_id = call.from_user.id
+    user_states.pop(user_id)
     
-    try:
-        admin_message = f"""🎭 НОВАЯ ЗАПИСЬ В ТЕАТРАЛЬНУЮ МАСТЕРСКУЮ "ИГРА"!
+    bot.edit_message_text(
+        "❌ Запись отменена",
+        call.message.chat.id,
+        call.message.message_id
+    )
+
+# ================== УВЕДОМЛЕНИЯ АДМИНИСТРАТОРА ==================
+def render_admin_notification(payload):
+    """Текст и кнопки уведомления об одной записи"""
+    admin_message = f"""🎭 НОВАЯ ЗАПИСЬ В ТЕАТРАЛЬНУЮ МАСТЕРСКУЮ "ИГРА"!
 
 📋 Детали записи:
-ID: #{booking_id}
-Филиал: {user_data['filial_name']}
-Адрес: {user_data['filial_address']}
+ID: #{payload['booking_id']}
+Филиал: {payload['filial_name']}
+Адрес: {payload['filial_address']}
 
 👤 Данные клиента:
-ФИО: {user_data['full_name']}
-Телефон: {user_data['phone']}
-Telegram ID: {user_id}
+ФИО: {payload['full_name']}
+Телефон: {payload['phone']}
+Telegram ID: {payload['user_id']}{render_repeat_client(payload)}
 
 🎭 Услуга: Запись на занятие
 
-⏰ Время записи: {datetime.now().strftime('%H:%M %d.%m.%Y')}
+⏰ Время записи: {payload['created_at']}
 
 📞 Контактный телефон: +7 (967) 655-50-45"""
+    
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(
+        text="📋 Подробнее", 
+        callback_data=f"admin_details_{payload['booking_id']}"
+    ))
+    markup.add(types.InlineKeyboardButton(
+        text="💬 Написать клиенту", 
+        url=f"tg://user?id={payload['user_id']}"
+    ))
+    return admin_message, markup
+
+def render_repeat_client(payload):
+    """Строка о прежних записях клиента (пусто для нового клиента)"""
+    previous = payload.get('previous_bookings')
+    if not previous:
+        return ""
+    line = f"\n🔁 Повторный клиент: записей ранее — {previous}"
+    if payload.get('accounts', 0) > 1:
+        line += f" (аккаунтов с этим телефоном: {payload['accounts']})"
+    return line
+
+def render_admin_digest(payloads):
+    """Один текст на несколько записей в одном филиале"""
+    first = payloads[0]
+    lines = [
+        f"🎭 НОВЫЕ ЗАПИСИ ({len(payloads)}) В ТЕАТРАЛЬНУЮ МАСТЕРСКУЮ \"ИГРА\"!",
+        "",
+        f"🏢 Филиал: {first['filial_name']}",
+        f"📍 Адрес: {first['filial_address']}",
+        "",
+    ]
+    for payload in payloads:
+        lines.append(
+            f"#{payload['booking_id']} • {payload['full_name']} • {payload['phone']} • "
+            f"{payload['created_at']} • tg://user?id={payload['user_id']}"
+            + (" • 🔁" if payload.get('previous_bookings') else "")
+        )
+    return "\n".join(lines), None
+
+class AdminNotifier:
+    """Фоновая доставка уведомлений из notification_outbox.
+
+    Пользователь получает подтверждение, не дожидаясь отправки
+    администратору. Неудачные отправки повторяются с растущей паузой,
+    после max_attempts уведомление помечается failed. В режиме дайджеста
+    (digest_window > 0) уведомление ждёт окно, и все созревшие записи
+    одного филиала уходят одним сообщением.
+    """
+
+    BATCH_SIZE = 50
+    LEASE_SECONDS = 60
+
+    def __init__(self, poll_interval, max_attempts, digest_window, retention_days):
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.digest_window = digest_window
+        self.retention_days = retention_days
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_cleanup = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="admin-notifier", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            thread.join(timeout)
+
+    def wake(self):
+        """Сообщить о новом уведомлении в outbox"""
+        self.start()
+        if not self.digest_window:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                while self.deliver_due() and not self._stopping.is_set():
+                    pass
+                self._cleanup()
+            except Exception:
+                logger.exception("❌ Ошибка обработки очереди уведомлений")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def deliver_due(self):
+        """Отправить созревшие уведомления; вернуть их количество"""
+        rows = db_fetchall('''
+        SELECT id, chat_id, filial_id, payload, attempts FROM notification_outbox
+        WHERE status = 'pending' AND next_attempt_at <= ?
+        ORDER BY id
+        LIMIT ?
+        ''', (time.time(), self.BATCH_SIZE))
+        if not rows:
+            return 0
         
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton(
-            text="📋 Подробнее", 
-            callback_data=f"admin_details_{booking_id}"
-        ))
-        markup.add(types.InlineKeyboardButton(
-            text="💬 Написать клиенту", 
-            url=f"tg://user?id={user_id}"
-        ))
+        # Несколько процессов читают один outbox: берём строки в аренду,
+        # чтобы уведомление не ушло дважды
+        claimed = db_writer.submit(self._claim, [row[0] for row in rows]).result(DB_WRITER_TIMEOUT)
+        rows = [row for row in rows if row[0] in claimed]
         
-        bot.send_message(
-            ADMIN_ID,
-            admin_message,
-            reply_markup=markup
+        groups = OrderedDict()
+        for row in rows:
+            key = (row[1], row[2]) if self.digest_window else (row[1], row[0])
+            groups.setdefault(key, []).append(row)
+        
+        for (chat_id, _), group in groups.items():
+            ids = [row[0] for row in group]
+            try:
+                payloads = [json.loads(row[3]) for row in group]
+                if len(payloads) == 1:
+                    text, markup = render_admin_notification(payloads[0])
+                else:
+                    text, markup = render_admin_digest(payloads)
+                bot.send_message(chat_id, text, reply_markup=markup)
+            except Exception as e:
+                db_writer.submit(self._mark_failed, group, str(e)).result(DB_WRITER_TIMEOUT)
+                logger.warning(f"⚠️ Ошибка отправки уведомления {ids}: {e}")
+            else:
+                db_writer.submit(self._mark_sent, ids).result(DB_WRITER_TIMEOUT)
+                logger.info(f"✅ Уведомление отправлено администратору {chat_id}: {ids}")
+        return len(claimed)
+
+    def _claim(self, cursor, ids):
+        now = time.time()
+        claimed = set()
+        for outbox_id in ids:
+            cursor.execute('''
+            UPDATE notification_outbox SET next_attempt_at = ?
+            WHERE id = ? AND status = 'pending' AND next_attempt_at <= ?
+            ''', (now + self.LEASE_SECONDS, outbox_id, now))
+            if cursor.rowcount:
+                claimed.add(outbox_id)
+        return claimed
+
+    def _mark_sent(self, cursor, ids):
+        cursor.executemany(
+            "UPDATE notification_outbox SET status = 'sent', sent_at = ? WHERE id = ?",
+            [(time.time(), outbox_id) for outbox_id in ids]
         )
+
+    def _mark_failed(self, cursor, group, error):
+        now = time.time()
+        for outbox_id, _, _, _, attempts in group:
+            attempts += 1
+            status = 'failed' if attempts >= self.max_attempts else 'pending'
+            delay = min(600.0, 5.0 * 2 ** attempts) * random.uniform(0.8, 1.2)
+            cursor.execute('''
+            UPDATE notification_outbox
+            SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+            WHERE id = ?
+            ''', (status, attempts, now + delay, error[:500], outbox_id))
+            if status == 'failed':
+                logger.error(f"❌ Уведомление {outbox_id} не доставлено после {attempts} попыток")
+
+    def _cleanup(self):
+        if time.monotonic() - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = time.monotonic()
+        cutoff = time.time() - self.retention_days * 86400
+        
+        def cleanup(cursor):
+            cursor.execute("DELETE FROM notification_outbox WHERE status = 'sent' AND sent_at < ?", (cutoff,))
+            cursor.execute("DELETE FROM booking_confirmations WHERE created_at < ?", (cutoff,))
+        db_writer.submit(cleanup).result(DB_WRITER_TIMEOUT)
+
+admin_notifier = AdminNotifier(
+    NOTIFY_POLL_SECONDS,
+    NOTIFY_MAX_ATTEMPTS,
+    NOTIFY_DIGEST_WINDOW,
+    NOTIFY_RETENTION_DAYS
+)
+
+# ================== РАССЫЛКИ ==================
+class BroadcastEngine:
+    """Рассылка сообщения всем клиентам с продолжением после перезапуска.
+
+    Получатели выбираются из clients страницами по id (keyset) и
+    записываются в broadcast_recipients вместе с позицией last_client_id
+    в одной транзакции. Страница отправляется пулом потоков; собственная
+    корзина токенов (rate) оставляет часть общего лимита Telegram обычным
+    ответам бота. Статус каждого получателя пишется через db_writer, так
+    что после падения рассылка продолжается с неотправленных.
+    """
+
+    MAX_ATTEMPTS = 3
+    LEASE_SECONDS = 60
+
+    def __init__(self, rate, workers, page_size, report_interval):
+        self.workers = workers
+        self.page_size = page_size
+        self.report_interval = report_interval
+        self._bucket = TokenBucket(rate, max(1, int(rate)))
+        self._bucket_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._cancelled = set()
+        self._stopping = threading.Event()
+        self._pool = None
+        self._owner = None
+
+    def create(self, text, created_by):
+        """Сохранить черновик рассылки, вернуть его id"""
+        return db_writer.submit(
+            lambda cursor: cursor.execute(
+                "INSERT INTO broadcasts (text, created_by, created_at) VALUES (?, ?, ?)",
+                (text, str(created_by), time.time())
+            ).lastrowid
+        ).result(DB_WRITER_TIMEOUT)
+
+    def launch(self, broadcast_id, report_chat_id, report_message_id):
+        """Запустить черновик; False, если он уже запущен или отменён"""
+        total = db_fetchone("SELECT COUNT(*) FROM clients WHERE user_id IS NOT NULL")[0]
         
-        print(f"✅ Уведомление отправлено администратору {ADMIN_ID}")
+        def mark_running(cursor):
+            cursor.execute('''
+            UPDATE broadcasts
+            SET status = 'running', total = ?, report_chat_id = ?, report_message_id = ?, started_at = ?
+            WHERE id = ? AND status = 'draft'
+            ''', (total, str(report_chat_id), report_message_id, time.time(), broadcast_id))
+            return cursor.rowcount == 1
         
-    except Exception as e:
-        print(f"❌ Ошибка отправки уведомления: {e}")
+        if not db_writer.submit(mark_running).result(DB_WRITER_TIMEOUT):
+            return False
+        self._start(broadcast_id)
+        return True
 
-@bot.callback_query_handler(func=lambda call: call.data == 'cancel')
-def cancel_booking(call):
-    """Отмена записи"""
-    user_id = call.from_user.id
-    if user_id in user_states:
-        del user_states[user_id]
+    def cancel(self, broadcast_id):
+        """Отменить черновик или идущую рассылку"""
+        self._cancelled.add(broadcast_id)
+        return db_writer.submit(
+            lambda cursor: cursor.execute(
+                "UPDATE broadcasts SET status = 'cancelled', finished_at = ? "
+                "WHERE id = ? AND status IN ('draft', 'running')",
+                (time.time(), broadcast_id)
+            ).rowcount == 1
+        ).result(DB_WRITER_TIMEOUT)
+
+    def resume(self):
+        """Подхватить рассылки, прерванные остановкой процесса.
+
+        Вызывается при старте и периодически: рассылку, аренда которой ещё
+        не истекла, подхватим при следующем вызове.
+        """
+        rows = db_fetchall("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+        resumed = sum(self._start(broadcast_id) for (broadcast_id,) in rows)
+        if resumed:
+            print(f"📣 Продолжаю рассылок: {resumed}")
+
+    def stop(self, timeout=None):
+        """Остановиться после текущих сообщений; неотправленные останутся pending"""
+        self._stopping.set()
+        with self._lock:
+            threads = list(self._threads.values())
+        for thread in threads:
+            thread.join(timeout)
+
+    def _start(self, broadcast_id):
+        with self._lock:
+            if broadcast_id in self._threads or self._stopping.is_set():
+                return False
+            if self._owner is None:
+                self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            # При нескольких процессах рассылку ведёт только один
+            if not shared_state.add(f"broadcast:{broadcast_id}", self._owner, self.LEASE_SECONDS):
+                return False
+            thread = threading.Thread(
+                target=self._run, args=(broadcast_id,), name=f"broadcast-{broadcast_id}", daemon=True
+            )
+            self._threads[broadcast_id] = thread
+        thread.start()
+        return True
+
+    def _run(self, broadcast_id):
+        started = time.monotonic()
+        delivered = 0
+        last_report = 0.0
+        try:
+            text = db_fetchone("SELECT text FROM broadcasts WHERE id = ?", (broadcast_id,))[0]
+            while not self._stopping.is_set() and broadcast_id not in self._cancelled:
+                # Отмена могла прийти в другой процесс
+                if db_fetchone("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,))[0] != 'running':
+                    break
+                rows = db_fetchall(
+                    "SELECT chat_id, attempts FROM broadcast_recipients "
+                    "WHERE broadcast_id = ? AND status = 'pending' ORDER BY chat_id LIMIT ?",
+                    (broadcast_id, self.page_size)
+                )
+                if not rows:
+                    selected = db_writer.submit(self._select_page, broadcast_id).result(DB_WRITER_TIMEOUT)
+                    if selected:
+                        continue
+                    db_writer.submit(
+                        lambda cursor: cursor.execute(
+                            "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ? AND status = 'running'",
+                            (time.time(), broadcast_id)
+                        )
+                    ).result(DB_WRITER_TIMEOUT)
+                    logger.info(f"✅ Рассылка #{broadcast_id} завершена")
+                    break
+                
+                sent, retried = self._send_page(broadcast_id, text, rows)
+                delivered += sent
+                if time.monotonic() - last_report >= self.report_interval:
+                    self._report(broadcast_id, delivered / (time.monotonic() - started))
+                    last_report = time.monotonic()
+                if retried > len(rows) // 2:
+                    # Telegram отвечает ошибками — не сжигаем попытки подряд
+                    logger.warning(f"⚠️ Рассылка #{broadcast_id}: много ошибок, пауза 30 с")
+                    self._stopping.wait(30)
+            
+            self._report(broadcast_id, delivered / max(time.monotonic() - started, 1e-6))
+        except Exception:
+            logger.exception(f"❌ Рассылка #{broadcast_id} прервана ошибкой")
+        finally:
+            with self._lock:
+                self._threads.pop(broadcast_id, None)
+            try:
+                shared_state.delete(f"broadcast:{broadcast_id}", self._owner)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось снять аренду рассылки #{broadcast_id}: {e}")
+            release_db()  # поток рассылки разовый
+
+    def _select_page(self, cursor, broadcast_id):
+        """Следующая страница клиентов после last_client_id — в получатели"""
+        last_client_id = cursor.execute(
+            "SELECT last_client_id FROM broadcasts WHERE id = ?", (broadcast_id,)
+        ).fetchone()[0]
+        rows = cursor.execute(
+            "SELECT id, user_id FROM clients WHERE id > ? ORDER BY id LIMIT ?",
+            (last_client_id, self.page_size)
+        ).fetchall()
+        if not rows:
+            return 0
+        cursor.executemany(
+            "INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, chat_id) VALUES (?, ?)",
+            [(broadcast_id, user_id) for _, user_id in rows if user_id is not None]
+        )
+        cursor.execute("UPDATE broadcasts SET last_client_id = ? WHERE id = ?", (rows[-1][0], broadcast_id))
+        return len(rows)
+
+    def _send_page(self, broadcast_id, text, rows):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="broadcast-sender")
+        
+        marks = []
+        
+        def deliver(chat_id, attempts):
+            if self._stopping.is_set() or broadcast_id in self._cancelled:
+                return None
+            result, error = self._deliver(chat_id, text)
+            BROADCAST_MESSAGES.inc(result)
+            marks.append(db_writer.submit(self._mark, broadcast_id, chat_id, attempts, result, error))
+            return result
+        
+        futures = [self._pool.submit(deliver, chat_id, attempts) for chat_id, attempts in rows]
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=self.LEASE_SECONDS / 3)
+            try:
+                shared_state.renew(f"broadcast:{broadcast_id}", self._owner, self.LEASE_SECONDS)
+            except Exception as e:
+                # Занятая БД не повод бросать страницу: продлим на следующем круге
+                logger.warning(f"⚠️ Ошибка продления аренды рассылки #{broadcast_id}: {e}")
+        for mark in marks:
+            mark.result(DB_WRITER_TIMEOUT)
+        
+        results = [future.result() for future in futures]
+        return results.count('sent'), results.count('retry')
+
+    def _deliver(self, chat_id, text):
+        with self._bucket_lock:
+            delay = self._bucket.reserve(time.monotonic())
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            bot.send_message(chat_id, text)
+            return 'sent', None
+        except apihelper.ApiTelegramException as e:
+            # 403 — бот заблокирован, 400 — чат не найден: повтор не поможет
+            if e.error_code == 403:
+                return 'blocked', e.description
+            if e.error_code == 400:
+                return 'failed', e.description
+            return 'retry', e.description
+        except Exception as e:
+            return 'retry', str(e)
+
+    def _mark(self, cursor, broadcast_id, chat_id, attempts, result, error):
+        status = result
+        if result == 'retry':
+            attempts += 1
+            status = 'failed' if attempts >= self.MAX_ATTEMPTS else 'pending'
+        cursor.execute('''
+        UPDATE broadcast_recipients SET status = ?, attempts = ?, error = ?, sent_at = ?
+        WHERE broadcast_id = ? AND chat_id = ?
+        ''', (status, attempts, error and error[:300], time.time() if status == 'sent' else None,
+              broadcast_id, chat_id))
+        if status == 'sent':
+            cursor.execute("UPDATE broadcasts SET sent = sent + 1 WHERE id = ?", (broadcast_id,))
+        elif status != 'pending':
+            cursor.execute("UPDATE broadcasts SET failed = failed + 1 WHERE id = ?", (broadcast_id,))
+
+    def _report(self, broadcast_id, rate):
+        """Обновить сообщение о ходе рассылки у администратора"""
+        row = db_fetchone(
+            "SELECT status, total, sent, failed, report_chat_id, report_message_id FROM broadcasts WHERE id = ?",
+            (broadcast_id,)
+        )
+        if row is None or row[4] is None:
+            return
+        status, total, sent, failed, chat_id, message_id = row
+        try:
+            bot.edit_message_text(render_broadcast_progress(broadcast_id, status, total, sent, failed, rate),
+                                  chat_id, message_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить отчёт рассылки #{broadcast_id}: {e}")
+
+def render_broadcast_progress(broadcast_id, status, total, sent, failed, rate):
+    """Текст отчёта о рассылке"""
+    titles = {
+        'running': "идёт",
+        'done': "завершена",
+        'cancelled': "отменена",
+    }
+    done = sent + failed
+    percent = done * 100 // total if total else 100
+    lines = [
+        f"📣 Рассылка #{broadcast_id} {titles.get(status, status)}",
+        "",
+        f"✅ Доставлено: {sent} из {total} ({percent}%)",
+        f"🚫 Не доставлено: {failed}",
+    ]
+    if status == 'running' and rate > 0:
+        remaining = max(total - done, 0) / rate
+        lines.append(f"⚡ Скорость: {rate:.1f} сообщ./с")
+        lines.append(f"⏳ Осталось: ~{int(remaining // 60)} мин {int(remaining % 60)} с")
+    return "\n".join(lines)
+
+broadcast_engine = BroadcastEngine(
+    BROADCAST_RATE,
+    BROADCAST_WORKERS,
+    BROADCAST_PAGE_SIZE,
+    BROADCAST_REPORT_SECONDS
+)
+
+# ================== АРХИВ ЗАПИСЕЙ ==================
+class BookingArchiver:
+    """Перенос старых записей из bookings в bookings_archive.
+
+    Запускается планировщиком. Переносятся записи старше after_days, а в
+    конечных статусах — старше terminal_after_days. Каждая пачка из
+    batch_size записей — отдельная короткая операция db_writer, поэтому
+    новые записи клиентов не ждут весь перенос. Освободившиеся страницы
+    возвращаются файлу через PRAGMA incremental_vacuum. Историю по обеим
+    таблицам читают через представление bookings_all, «Мои записи» —
+    через fetch_bookings_page.
+    """
+
+    LEASE_SECONDS = 600
+
+    def __init__(self, after_days, terminal_after_days, terminal_statuses, batch_size, vacuum_pages):
+        self.after_days = after_days
+        self.terminal_after_days = min(terminal_after_days, after_days)
+        self.terminal_statuses = tuple(
+            status.strip() for status in terminal_statuses.split(",") if status.strip()
+        )
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._stopping = threading.Event()
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._convert_noted = False
+
+    def run(self):
+        """Задача планировщика: перенос и освобождение места в файле"""
+        if self.after_days <= 0 or self._stopping.is_set():
+            return
+        # При нескольких процессах переносит один
+        if not shared_state.add("archive", self._owner, self.LEASE_SECONDS):
+            return
+        try:
+            moved = self.archive()
+            freed = self.vacuum()
+            if moved or freed:
+                logger.info(f"🗄 Архив: перенесено записей {moved}, освобождено страниц {freed}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка архивации записей: {e}")
+        finally:
+            shared_state.delete("archive", self._owner)
+
+    def stop(self):
+        """Прервать перенос после текущей пачки"""
+        self._stopping.set()
+
+    def archive(self):
+        """Перенести все подходящие записи, вернуть их число"""
+        hot_cutoff, terminal_cutoff = db_fetchone(
+            "SELECT datetime('now', ?), datetime('now', ?)",
+            (f"-{self.after_days} days", f"-{self.terminal_after_days} days")
+        )
+        position = ("", 0)
+        moved = 0
+        while not self._stopping.is_set():
+            count, position = db_writer.submit(
+                self._move_batch, hot_cutoff, terminal_cutoff, position
+            ).result(DB_WRITER_TIMEOUT)
+            if not count:
+                break
+            moved += count
+            ARCHIVED_BOOKINGS.inc(amount=count)
+        return moved
+
+    def _move_batch(self, cursor, hot_cutoff, terminal_cutoff, position):
+        """Перенести одну пачку; позиция (created_at, id) продолжает обход индекса"""
+        statuses = ", ".join("?" * len(self.terminal_statuses))
+        cursor.execute(f'''
+        SELECT id, created_at FROM bookings
+        WHERE (created_at, id) > (?, ?) AND created_at < ?
+          AND (created_at < ? OR status IN ({statuses}))
+        ORDER BY created_at, id
+        LIMIT ?
+        ''', (*position, terminal_cutoff, hot_cutoff, *self.terminal_statuses, self.batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0, position
+        
+        ids = [booking_id for booking_id, _ in rows]
+        marks = ", ".join("?" * len(ids))
+        cursor.execute(f'''
+        INSERT INTO bookings_archive (id, client_id, filial_id, service_type, notes, status, created_at)
+        SELECT id, client_id, filial_id, service_type, notes, status, created_at
+        FROM bookings WHERE id IN ({marks})
+        ''', ids)
+        cursor.execute(f"DELETE FROM bookings WHERE id IN ({marks})", ids)
+        last_id, last_created = rows[-1]
+        return len(ids), (last_created, last_id)
+
+    def vacuum(self):
+        """Вернуть свободные страницы файлу порциями по vacuum_pages, вернуть их число"""
+        conn = get_db()
+        # SELECT открывает читающую транзакцию, а PRAGMA вернула бы режим,
+        # запомненный соединением до VACUUM другого соединения
+        if conn.execute("SELECT * FROM pragma_auto_vacuum").fetchone()[0] == 0:
+            # Файл создан без auto_vacuum: режим меняется только полным VACUUM.
+            # Он держит монопольную блокировку на всё время и требует места
+            # ещё на одну копию файла, поэтому только по явному разрешению
+            if not DB_VACUUM_CONVERT:
+                if not self._convert_noted:
+                    self._convert_noted = True
+                    logger.warning(
+                        "⚠️ БД без auto_vacuum: место после архивации не возвращается. "
+                        "Для разового VACUUM запустите процесс с DB_VACUUM_CONVERT=1 в окно обслуживания"
+                    )
+                return 0
+            return db_writer.exclusive(self._convert).result()
+        
+        freed = 0
+        while not self._stopping.is_set():
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free_pages:
+                break
+            step = min(free_pages, self.vacuum_pages)
+            # execute() делает один шаг и освобождает одну страницу; executescript — все step
+            conn.executescript(f"PRAGMA incremental_vacuum({step});")
+            freed += step
+        if freed:
+            # В режиме WAL файл укорачивается только при checkpoint
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return freed
+
+    @staticmethod
+    def _convert(conn):
+        """Перевести файл в auto_vacuum=INCREMENTAL; выполняется на потоке-писателе"""
+        page_count, = conn.execute("PRAGMA page_count").fetchone()
+        page_size, = conn.execute("PRAGMA page_size").fetchone()
+        free_pages, = conn.execute("PRAGMA freelist_count").fetchone()
+        # Новая копия пишется через WAL: нужно ещё примерно столько же места
+        needed = (page_count - free_pages) * page_size
+        available = shutil.disk_usage(os.path.dirname(os.path.abspath(DB_NAME))).free
+        if available < needed:
+            logger.error(f"❌ Для VACUUM не хватает места: нужно {needed} байт, свободно {available}")
+            return 0
+        logger.info(f"🗄 Перевожу БД в режим auto_vacuum=INCREMENTAL (VACUUM, {page_count} страниц)")
+        started = time.monotonic()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logger.info(f"✅ VACUUM завершён за {time.monotonic() - started:.1f} с")
+        return free_pages
+
+booking_archiver = BookingArchiver(
+    ARCHIVE_AFTER_DAYS,
+    ARCHIVE_TERMINAL_AFTER_DAYS,
+    ARCHIVE_TERMINAL_STATUSES,
+    ARCHIVE_BATCH_SIZE,
+    VACUUM_STEP_PAGES
+)
+
+# ================== ЖИЗНЕННЫЙ ЦИКЛ ПРОЦЕССА ==================
+_lifecycle_lock = threading.Lock()
+_started = False
+accepting_updates = True
+scheduler = None
+server_ready = threading.Event()
+startup_seconds = float("nan")
+metrics.gauge(
+    "bot_startup_seconds", "Время от запуска процесса до готовности принимать обновления",
+    lambda: startup_seconds
+)
+
+def mark_ready(source):
+    """Отметить готовность процесса; вызывается, когда сервер уже слушает порт"""
+    global startup_seconds
+    if server_ready.is_set():
+        return
+    startup_seconds = time.monotonic() - PROCESS_STARTED
+    server_ready.set()
+    logger.info(f"🚀 Готов к работе за {startup_seconds:.3f} с ({source})")
+    print(f"🚀 Готов к работе за {startup_seconds:.3f} с ({source})")
     
-    bot.edit_message_text(
-        "❌ Запись отменена",
-        call.message.chat.id,
-        call.message.message_id
-    )
+    # Первый пинг — в фоне, когда сервер уже отвечает
+    if SELF_PING_URL and scheduler is not None:
+        scheduler.add_job(keep_alive)
+
+def startup():
+    """Подготовка процесса: БД, восстановление состояния, фоновые задачи.
+
+    Вызывается один раз в каждом процессе, который обслуживает запросы
+    (в воркерах gunicorn — после fork).
+    """
+    global _started, accepting_updates, scheduler
+    with _lifecycle_lock:
+        if _started:
+            return
+        _started = True
+        accepting_updates = True
+    
+    # Инициализация БД
+    init_db()
+    
+    if chat_shards.enabled:
+        slot = chat_shards.claim()
+        update_deduplicator.meta_key = f"last_update_id:{slot}"
+        telegram_sender.set_global_rate(TELEGRAM_GLOBAL_RATE / chat_shards.count)
+    
+    # Восстанавливаем незавершённые записи после перезапуска
+    restored = user_states.load(owns=chat_shards.owns if chat_shards.enabled else None)
+    if restored:
+        print(f"♻️ Восстановлено незавершённых записей: {restored}")
+    update_deduplicator.load()
+    
+    update_dispatcher.start()
+    if chat_shards.enabled:
+        chat_shards.start()
+    # Досылаем уведомления, оставшиеся в outbox с прошлого запуска
+    admin_notifier.start()
+    broadcast_engine.resume()
+    
+    # Запуск планировщика пингов (если есть URL для пинга)
+    scheduler = BackgroundScheduler()
+    if SELF_PING_URL:
+        scheduler.add_job(keep_alive, 'interval', minutes=5)
+        print("⏰ Планировщик пингов запущен (каждые 5 минут)")
+    else:
+        print("ℹ️ Пинги отключены (нет SELF_PING_URL)")
+    scheduler.add_job(broadcast_engine.resume, 'interval', seconds=BroadcastEngine.LEASE_SECONDS)
+    if ARCHIVE_AFTER_DAYS > 0:
+        # Первый перенос — через минуту, чтобы не занимать БД во время старта
+        scheduler.add_job(
+            booking_archiver.run, 'interval', minutes=ARCHIVE_INTERVAL_MINUTES,
+            next_run_time=datetime.now() + timedelta(minutes=1)
+        )
+    scheduler.start()
+    
+    atexit.register(shutdown)
+
+def shutdown(timeout=SHUTDOWN_TIMEOUT):
+    """Плавная остановка: перестаём принимать обновления и дорабатываем очередь"""
+    global _started, accepting_updates
+    with _lifecycle_lock:
+        if not _started:
+            return
+        _started = False
+        accepting_updates = False
+    server_ready.clear()
+    
+    print("🛑 Останавливаюсь, дорабатываю принятые обновления...")
+    update_poller.stop()
+    chat_shards.stop()
+    if not update_dispatcher.wait_idle(timeout):
+        logger.warning(f"⚠️ Не все обновления обработаны за {timeout} с: {update_dispatcher.pending}")
+    update_poller.save_offset()
+    
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
+    booking_archiver.stop()
+    admin_notifier.stop(timeout)
+    broadcast_engine.stop(timeout)
+    user_states.flush()
+    update_deduplicator.flush()
+    # Шард отпускаем после сброса состояний: новый владелец прочитает их целиком
+    chat_shards.release()
+    db_writer.stop(timeout)
+    close_db()
+    print("✅ Остановка завершена")
+
+def create_app(source='wsgi'):
+    """Фабрика WSGI-приложения для продакшн-сервера.
+
+    gunicorn -w 2 --threads 8 'bot_final:create_app()'
+    waitress-serve --port=10000 --call bot_final:create_app
+
+    Сервер вызывает фабрику, когда порт уже открыт (у gunicorn его держит
+    мастер) или сразу перед открытием, поэтому процесс здесь же отмечается
+    готовым.
+    """
+    startup()
+    mark_ready(source)
+    return app
+
+def set_webhook_when_ready(fallback):
+    """Поставить webhook в фоне, когда сервер уже слушает порт.
+
+    Раньше Telegram слал бы обновления на закрытый порт и откладывал
+    повторы. Если webhook поставить не удалось, вызывается fallback.
+    """
+    def setup():
+        server_ready.wait()
+        if set_webhook():
+            print("✅ Webhook успешно установлен!")
+            print("⏳ Бот будет получать обновления через webhook")
+        else:
+            fallback()
+    
+    threading.Thread(target=setup, name="webhook-setup", daemon=True).start()
+
+def switch_to_polling():
+    """Webhook не установлен: обновления забираем polling, сервер продолжает отвечать"""
+    print("❌ Не удалось установить webhook, переключаюсь на polling...")
+    fallback_to_polling()
+
+def retry_webhook():
+    """Webhook не установлен: повторяем с растущей паузой.
+
+    В воркерах gunicorn polling не запускаем — несколько процессов с
+    getUpdates мешали бы друг другу.
+    """
+    delay = 5
+    while _started:
+        logger.warning(f"⚠️ Повтор установки webhook через {delay} с")
+        time.sleep(delay)
+        if set_webhook():
+            return
+        delay = min(300, delay * 2)
 
 # ================== ЗАПУСК СЕРВЕРА ==================
 def run_flask():
-    """Запуск Flask сервера"""
-    port = int(os.environ.get('PORT', 10000))
-    print(f"🌐 Запускаю Flask сервер на порту {port}...")
-    app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
+    """Запуск Flask сервера (встроенный сервер Werkzeug)"""
+    print(f"🌐 Запускаю Flask сервер на порту {PORT}...")
+    # make_server открывает сокет сразу: после этого соединения уже
+    # встают в очередь, и процесс можно считать готовым
+    server = make_server('0.0.0.0', PORT, app, threaded=True)
+    mark_ready('werkzeug')
+    server.serve_forever()
+
+def handle_sigterm():
+    """SIGTERM (остановка на Render) — плавное завершение вместо мгновенного"""
+    def on_sigterm(signum, frame):
+        shutdown()
+        sys.exit(0)
+    
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+def _resolve_server_backend():
+    if SERVER_BACKEND != 'auto':
+        return SERVER_BACKEND
+    if os.name != 'nt':
+        try:
+            import gunicorn  # noqa: F401
+            return 'gunicorn'
+        except ImportError:
+            pass
+    try:
+        import waitress  # noqa: F401
+        return 'waitress'
+    except ImportError:
+        return 'werkzeug'
+
+def run_gunicorn(use_webhook=False):
+    """gunicorn с WEB_CONCURRENCY процессами и WEB_THREADS потоками в каждом"""
+    from gunicorn.app.base import BaseApplication
+    
+    class BotApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"0.0.0.0:{PORT}")
+            self.cfg.set('workers', WEB_CONCURRENCY)
+            self.cfg.set('threads', WEB_THREADS)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('graceful_timeout', int(SHUTDOWN_TIMEOUT))
+            self.cfg.set('worker_exit', lambda server, worker: shutdown())
+
+        def load(self):
+            telegram_sender.reset_connections()
+            wsgi_app = create_app('gunicorn')
+            if use_webhook:
+                set_webhook_when_ready(retry_webhook)
+            return wsgi_app
+    
+    if CHAT_SHARDS > 1 and WEB_CONCURRENCY > CHAT_SHARDS:
+        # Лишние воркеры навсегда остались бы в ChatShards.claim()
+        raise SystemExit(
+            f"❌ CHAT_SHARDS={CHAT_SHARDS} меньше WEB_CONCURRENCY={WEB_CONCURRENCY}: "
+            f"нужен хотя бы один шард на процесс"
+        )
+    print(f"🌐 gunicorn: порт {PORT}, процессов {WEB_CONCURRENCY}, потоков {WEB_THREADS}")
+    if WEB_CONCURRENCY < CHAT_SHARDS:
+        logger.info(
+            f"ℹ️ CHAT_SHARDS={CHAT_SHARDS} больше процессов здесь ({WEB_CONCURRENCY}): "
+            f"остальные шарды ждут другие инстансы, без владельца их чаты обрабатываются на месте"
+        )
+    BotApplication().run()
+
+def run_waitress(use_webhook=False):
+    """waitress: один процесс с WEB_THREADS потоками"""
+    from waitress import create_server
+    
+    handle_sigterm()
+    startup()
+    if use_webhook:
+        set_webhook_when_ready(switch_to_polling)
+    print(f"🌐 waitress: порт {PORT}, потоков {WEB_THREADS}")
+    server = create_server(app, host='0.0.0.0', port=PORT, threads=WEB_THREADS)
+    mark_ready('waitress')
+    server.run()
+
+def run_server(use_webhook=False):
+    """Запуск HTTP-сервера в текущем потоке; webhook ставится, когда порт открыт"""
+    backend = _resolve_server_backend()
+    if backend == 'gunicorn':
+        run_gunicorn(use_webhook)
+    elif backend == 'waitress':
+        run_waitress(use_webhook)
+    else:
+        handle_sigterm()
+        startup()
+        if use_webhook:
+            set_webhook_when_ready(switch_to_polling)
+        run_flask()
 
 # ================== ЗАПУСК БОТА ==================
 def run_bot():
     """Запуск Telegram бота с поддержкой webhook/polling"""
     print("🤖 Инициализация бота...")
     
-    # Всегда удаляем старый webhook перед запуском
-    try:
-        bot.remove_webhook()
-        time.sleep(1)
-        print("✅ Старый webhook удалён")
-    except Exception as e:
-        print(f"⚠️ Ошибка удаления webhook: {e}")
-    
     # Определяем режим работы
     use_webhook = bool(WEBHOOK_URL and SELF_PING_URL)
     
@@ -609,27 +4637,33 @@ def run_bot():
         print("🌐 Настраиваю работу через webhook...")
         print(f"📡 Webhook URL: {WEBHOOK_URL}/webhook")
         
-        # Пытаемся установить webhook
-        if set_webhook():
-            print("✅ Webhook успешно установлен!")
-            print("⏳ Бот будет получать обновления через webhook")
-            
-            # Просто держим программу активной
-            while True:
-                time.sleep(3600)  # Спим 1 час
-        else:
-            print("❌ Не удалось установить webhook, переключаюсь на polling...")
-            fallback_to_polling()
+        # HTTP-сервер в главном потоке до остановки процесса; webhook
+        # ставится после открытия порта, при неудаче — переход на polling
+        run_server(use_webhook=True)
     else:
         print("🔄 Webhook URL не указан, использую polling...")
-        fallback_to_polling()
+        run_polling()
+
+def run_polling():
+    """Polling, а Flask в отдельном потоке отвечает на /health и /status"""
+    handle_sigterm()
+    startup()
+    flask_thread = threading.Thread(target=run_flask, daemon=True)
+    flask_thread.start()
+    print("🌐 Flask сервер запущен в отдельном потоке")
+    fallback_to_polling()
 
 def fallback_to_polling():
     """Переход на polling метод"""
     print("🔄 Запускаю polling...")
-    bot.remove_webhook()
-    time.sleep(2)
-    bot.polling(none_stop=True, interval=0, timeout=30)
+    # getUpdates не работает при активном webhook; удаляем его, только если он есть
+    try:
+        if bot.get_webhook_info().url:
+            bot.remove_webhook()
+            print("✅ Старый webhook удалён")
+    except Exception as e:
+        print(f"⚠️ Ошибка удаления webhook: {e}")
+    update_poller.run()
 
 # ================== ОСНОВНОЙ БЛОК ==================
 if __name__ == "__main__":
@@ -642,29 +4676,10 @@ if __name__ == "__main__":
     print(f"🏓 Ping URL: {SELF_PING_URL or '❌ Не установлен'}")
     print("=" * 50)
     
-    # Инициализация БД
+    # Миграции — один раз до запуска воркеров; соединение закрываем,
+    # чтобы оно не досталось дочерним процессам после fork
     init_db()
-    
-    # Запуск планировщика пингов (если есть URL для пинга)
-    if SELF_PING_URL:
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(keep_alive, 'interval', minutes=5)
-        scheduler.start()
-        print("⏰ Планировщик пингов запущен (каждые 5 минут)")
-    else:
-        print("ℹ️ Пинги отключены (нет SELF_PING_URL)")
-    
-    # Первый пинг (если настроено)
-    if SELF_PING_URL:
-        keep_alive()
-    
-    # Запуск Flask в отдельном потоке
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    print("🌐 Flask сервер запущен в отдельном потоке")
-    
-    # Ждём запуска сервера
-    time.sleep(2)
+    close_db()
     
     # Запуск бота
     run_bot()
@@ -0,0 +1,44 @@
+"""Общие фикстуры тестов: bot_final на временной базе"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+# До импорта bot_final: настройки читаются при импорте модуля
+_tmp_dir = tempfile.mkdtemp(prefix="bot_tests_")
+os.environ.setdefault("DB_NAME", os.path.join(_tmp_dir, "bot.db"))
+os.environ.setdefault("TELEGRAM_API_URL", "http://127.0.0.1:9")  # наружу тесты не ходят
+os.environ.setdefault("LOG_FORMAT", "text")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot_final  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Чистая база со всеми миграциями на каждый тест"""
+    bot_final.db_writer.stop(5)
+    bot_final.close_db()
+    monkeypatch.setattr(bot_final, "DB_NAME", str(tmp_path / "bot.db"))
+    bot_final.init_db()
+    yield bot_final
+    bot_final.db_writer.stop(5)
+    bot_final.close_db()
+
+
+@pytest.fixture
+def sql_log(db, monkeypatch):
+    """SQL всех новых соединений с подставленными параметрами"""
+    statements = []
+    connect = bot_final._connect_db
+    
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(statements.append)
+        return conn
+    
+    bot_final.close_db()
+    monkeypatch.setattr(bot_final, "_connect_db", traced_connect)
+    return statements
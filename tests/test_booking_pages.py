@@ -0,0 +1,135 @@
+"""«Мои записи»: keyset-страницы по bookings и bookings_archive"""
+from types import SimpleNamespace
+
+import pytest
+
+import bot_final
+
+USER_ID = 1001
+TOTAL = 25
+
+
+@pytest.fixture
+def history(db):
+    """TOTAL записей клиента по одной в день; старшие перенесены в архив"""
+    for i in range(TOTAL):
+        bot_final.db_writer.submit(
+            bot_final.create_booking, USER_ID, "Иванов Иван", "+7 900 000-00-01", 1 + i % 4
+        ).result(timeout=10)
+    with bot_final.db_transaction() as cursor:
+        # Чужая запись не должна попасть в историю
+        cursor.execute("INSERT INTO clients (user_id, full_name, phone) VALUES (2002, 'Другой', '1')")
+        cursor.execute("INSERT INTO bookings (client_id, filial_id) VALUES (last_insert_rowid(), 1)")
+        cursor.execute(
+            "UPDATE bookings SET created_at = datetime('2024-01-01', id || ' days') "
+            "WHERE client_id = (SELECT id FROM clients WHERE user_id = ?)", (USER_ID,)
+        )
+        # Две записи с одинаковым временем: порядок решает id
+        cursor.execute("UPDATE bookings SET created_at = '2024-01-10 00:00:00' WHERE id IN (10, 11)")
+    archived, _ = bot_final.db_writer.submit(
+        bot_final.booking_archiver._move_batch, "2024-01-15", "2024-01-15", ("", 0)
+    ).result(timeout=10)
+    assert archived == 13
+    client_id = bot_final.db_fetchone("SELECT id FROM clients WHERE user_id = ?", (USER_ID,))[0]
+    expected = [
+        row[0] for row in bot_final.db_fetchall(
+            "SELECT id, created_at FROM bookings_all WHERE client_id = ? "
+            "ORDER BY created_at DESC, id DESC", (client_id,)
+        )
+    ]
+    return client_id, expected
+
+
+def cursor_of(row):
+    return row[3], row[0]
+
+
+def test_older_pages_walk_into_archive(history):
+    client_id, expected = history
+
+    rows, has_older = bot_final.fetch_bookings_page(client_id)
+    pages = [rows]
+    while has_older:
+        rows, has_older = bot_final.fetch_bookings_page(client_id, 'older', cursor_of(rows[-1]))
+        pages.append(rows)
+
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [row[0] for page in pages for row in page] == expected
+
+
+def test_newer_pages_walk_back_from_archive(history):
+    client_id, expected = history
+    oldest = bot_final.db_fetchone(
+        "SELECT id, NULL, NULL, created_at FROM bookings_archive ORDER BY created_at, id LIMIT 1"
+    )
+
+    rows, has_newer = bot_final.fetch_bookings_page(client_id, 'newer', cursor_of(oldest))
+    pages = [rows]
+    while has_newer:
+        rows, has_newer = bot_final.fetch_bookings_page(client_id, 'newer', cursor_of(rows[0]))
+        pages.insert(0, rows)
+
+    assert [row[0] for page in pages for row in page] == expected[:-1]
+
+
+def test_cursor_round_trip(history):
+    client_id, _ = history
+    first, _ = bot_final.fetch_bookings_page(client_id)
+
+    token = bot_final.encode_booking_cursor(*cursor_of(first[-1]))
+
+    assert bot_final.decode_booking_cursor(token) == cursor_of(first[-1])
+
+
+@pytest.mark.parametrize("created_at", [
+    "2024-05-01 10:00:00",
+    "2024-05-01 10:00:00.250",
+    "2024-05-01T10:00:00+03:00",
+])
+def test_cursor_keeps_created_at_exactly(created_at):
+    token = bot_final.encode_booking_cursor(created_at, 42)
+
+    assert len(f"bookings_older_{token}".encode()) <= 64
+    assert bot_final.decode_booking_cursor(token) == (created_at, 42)
+
+
+@pytest.mark.parametrize("token", ["", "garbage", "2024_x", "_42", "abcd-05-01_42", "1" * 40 + "_42"])
+def test_broken_cursor_is_rejected(token):
+    assert bot_final.decode_booking_cursor(token) is None
+
+
+def test_fractional_seconds_do_not_skip_bookings(history):
+    client_id, expected = history
+    with bot_final.db_transaction() as cursor:
+        cursor.execute(
+            "UPDATE bookings SET created_at = created_at || '.' || printf('%03d', id) "
+            "WHERE client_id = ?", (client_id,)
+        )
+
+    rows, has_older = bot_final.fetch_bookings_page(client_id)
+    pages = [rows]
+    while has_older:
+        token = bot_final.encode_booking_cursor(*cursor_of(rows[-1]))
+        rows, has_older = bot_final.fetch_bookings_page(
+            client_id, 'older', bot_final.decode_booking_cursor(token)
+        )
+        pages.append(rows)
+
+    assert [row[0] for page in pages for row in page] == expected
+
+
+def test_unreadable_cursor_shows_first_page(history, monkeypatch):
+    client_id, expected = history
+    edited = []
+    monkeypatch.setattr(
+        bot_final.bot, "edit_message_text", lambda text, *args, **kwargs: edited.append(text)
+    )
+    call = SimpleNamespace(
+        data="bookings_older_garbage",
+        from_user=SimpleNamespace(id=USER_ID),
+        message=SimpleNamespace(chat=SimpleNamespace(id=USER_ID), message_id=1),
+    )
+
+    bot_final.browse_my_bookings(call)
+
+    assert f"#{expected[0]}" in edited[0]
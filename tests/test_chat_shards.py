@@ -0,0 +1,123 @@
+"""Шарды чатов: пересылка владельцу и шарды без владельца"""
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot_final
+
+
+def raw_update(update_id, chat_id):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'},
+            'text': 'hi',
+        },
+    })
+
+
+@pytest.fixture
+def shards(db, monkeypatch):
+    """Этот процесс владеет шардом 0 из 2"""
+    shared = bot_final.SqliteSharedState()
+    shards = bot_final.ChatShards(shared, 2, 30)
+    assert shards.claim() == 0
+    monkeypatch.setattr(bot_final, "chat_shards", shards)
+    return shards
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    """Обновления, дошедшие до обработчика в этом процессе"""
+    updates = SimpleNamespace(ids=[], done=threading.Event())
+
+    def handler(update):
+        updates.ids.append(update.update_id)
+        updates.done.set()
+
+    monkeypatch.setattr(bot_final, "update_dispatcher", bot_final.UpdateDispatcher(handler, 2, 10))
+    monkeypatch.setattr(bot_final, "update_deduplicator", bot_final.UpdateDeduplicator(100, 3600, 86400))
+    monkeypatch.setattr(bot_final, "accepting_updates", True)
+    return updates
+
+
+def post(update):
+    return bot_final.app.test_client().post(
+        '/webhook', data=update, headers={'content-type': 'application/json'}
+    )
+
+
+def test_forward_to_live_owner(shards, handled):
+    shards.shared.add("shard:1", "other-process", 30)
+
+    update = raw_update(1, 1)
+
+    assert post(update).status_code == 200
+
+    assert shards.shared.pop("inbox:1", 10, 1) == [update]
+    assert handled.ids == []
+
+
+def test_unowned_shard_is_handled_locally(shards, handled):
+    assert post(raw_update(2, 1)).status_code == 200
+
+    assert handled.done.wait(5)
+    assert handled.ids == [2]
+    assert shards.shared.pop("inbox:1", 10, 0.1) == []
+
+
+def test_own_chat_is_handled_locally(shards, handled):
+    assert post(raw_update(3, 2)).status_code == 200
+
+    assert handled.done.wait(5)
+    assert handled.ids == [3]
+
+
+@pytest.fixture
+def heartbeat(shards, monkeypatch):
+    """Продление аренды с короткой арендой; os.kill только записывается"""
+    kills = []
+    monkeypatch.setattr(bot_final.os, "kill", lambda pid, sig: kills.append(sig))
+    shards.lease_seconds = 0.3
+    thread = threading.Thread(target=shards._heartbeat, daemon=True)
+    thread.start()
+    yield kills
+    shards._stopping.set()
+    thread.join(5)
+
+
+def test_busy_db_does_not_drop_lease(shards, heartbeat, monkeypatch):
+    monkeypatch.setattr(bot_final, "DB_BUSY_TIMEOUT_MS", 50)
+    other = bot_final.sqlite3.connect(bot_final.DB_NAME, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        time.sleep(1.5)  # блокировка дольше нескольких аренд
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    time.sleep(0.5)
+
+    assert heartbeat == []
+    assert shards.shared.get("shard:0") == shards.owner
+
+
+def test_free_expired_lease_is_taken_back(shards, heartbeat):
+    shards.shared.delete("shard:0")
+    time.sleep(0.5)
+
+    assert heartbeat == []
+    assert shards.shared.get("shard:0") == shards.owner
+
+
+def test_lease_taken_by_other_process_stops_worker(shards, heartbeat):
+    shards.shared.delete("shard:0")
+    assert shards.shared.add("shard:0", "other-process", 30)
+    time.sleep(0.5)
+
+    assert heartbeat == [bot_final.signal.SIGTERM]
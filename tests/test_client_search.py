@@ -0,0 +1,98 @@
+"""Поиск клиентов (/find): нормализация телефона, ФИО по началу слов, архив"""
+import pytest
+
+import bot_final
+
+CLIENTS = {
+    1001: ("Иванов Иван Петрович", "+7 (916) 123-45-67"),
+    1002: ("Фёдоров Алексей", "8 916 765 43 21"),
+    1003: ("Иванова Мария", "+7 903 111-22-33"),
+    1004: ("Smith John", "+44 20 7946 0958"),
+    1005: ("Петров Сергей", "8 (917) 000-00-00"),
+}
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("+7 (916) 123-45-67", "+79161234567"),
+    ("8 916 123 45 67", "+79161234567"),
+    ("7(916)1234567", "+79161234567"),
+    ("89161234567", "+79161234567"),
+    ("9161234567", "+79161234567"),
+    ("  +79161234567 ", "+79161234567"),
+    ("+44 20 7946 0958", "+442079460958"),
+    ("+380 (44) 123-45-67", "+380441234567"),
+    ("8916123456", None),  # 10 цифр, но не с 9
+    ("891612345678", None),  # 12 цифр без '+'
+    ("916123456", None),  # 9 цифр
+    ("+1234567", None),  # короче 8 цифр
+    ("+1234567890123456", None),  # длиннее 15 цифр
+    ("+0123456789", None),  # код страны не начинается с 0
+    ("abc", None),
+    ("", None),
+    (None, None),
+])
+def test_normalize_phone(raw, expected):
+    assert bot_final.normalize_phone(raw) == expected
+
+
+@pytest.fixture
+def clients(db):
+    """Клиенты с записями; записи Ивановой Марии перенесены в архив"""
+    for user_id, (full_name, phone) in CLIENTS.items():
+        bot_final.db_writer.submit(bot_final.create_booking, user_id, full_name, phone, 1).result(timeout=5)
+    with bot_final.db_transaction() as cursor:
+        cursor.execute(
+            "UPDATE bookings SET created_at = '2024-01-01 10:00:00' "
+            "WHERE client_id = (SELECT id FROM clients WHERE user_id = 1003)"
+        )
+    archived, _ = bot_final.db_writer.submit(
+        bot_final.booking_archiver._move_batch, "2024-02-01", "2024-02-01", ("", 0)
+    ).result(timeout=5)
+    assert archived == 1
+
+
+def found(query):
+    return sorted(user_id for _, _, _, user_id, _, _ in bot_final.find_clients(query))
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("Иван", [1001, 1003]),
+    ("иванов пет", [1001]),
+    ("Иванова", [1003]),
+    ("Фёдоров", [1002]),
+    ("федоров", [1002]),
+    ("ФЁД", [1002]),
+    ("Алексей Фед", [1002]),
+    ("smi", [1004]),
+    ("Сидоров", []),
+])
+def test_find_by_name_prefix(clients, query, expected):
+    assert found(query) == expected
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("8916", [1001, 1002]),
+    ("+7 916", [1001, 1002]),
+    ("916 123", [1001]),
+    ("8 (917)", [1005]),
+    ("+4420", [1004]),
+    ("+7903111", [1003]),
+    ("8999", []),
+])
+def test_find_by_phone_range(clients, query, expected):
+    assert found(query) == expected
+
+
+def test_find_needs_three_phone_digits(clients):
+    with pytest.raises(ValueError):
+        bot_final.find_clients("12")
+
+
+def test_archived_client_is_found_with_history(clients):
+    (row,) = bot_final.find_clients("Иванова")
+    client_id, full_name, phone, user_id, total, last_at = row
+
+    assert (full_name, phone, user_id) == ("Иванова Мария", "+79031112233", 1003)
+    assert total == 1
+    assert last_at == "2024-01-01 10:00:00"
+    assert bot_final.db_fetchone("SELECT COUNT(*) FROM bookings WHERE client_id = ?", (client_id,)) == (0,)
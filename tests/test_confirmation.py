@@ -0,0 +1,91 @@
+"""Подтверждение записи: повторное «Да» не создаёт вторую запись"""
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import bot_final
+
+USER_ID = 1001
+
+
+@pytest.fixture
+def confirming(db, monkeypatch):
+    """Пользователь на шаге подтверждения; ответы бота записываются"""
+    replies = SimpleNamespace(edited=[], alerts=[])
+    monkeypatch.setattr(
+        bot_final.bot, "edit_message_text", lambda text, *args, **kwargs: replies.edited.append(text)
+    )
+    monkeypatch.setattr(
+        bot_final.bot, "answer_callback_query",
+        lambda callback_id, text=None, **kwargs: replies.alerts.append(text)
+    )
+    monkeypatch.setattr(bot_final.admin_notifier, "wake", lambda: None)
+    bot_final.user_states.set(USER_ID, {
+        'filial_id': 1,
+        'filial_name': 'Филиал',
+        'filial_address': 'Адрес',
+        'full_name': 'Иванов Иван',
+        'phone': '+79000000001',
+        'confirmation': 'token-1',
+        'step': 'waiting_confirmation',
+    })
+    yield replies
+    bot_final.user_states.pop(USER_ID)
+
+
+def tap_yes():
+    bot_final.process_confirmation(SimpleNamespace(
+        id="1",
+        data="confirm_yes",
+        from_user=SimpleNamespace(id=USER_ID),
+        message=SimpleNamespace(chat=SimpleNamespace(id=USER_ID), message_id=1),
+    ))
+
+
+def counts():
+    return (
+        bot_final.db_fetchone("SELECT COUNT(*) FROM bookings")[0],
+        bot_final.db_fetchone("SELECT COUNT(*) FROM notification_outbox")[0],
+    )
+
+
+def test_same_confirmation_saves_once(confirming):
+    user_data = bot_final.user_states.get(USER_ID)
+
+    first = bot_final.db_writer.submit(bot_final.save_booking, USER_ID, user_data).result(timeout=5)
+    second = bot_final.db_writer.submit(bot_final.save_booking, USER_ID, user_data).result(timeout=5)
+
+    assert first == second
+    assert counts() == (1, 1)
+
+
+def test_tap_after_writer_timeout_does_not_duplicate(confirming, monkeypatch):
+    monkeypatch.setattr(bot_final, "DB_WRITER_TIMEOUT", 0.2)
+    release = threading.Event()
+    busy = bot_final.db_writer.exclusive(lambda conn: release.wait(5))
+
+    tap_yes()  # писатель занят — ответа не дождались, запись осталась в очереди
+
+    assert confirming.alerts and "ещё раз" in confirming.alerts[0]
+    assert confirming.edited == []
+    assert USER_ID in bot_final.user_states
+
+    release.set()
+    busy.result(timeout=5)
+    monkeypatch.setattr(bot_final, "DB_WRITER_TIMEOUT", 5)
+    tap_yes()
+
+    assert counts() == (1, 1)
+    assert "ЗАПИСЬ УСПЕШНО СОЗДАНА" in confirming.edited[0]
+    assert USER_ID not in bot_final.user_states
+
+
+def test_new_confirmation_is_new_booking(confirming):
+    user_data = bot_final.user_states.get(USER_ID)
+    tap_yes()
+
+    bot_final.user_states.set(USER_ID, {**user_data, 'confirmation': 'token-2'})
+    tap_yes()
+
+    assert counts() == (2, 2)
@@ -0,0 +1,139 @@
+"""Поток-писатель и транзакции: ошибки не оставляют висящих Future и транзакций"""
+import sqlite3
+import threading
+import time
+from concurrent.futures import wait
+
+import pytest
+
+import bot_final
+
+
+def put_meta(key):
+    def operation(cursor):
+        cursor.execute("INSERT INTO bot_meta (key, value) VALUES (?, '1')", (key,))
+        return key
+    return operation
+
+
+def test_batch_fails_every_future_when_begin_is_busy(db, monkeypatch):
+    monkeypatch.setattr(bot_final, "DB_BUSY_TIMEOUT_MS", 100)
+    other = sqlite3.connect(bot_final.DB_NAME, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        futures = [bot_final.db_writer.submit(put_meta(f"busy_{i}")) for i in range(3)]
+        done, not_done = wait(futures, timeout=5)
+        assert not not_done
+        for future in done:
+            with pytest.raises(sqlite3.OperationalError):
+                future.result()
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+    # Блокировку отпустили — писатель работает дальше
+    assert bot_final.db_writer.submit(put_meta("after")).result(timeout=5) == "after"
+    assert bot_final.db_fetchone("SELECT value FROM bot_meta WHERE key = 'after'") == ("1",)
+
+
+def test_failed_operation_does_not_roll_back_batch(db):
+    def broken(cursor):
+        raise ValueError("сбой операции")
+
+    ok = bot_final.db_writer.submit(put_meta("ok"))
+    bad = bot_final.db_writer.submit(broken)
+
+    assert ok.result(timeout=5) == "ok"
+    with pytest.raises(ValueError):
+        bad.result(timeout=5)
+
+
+def test_failed_commit_leaves_no_open_transaction(db):
+    conn = bot_final.get_db()
+    conn.execute("PRAGMA foreign_keys=ON")
+    try:
+        with pytest.raises(sqlite3.IntegrityError):
+            with bot_final.db_transaction() as cursor:
+                # Проверка внешних ключей отложена до COMMIT — он и падает
+                cursor.execute("PRAGMA defer_foreign_keys=ON")
+                cursor.execute("INSERT INTO bookings (client_id, filial_id) VALUES (999999, 1)")
+        assert not conn.in_transaction
+    finally:
+        conn.execute("PRAGMA foreign_keys=OFF")
+
+    with bot_final.db_transaction() as cursor:
+        cursor.execute("INSERT INTO bot_meta (key, value) VALUES ('after_commit', '1')")
+    assert bot_final.db_fetchone("SELECT COUNT(*) FROM bookings")[0] == 0
+
+
+def test_connect_to_existing_db_does_not_need_write_lock(db, monkeypatch):
+    assert bot_final.get_db().execute("PRAGMA auto_vacuum").fetchone()[0] == 2  # INCREMENTAL
+    monkeypatch.setattr(bot_final, "DB_BUSY_TIMEOUT_MS", 100)
+    other = sqlite3.connect(bot_final.DB_NAME, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        conn = bot_final._connect_db()
+        assert conn.execute("SELECT COUNT(*) FROM filials").fetchone()[0] > 0
+        conn.close()
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+
+def test_exclusive_operation_holds_later_writes(db):
+    release = threading.Event()
+    before = bot_final.db_writer.submit(put_meta("before"))
+    exclusive = bot_final.db_writer.exclusive(lambda conn: release.wait(5) and conn.in_transaction)
+    after = bot_final.db_writer.submit(put_meta("after"))
+
+    assert before.result(timeout=5) == "before"
+    time.sleep(0.2)
+    assert not after.done()
+
+    release.set()
+    assert exclusive.result(timeout=5) is False  # вне транзакции
+    assert after.result(timeout=5) == "after"
+
+
+def auto_vacuum():
+    return bot_final.get_db().execute("SELECT * FROM pragma_auto_vacuum").fetchone()[0]
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    """Существующий файл, созданный без auto_vacuum"""
+    bot_final.db_writer.stop(5)
+    bot_final.close_db()
+    path = tmp_path / "legacy.db"
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA auto_vacuum=NONE")
+    conn.execute("CREATE TABLE filler (data BLOB)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(bot_final, "DB_NAME", str(path))
+    bot_final.init_db()
+    yield bot_final.BookingArchiver(180, 30, "cancelled,done", 500, 256)
+    bot_final.db_writer.stop(5)
+    bot_final.close_db()
+
+
+def test_vacuum_conversion_needs_opt_in(legacy_db):
+    assert legacy_db.vacuum() == 0
+    assert auto_vacuum() == 0
+
+
+def test_vacuum_conversion_runs_on_writer(legacy_db, monkeypatch):
+    monkeypatch.setattr(bot_final, "DB_VACUUM_CONVERT", True)
+    threads = []
+    convert = bot_final.BookingArchiver._convert
+    monkeypatch.setattr(
+        bot_final.BookingArchiver, "_convert",
+        staticmethod(lambda conn: threads.append(threading.current_thread().name) or convert(conn))
+    )
+
+    legacy_db.vacuum()
+
+    assert threads == ["db-writer"]
+    assert auto_vacuum() == 2  # INCREMENTAL
+    legacy_db.vacuum()
+    assert threads == ["db-writer"]  # повторного VACUUM нет
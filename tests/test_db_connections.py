@@ -0,0 +1,61 @@
+"""Соединения с БД не копятся, когда каждый запрос идёт в новом потоке"""
+import os
+import threading
+
+import bot_final
+
+
+def in_new_thread(target):
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join(10)
+
+
+def open_files():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_request_threads_reuse_bounded_connections(db, monkeypatch):
+    monkeypatch.setattr(bot_final.stats_cache, "ttl", 0)
+    client = bot_final.app.test_client()
+    in_new_thread(lambda: client.get('/status'))
+    connections, files = len(bot_final._db_connections), open_files()
+
+    for _ in range(200):
+        in_new_thread(lambda: client.get('/status'))
+
+    assert len(bot_final._db_connections) <= connections + bot_final.DB_IDLE_CONNECTIONS
+    assert open_files() <= files + 3 * bot_final.DB_IDLE_CONNECTIONS
+
+
+def test_released_connection_is_reused_by_next_thread(db):
+    used = []
+
+    def work():
+        used.append(bot_final.get_db())
+        bot_final.release_db()
+
+    in_new_thread(work)
+    in_new_thread(work)
+
+    assert used[0] is used[1]
+
+
+def test_idle_connections_beyond_limit_are_closed(db, monkeypatch):
+    monkeypatch.setattr(bot_final, "DB_IDLE_CONNECTIONS", 1)
+    barrier = threading.Barrier(3)
+
+    def work():
+        bot_final.get_db()
+        barrier.wait(5)
+        bot_final.release_db()
+
+    threads = [threading.Thread(target=work) for _ in range(3)]
+    before = len(bot_final._db_connections)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(bot_final._db_idle) == 1
+    assert len(bot_final._db_connections) == before + 1
@@ -0,0 +1,62 @@
+"""Жизненный цикл процесса: готовность и порядок установки webhook"""
+import math
+import threading
+
+import pytest
+
+import bot_final
+
+
+@pytest.fixture
+def app_process(db):
+    """Процесс, поднятый через create_app(), как у gunicorn/waitress-serve"""
+    yield bot_final.create_app()
+    bot_final.shutdown(timeout=5)
+
+
+def test_create_app_marks_process_ready(app_process):
+    client = app_process.test_client()
+
+    assert client.get('/ready').status_code == 200
+    assert not math.isnan(bot_final.startup_seconds)
+
+
+def test_ready_is_503_after_shutdown(app_process):
+    bot_final.shutdown(timeout=5)
+
+    assert app_process.test_client().get('/ready').status_code == 503
+
+
+def test_webhook_is_set_only_after_server_is_ready(monkeypatch):
+    calls = []
+    called = threading.Event()
+    fallback = threading.Event()
+
+    def fake_set_webhook():
+        calls.append(bot_final.server_ready.is_set())
+        called.set()
+        return True
+
+    monkeypatch.setattr(bot_final, "set_webhook", fake_set_webhook)
+    monkeypatch.setattr(bot_final, "server_ready", threading.Event())
+
+    bot_final.set_webhook_when_ready(fallback.set)
+    assert not called.wait(0.2)
+
+    bot_final.server_ready.set()
+
+    assert called.wait(5)
+    assert calls == [True]
+    assert not fallback.is_set()
+
+
+def test_failed_webhook_calls_fallback(monkeypatch):
+    done = threading.Event()
+    ready = threading.Event()
+    ready.set()
+    monkeypatch.setattr(bot_final, "set_webhook", lambda: False)
+    monkeypatch.setattr(bot_final, "server_ready", ready)
+
+    bot_final.set_webhook_when_ready(done.set)
+
+    assert done.wait(5)
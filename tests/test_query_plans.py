@@ -0,0 +1,118 @@
+"""Горячие запросы идут по индексам (EXPLAIN QUERY PLAN).
+
+Планы строятся для того SQL, который реально выполняет код: sql_log
+перехватывает запросы с подставленными параметрами.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+import bot_final
+
+USER_ID = 1001
+
+
+def query_plan(sql):
+    rows = bot_final.get_db().execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    return " | ".join(row[-1] for row in rows)
+
+
+def assert_ordered_by_index(sql, index):
+    """Чтение идёт по index, и его результат не сортируется заново.
+
+    Слияние частей UNION ALL может сортировать уже ограниченные LIMIT
+    страницы — это не в счёт.
+    """
+    rows = bot_final.get_db().execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    searches = [parent for _, parent, _, detail in rows if f"USING INDEX {index} " in detail]
+    sorted_scopes = {parent for _, parent, _, detail in rows if "TEMP B-TREE" in detail}
+    assert searches, f"{index} не используется: {[row[-1] for row in rows]}"
+    assert not sorted_scopes & set(searches)
+
+
+def executed(statements, *fragments):
+    """Выполненные SELECT, в которых есть все фрагменты"""
+    found = [
+        sql for sql in statements
+        if sql.lstrip().upper().startswith("SELECT") and all(f in sql for f in fragments)
+    ]
+    assert found, f"не выполнялся запрос с {fragments}"
+    return found
+
+
+@pytest.fixture
+def bookings(db):
+    """Клиент с тремя страницами записей и соседи по базе"""
+    pages = 3 * bot_final.BOOKINGS_PAGE_SIZE
+    futures = [
+        bot_final.db_writer.submit(
+            bot_final.create_booking, USER_ID, "Иванов Иван", "+7 900 000-00-01", 1 + i % 4
+        )
+        for i in range(pages)
+    ]
+    futures += [
+        bot_final.db_writer.submit(
+            bot_final.create_booking, 2000 + i, f"Клиент {i}", f"+7 900 100-00-{i:02d}", 1
+        )
+        for i in range(20)
+    ]
+    for future in futures:
+        future.result(timeout=10)
+    return pages
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    messages = []
+    monkeypatch.setattr(
+        bot_final.bot, "send_message",
+        lambda chat_id, text, **kwargs: messages.append((text, kwargs))
+    )
+    return messages
+
+
+def test_upsert_client_reads_id_by_user_index(sql_log):
+    bot_final.db_writer.submit(
+        bot_final.create_booking, USER_ID, "Иванов Иван", "+7 900 000-00-01", 1
+    ).result(timeout=10)
+
+    for sql in executed(sql_log, "FROM clients WHERE user_id"):
+        assert "idx_clients_user_id" in query_plan(sql)
+
+
+def test_my_bookings_first_page_uses_indexes(bookings, sql_log, sent):
+    bot_final.booking_pages.invalidate(USER_ID)
+    message = SimpleNamespace(chat=SimpleNamespace(id=USER_ID), from_user=SimpleNamespace(id=USER_ID))
+
+    bot_final.show_my_bookings(message)
+
+    assert sent and "ВАШИ ЗАПИСИ" in sent[0][0]
+    for sql in executed(sql_log, "FROM clients WHERE user_id"):
+        assert "idx_clients_user_id" in query_plan(sql)
+    for sql in executed(sql_log, "FROM bookings b", "client_id"):
+        assert_ordered_by_index(sql, "idx_bookings_client_created")
+        assert_ordered_by_index(sql, "idx_bookings_archive_client_created")
+
+
+def test_my_bookings_keyset_pages_use_index(bookings, sql_log):
+    client_id = bot_final.db_fetchone("SELECT id FROM clients WHERE user_id = ?", (USER_ID,))[0]
+
+    first, has_older = bot_final.fetch_bookings_page(client_id)
+    assert has_older
+    last = first[-1]
+    older, _ = bot_final.fetch_bookings_page(client_id, 'older', (last[3], last[0]))
+    newest_older = older[0]
+    newer, _ = bot_final.fetch_bookings_page(client_id, 'newer', (newest_older[3], newest_older[0]))
+
+    assert [row[0] for row in newer] == [row[0] for row in first]
+    for sql in executed(sql_log, "FROM bookings b", "(b.created_at, b.id)"):
+        assert_ordered_by_index(sql, "idx_bookings_client_created")
+        assert_ordered_by_index(sql, "idx_bookings_archive_client_created")
+
+
+def test_export_by_filial_and_status_uses_index(bookings, sql_log):
+    body = b"".join(bot_final.export_stream('bookings', 'csv', {'filial': 1, 'status': 'new'}))
+
+    assert body.count(b"\n") > 1
+    for sql in executed(sql_log, "b.filial_id = 1", "b.status = 'new'"):
+        assert "idx_bookings_filial_status_created" in query_plan(sql)
@@ -0,0 +1,103 @@
+"""Общее состояние процессов: одинаковое поведение SQLite и Redis"""
+import time
+
+import pytest
+
+import bot_final
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def shared(request):
+    if request.param == "sqlite":
+        request.getfixturevalue("db")
+        return bot_final.SqliteSharedState()
+    fakeredis = pytest.importorskip("fakeredis")
+    return bot_final.RedisSharedState(fakeredis.FakeRedis(), prefix="test:")
+
+
+def test_incomplete_backend_fails_on_creation():
+    class NoQueues(bot_final.SharedState):
+        def add(self, key, value, ttl):
+            return True
+
+    with pytest.raises(TypeError):
+        NoQueues()
+
+
+def test_lease_is_exclusive_until_ttl(shared):
+    assert shared.add("lease", "a", 0.3)
+    assert not shared.add("lease", "b", 0.3)
+    assert shared.get("lease") == "a"
+
+    time.sleep(0.4)
+
+    assert shared.get("lease") is None
+    assert shared.add("lease", "b", 30)
+
+
+def test_renew_and_delete_only_by_owner(shared):
+    shared.add("lease", "a", 0.3)
+
+    assert not shared.renew("lease", "b", 30)
+    assert shared.renew("lease", "a", 30)
+    time.sleep(0.4)
+    assert shared.get("lease") == "a"
+
+    shared.delete("lease", "b")
+    assert shared.get("lease") == "a"
+    shared.delete("lease", "a")
+    assert shared.get("lease") is None
+
+
+def test_queue_keeps_order_and_limit(shared):
+    for i in range(5):
+        shared.push("inbox", f"m{i}")
+
+    assert shared.pop("inbox", 3, 1) == ["m0", "m1", "m2"]
+    assert shared.pop("inbox", 10, 1) == ["m3", "m4"]
+
+
+def test_pop_from_empty_queue_waits_and_returns_nothing(shared):
+    started = time.monotonic()
+
+    assert shared.pop("empty", 10, 0.1) == []
+    assert time.monotonic() - started < 3
+
+
+def test_state_backend_round_trip(shared):
+    backend = shared.state_backend()
+    now = time.time()
+
+    backend.save([(1, {'step': 'name'}, now + 60), (2, {'step': 'phone'}, now + 60)])
+    backend.delete([2], now)
+
+    assert backend.load(now) == [(1, {'step': 'name'}, pytest.approx(now + 60))]
+
+
+def test_redis_delete_keeps_lease_taken_over_meanwhile():
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server)
+    other = fakeredis.FakeRedis(server=server)
+    shared = bot_final.RedisSharedState(client, prefix="test:")
+    shared.add("lease", "a", 30)
+    pipeline = client.pipeline
+
+    def racing_pipeline(*args, **kwargs):
+        # Аренда истекает и достаётся другому процессу сразу после чтения
+        pipe = pipeline(*args, **kwargs)
+        read = pipe.get
+
+        def get(name):
+            value = read(name)
+            other.set(name, "b", px=30000)
+            return value
+
+        pipe.get = get
+        return pipe
+
+    client.pipeline = racing_pipeline
+
+    shared.delete("lease", "a")
+
+    assert shared.get("lease") == "b"
@@ -0,0 +1,84 @@
+"""Счётчики /status: триггеры совпадают с COUNT(*) по bookings и архиву"""
+import time
+
+import pytest
+
+import bot_final
+
+
+def recount():
+    """Счётчики, посчитанные заново по bookings_all и clients"""
+    expected = {"bookings": bot_final.db_fetchone("SELECT COUNT(*) FROM bookings_all")[0]}
+    expected["clients"] = bot_final.db_fetchone("SELECT COUNT(*) FROM clients")[0]
+    for prefix, column in (
+        ("status", "status"),
+        ("filial", "filial_id"),
+        ("day", "date(created_at, 'localtime')"),
+    ):
+        for name, count in bot_final.db_fetchall(
+            f"SELECT {column}, COUNT(*) FROM bookings_all GROUP BY 1"
+        ):
+            expected[f"{prefix}:{name}"] = count
+    return expected
+
+
+def counters():
+    """Ненулевые счётчики из таблицы stats"""
+    return dict(bot_final.db_fetchall("SELECT key, value FROM stats WHERE value != 0"))
+
+
+@pytest.fixture
+def local_utc_plus_3(monkeypatch):
+    """Процесс работает в UTC+3, как сервис"""
+    monkeypatch.setenv("TZ", "Etc/GMT-3")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_counters_follow_inserts_updates_deletes_and_archive(db, local_utc_plus_3):
+    for i in range(6):
+        bot_final.db_writer.submit(
+            bot_final.create_booking, 1000 + i % 3, f"Клиент {i}", f"+7 900 000-00-0{i}", 1 + i % 2
+        ).result(timeout=5)
+    assert counters() == recount()
+
+    with bot_final.db_transaction() as cursor:
+        # Около полуночи: по UTC ещё 1 мая, по местному времени уже 2-е
+        cursor.execute("UPDATE bookings SET created_at = '2024-05-01 22:30:00' WHERE id IN (1, 2)")
+        cursor.execute("UPDATE bookings SET created_at = '2024-05-01 20:30:00' WHERE id = 3")
+        cursor.execute("UPDATE bookings SET status = 'done' WHERE id IN (1, 4)")
+        cursor.execute("UPDATE bookings SET filial_id = 3 WHERE id = 5")
+    assert counters() == recount()
+    assert counters()["day:2024-05-02"] == 2
+    assert counters()["day:2024-05-01"] == 1
+
+    archived, _ = bot_final.db_writer.submit(
+        bot_final.booking_archiver._move_batch, "2024-06-01", "2024-06-01", ("", 0)
+    ).result(timeout=5)
+    assert archived == 3
+    assert counters() == recount()
+
+    with bot_final.db_transaction() as cursor:
+        cursor.execute("DELETE FROM bookings WHERE id = 6")
+        cursor.execute("DELETE FROM bookings_archive WHERE id = 1")
+    assert counters() == recount()
+    assert counters()["bookings"] == 4
+
+
+def test_today_is_local_date(db, local_utc_plus_3):
+    bot_final.db_writer.submit(
+        bot_final.create_booking, 1000, "Клиент", "+7 900 000-00-01", 1
+    ).result(timeout=5)
+    with bot_final.db_transaction() as cursor:
+        # Полчаса после и до местной полуночи: сегодняшняя только первая
+        for local_time in ("+30 minutes", "-30 minutes"):
+            cursor.execute(
+                "INSERT INTO bookings (client_id, filial_id, created_at) "
+                "VALUES (1, 1, datetime('now', 'localtime', 'start of day', ?, 'utc'))", (local_time,)
+            )
+    bot_final.stats_cache.invalidate()
+
+    assert bot_final.stats_cache.get()["bookings_today"] == 2
+    assert bot_final.app.test_client().get('/status').get_json()["bookings_today"] == 2
@@ -0,0 +1,185 @@
+"""Повторы запросов к Bot API: только когда повтор не задвоит сообщение.
+
+Запросы идут через telebot и TelegramSender в локальную заглушку Bot API
+(как TELEGRAM_API_URL в benchmark.py), которая отвечает по сценарию.
+"""
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+from telebot import apihelper
+
+import bot_final
+
+OK = (200, None)
+
+
+class ScriptedBotApiHandler(BaseHTTPRequestHandler):
+    """Отвечает на методы по сценарию server.script, остальное — успехом"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        length = int(self.headers.get("content-length") or 0)
+        if length:
+            self.rfile.read(length)
+        url = urlparse(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        # Порт клиента один и тот же, пока соединение переиспользуется
+        self.server.calls.append((method, self.client_address[1]))
+        script = self.server.script.get(method)
+        status, body = script.pop(0) if script else OK
+
+        if status == "hang":
+            self.server.release.wait(5)
+            self.close_connection = True
+            return
+        if status == "drop":
+            self.close_connection = True  # закрыть соединение, не ответив
+            return
+        if body is None:
+            if method == "sendMessage":
+                result = {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                    "text": params.get("text", ""),
+                }
+            elif method == "getWebhookInfo":
+                result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+            else:
+                result = True
+            body = json.dumps({"ok": True, "result": result})
+
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Заглушка Bot API; apihelper.API_URL указывает на неё"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedBotApiHandler)
+    server.calls = []
+    server.script = {}
+    server.release = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(apihelper, "API_URL", url + "/bot{0}/{1}")
+    yield SimpleNamespace(
+        url=url,
+        calls=server.calls,
+        script=server.script,
+        methods=lambda: [method for method, _ in server.calls],
+    )
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sender(monkeypatch):
+    """TelegramSender вместо общего; паузы перед повтором записываются"""
+    sender = bot_final.TelegramSender(4, 1000, 1000, 1000, 1000, max_retries=3)
+    sender.delays = []
+    monkeypatch.setattr(bot_final.time, "sleep", sender.delays.append)
+    monkeypatch.setattr(apihelper, "CUSTOM_REQUEST_SENDER", sender.request)
+    return sender
+
+
+def closed_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def test_rate_limit_waits_retry_after(api, sender):
+    api.script["sendMessage"] = [(429, '{"ok": false, "error_code": 429, "parameters": {"retry_after": 3}}')]
+
+    message = bot_final.bot.send_message(1, "hi")
+
+    assert message.text == "hi"
+    assert api.methods() == ["sendMessage", "sendMessage"]
+    assert 3 <= sender.delays[0] <= 3.5
+
+
+def test_server_error_is_repeated_for_read_methods(api, sender):
+    api.script["getWebhookInfo"] = [(502, "Bad Gateway"), (503, "Service Unavailable")]
+
+    bot_final.bot.get_webhook_info()
+
+    assert api.methods() == ["getWebhookInfo"] * 3
+
+
+@pytest.mark.parametrize("method, call", [
+    ("sendMessage", lambda: bot_final.bot.send_message(1, "hi")),
+    ("editMessageText", lambda: bot_final.bot.edit_message_text("hi", 1, 1)),
+])
+def test_server_error_is_not_repeated_for_sends(api, sender, method, call):
+    api.script[method] = [(502, "Bad Gateway")]
+
+    with pytest.raises(apihelper.ApiHTTPException):
+        call()
+
+    assert api.methods() == [method]
+
+
+def test_keep_alive_connection_is_reused(api, sender):
+    for _ in range(5):
+        bot_final.bot.send_message(1, "hi")
+    bot_final.bot.get_webhook_info()
+
+    assert len(api.calls) == 6
+    assert len({port for _, port in api.calls}) == 1
+
+
+def test_send_is_not_repeated_after_read_timeout(api, sender):
+    api.script["sendMessage"] = [("hang", None)]
+
+    with pytest.raises(requests.ReadTimeout):
+        sender.request("post", f"{api.url}/bot1:x/sendMessage", params={'chat_id': 1, 'text': "hi"}, timeout=0.2)
+
+    assert api.methods() == ["sendMessage"]
+
+
+def test_read_method_is_repeated_after_read_timeout(api, sender):
+    api.script["getWebhookInfo"] = [("hang", None)]
+
+    response = sender.request("get", f"{api.url}/bot1:x/getWebhookInfo", timeout=0.2)
+
+    assert response.status_code == 200
+    assert api.methods() == ["getWebhookInfo"] * 2
+
+
+def test_send_is_not_repeated_after_dropped_connection(api, sender):
+    api.script["sendMessage"] = [("drop", None)]
+
+    with pytest.raises(requests.ConnectionError):
+        bot_final.bot.send_message(1, "hi")
+
+    assert api.methods() == ["sendMessage"]
+
+
+def test_refused_connection_is_repeated_until_max_retries(api, sender, monkeypatch):
+    monkeypatch.setattr(apihelper, "API_URL", f"http://127.0.0.1:{closed_port()}/bot{{0}}/{{1}}")
+
+    with pytest.raises(requests.ConnectionError):
+        bot_final.bot.send_message(1, "hi")
+
+    assert len(sender.delays) == sender.max_retries
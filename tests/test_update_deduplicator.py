@@ -0,0 +1,89 @@
+"""Дедупликация обновлений: LRU и сохранённая отметка update_id"""
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot_final
+
+DAY = 86400
+
+
+def update(update_id, callback_id=None):
+    callback = SimpleNamespace(id=callback_id) if callback_id else None
+    return SimpleNamespace(update_id=update_id, callback_query=callback)
+
+
+@pytest.fixture
+def make_dedup(db):
+    def make(mark=None, saved_at=None):
+        if mark is not None:
+            value = mark if saved_at is None else {'update_id': mark, 'saved_at': saved_at}
+            bot_final.set_meta('test_update_id', json.dumps(value))
+        dedup = bot_final.UpdateDeduplicator(100, 3600, 6 * DAY, meta_key='test_update_id')
+        dedup.load()
+        return dedup
+    return make
+
+
+def test_repeated_update_and_callback_are_dropped(make_dedup):
+    dedup = make_dedup()
+
+    assert dedup.claim(update(1, "cb"))
+    assert not dedup.claim(update(1, "cb"))
+    assert not dedup.claim(update(2, "cb"))
+    assert dedup.claim(update(3))
+
+
+def test_released_update_can_be_claimed_again(make_dedup):
+    dedup = make_dedup()
+    dedup.claim(update(5))
+
+    dedup.release(update(5))
+
+    assert dedup.claim(update(5))
+
+
+def test_mark_survives_restart(make_dedup):
+    dedup = make_dedup()
+    for update_id in range(1000, 1010):
+        dedup.claim(update(update_id))
+    dedup.flush()
+
+    restarted = make_dedup()
+
+    assert not restarted.claim(update(1009))
+    assert not restarted.claim(update(1000))
+    assert restarted.claim(update(1010))
+
+
+def test_new_sequence_far_below_mark_is_accepted(make_dedup):
+    dedup = make_dedup(900000000, time.time())
+
+    assert not dedup.claim(update(900000000 - 5))
+    assert dedup.claim(update(12345))
+
+
+def test_stale_mark_is_ignored(make_dedup):
+    dedup = make_dedup(900000000, time.time() - 7 * DAY)
+
+    assert dedup.claim(update(900000000 - 5))
+
+
+def test_mark_without_timestamp_still_applies_near_it(make_dedup):
+    dedup = make_dedup(900000000)
+
+    assert not dedup.claim(update(900000000))
+    assert dedup.claim(update(12345))
+
+
+def test_mark_follows_new_sequence(make_dedup):
+    dedup = make_dedup(900000000, time.time())
+    dedup.claim(update(12345))
+    dedup.flush()
+
+    restarted = make_dedup()
+
+    assert restarted.load() == 12345
+    assert not restarted.claim(update(12345))
@@ -0,0 +1,109 @@
+"""Polling: offset стоит на первом необработанном обновлении"""
+import threading
+import time
+
+import pytest
+import telebot
+
+import bot_final
+
+
+def make_update(update_id, chat_id):
+    return telebot.types.Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'},
+            'text': 'hi',
+        },
+    })
+
+
+class Handler:
+    """Записывает обработанные update_id; заданные ждут release()"""
+
+    def __init__(self, blocked=()):
+        self.handled = []
+        self.blocked = set(blocked)
+        self._released = threading.Event()
+
+    def __call__(self, update):
+        if update.update_id in self.blocked:
+            self._released.wait(5)
+        self.handled.append(update.update_id)
+
+    def release(self):
+        self._released.set()
+
+
+@pytest.fixture
+def polling(db, monkeypatch):
+    """Свежие dispatcher, deduplicator и poller поверх временной БД"""
+    def make(handler, mark=None):
+        dispatcher = bot_final.UpdateDispatcher(handler, 4, 100)
+        dedup = bot_final.UpdateDeduplicator(100, 3600, 6 * 86400)
+        monkeypatch.setattr(bot_final, "update_dispatcher", dispatcher)
+        monkeypatch.setattr(bot_final, "update_deduplicator", dedup)
+        if mark is not None:
+            bot_final.set_meta(dedup.meta_key, mark)
+        dedup.load()
+        poller = bot_final.UpdatePoller(100, 1)
+        poller.load()
+        return dispatcher, poller
+    return make
+
+
+def saved_offset():
+    row = bot_final.db_fetchone(
+        "SELECT value FROM bot_meta WHERE key = ?", (bot_final.UpdatePoller.META_KEY,)
+    )
+    return int(row[0]) if row else None
+
+
+def test_offset_waits_for_slow_update(polling):
+    handler = Handler(blocked={11})
+    dispatcher, poller = polling(handler)
+
+    poller._dispatch([make_update(10, 1), make_update(11, 2), make_update(12, 3)])
+    dispatcher.wait_progress(10, 5)
+    dispatcher.wait_progress(12, 5)
+    poller.save_offset()
+
+    assert saved_offset() == 11
+
+    handler.release()
+    assert dispatcher.wait_idle(5)
+    poller.save_offset()
+
+    assert saved_offset() == 13
+    assert sorted(handler.handled) == [10, 11, 12]
+
+
+def test_redelivered_update_in_progress_is_skipped(polling):
+    handler = Handler(blocked={11})
+    dispatcher, poller = polling(handler)
+    poller._dispatch([make_update(11, 1)])
+    poller.save_offset()
+
+    # offset остался на 11 — getUpdates вернёт его ещё раз вместе с новым
+    poller._dispatch([make_update(11, 1), make_update(12, 2)])
+    handler.release()
+    assert dispatcher.wait_idle(5)
+
+    assert sorted(handler.handled) == [11, 12]
+
+
+def test_unprocessed_updates_are_handled_after_restart(polling):
+    # До сбоя: приняты 11 и 12 (отметка дедупликации 12), обработано ничего
+    bot_final.set_meta(bot_final.UpdatePoller.META_KEY, 11)
+    handler = Handler()
+    dispatcher, poller = polling(handler, mark='{"update_id": 12, "saved_at": %d}' % time.time())
+
+    poller._dispatch([make_update(11, 1), make_update(12, 2), make_update(13, 3)])
+    assert dispatcher.wait_idle(5)
+    poller.save_offset()
+
+    assert sorted(handler.handled) == [11, 12, 13]
+    assert saved_offset() == 14